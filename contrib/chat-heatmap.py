@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+from collections import deque
 
 # takes an ass file and shows how many messages there are within a 30sec window at each time
 # for example to see where a youtube/twitch chatlog is hype
@@ -11,9 +12,13 @@ import sys
 #
 # example: list the most explosive parts (chat going from idle to 3x activity)
 #  chat-heatmap.py some.ass | awk '$1>p*3{printf "\n%s\n%s\n",p,$0} {p=$0}'
+#
+# `python3 -m softchat.heatmap` does the same from the chat json (and
+# caches it, so it's fast enough for a few hundred vods at once), and
+# can show several window sizes side by side
 
 
-stack = []
+stack = deque()
 basets = 0
 maxnum = 0
 maxts = 0
@@ -24,12 +29,10 @@ with open(sys.argv[1], "rb") as f:
 
         ts = ln.split(",")[1].split(":")
         ts = 60 * (60 * int(ts[0]) + int(ts[1])) + float(ts[2])
-        rm = 0
-        for v in stack:
-            if v < ts - 10:
-                rm += 1
+        stack.append(ts)
+        while stack[0] < ts - 10:
+            stack.popleft()
 
-        stack = stack[rm:] + [ts]
         if maxnum < len(stack):
             maxnum = len(stack)
             maxts = ts
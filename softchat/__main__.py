@@ -15,52 +15,71 @@ import os
 import sys
 import time
 import json
-import zlib
+import copy
 import shlex
+import atexit
 import string
 import base64
 import random
-import requests
-import pprint
 import hashlib
 import shutil
 import argparse
 import tempfile
-import colorsys
 import datetime
-import multiprocessing
-import subprocess as sp
-from PIL import Image
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
 from .util import debug, info, warn, error, init_logger
-from .util import HAVE_FONTFORGE, MACOS, WINDOWS
-from .util import shell_esc, zopen, tt, hms, get_ff_info, load_fugashi
-from .mproc import TextStuff, gen_msg_thr, gen_msg_initializer
-from .ass import assan, segment_msg, render_msegs
-from .fconv import convert_file
+from .util import have_fontforge, MACOS, WINDOWS
+from .util import shell_esc, zopen, tt, hms, unhms, load_fugashi
+from .util import cpu_limit, mem_avail
+from .mproc import TextStuff, Ctx, gen_msg_thr, memo_key, WORKER_MEM, FUGASHI_MEM
+from .executor import get_executor, EXECUTORS
+from .ass import AssWriter, ass_header, dialogue
+from .danmaku import Danmaku, Admission, layout, move_txt
+from .sidebar import Sidebar
+from .fconv import convert_file, convert_action
+from .follow import tail_json
+from .fetch import fetch_all
+from .fontcache import get_font, emote_map, FIRST_POINT
+from .chatidx import load_window
+from .probe import get_media_info
+from .subset import subset_font
+from .heatmap import save_density
+from .trace import span
+from . import trace
 
 
-try:
-    from nototools import merge_fonts
+if __name__ == "__main__":
+    init_logger("-d" in sys.argv)
 
-    HAVE_NOTO_MERGE = True
-except ImportError:
-    HAVE_NOTO_MERGE = False
 
+FONT_NAME = "Squished Noto Sans CJK JP Regular"
 
-if __name__ == "__main__":
-    init_logger("-d" in sys.argv)
+# bump this if the emote conversion changes in a way
+# which is not visible in the arguments of emote_cmds
+EMOTE_CONV_VER = 1
 
+# the imagemagick command; None until find_magick() has looked
+magick = None
 
-HAVE_MAGICK = False
-try:
-    magick = ["magick", "convert"]
-    if shutil.which(magick[0]) is None and not WINDOWS:
-        magick = ["convert"]
+# one build_emotes at a time; with --batch the next file's emotes would
+# otherwise be cached into the same emote_dir while this one is converting
+EMOTE_LOCK = threading.Lock()
 
-    if shutil.which(magick[0]) is not None:
-        HAVE_MAGICK = True
-except:
-    pass
+
+def find_magick():
+    """the imagemagick command, or [] if there is none"""
+    global magick
+    if magick is None:
+        cmd = ["magick", "convert"]
+        if shutil.which(cmd[0]) is None and not WINDOWS:
+            cmd = ["convert"]
+
+        magick = cmd if shutil.which(cmd[0]) else []
+
+    return magick
 
 
 def convert_old(m):
@@ -91,16 +110,13 @@ def convert_old(m):
     return o
 
 
-def cache_emotes(emotes, emote_dir, overwrite):
-    try:
-        lastmod_softchat = os.stat(os.path.abspath(__file__)).st_mtime
-    except:
-        lastmod_softchat = 0
-        warn("could not lastmod self, will not replace existing png/svg emotes")
-
+def cache_emotes(emotes, emote_dir, overwrite, j):
+    dls = []
     for e in emotes.values():
         source_fname = os.path.join(emote_dir, e["id"].replace("/", "_"))
         try:
+            from PIL import Image
+
             im = Image.open(source_fname)
             source_ok = True
         except:
@@ -134,24 +150,32 @@ def cache_emotes(emotes, emote_dir, overwrite):
                 error(f"Could not find URL for {e['name']}")
                 sys.exit(1)
 
-            r = requests.get(url)
-            # Save the originals in case youtube stops providing them for whatever reason.
-            # These can also be used to manually replace the svgs if the automatically
-            # generated one is of low quality.
-            with open(source_fname, "wb") as f:
-                f.write(r.content)
+            dls.append([url, source_fname])
+
+    # Save the originals in case youtube stops providing them for whatever reason.
+    # These can also be used to manually replace the svgs if the automatically
+    # generated one is of low quality.
+    if dls:
+        info(f"downloading {len(dls)} emotes")
+        # mostly waiting on the network, so more than the cores
+        errs = fetch_all(dls, max(8, j))
+        if errs:
+            error(f"failed to download {len(errs)} emotes")
+            sys.exit(1)
 
-            r.close()
+    fp = emote_fingerprint()
+    todo = {}  # source hash to the emotes which need it converted
+    done = {}  # source hash to an up-to-date conversion of it
+    for e in emotes.values():
+        source_fname = os.path.join(emote_dir, e["id"].replace("/", "_"))
 
         # look for existing intermediate file for fontforge
         for ext in [".png", ".svg"]:
             fname = source_fname + ext
-            try:
-                lastmod = os.stat(fname).st_mtime
+            if os.path.exists(fname):
                 break
-            except:
-                lastmod = 0
-                fname = None
+
+            fname = None
 
         if not fname:
             if WINDOWS:
@@ -171,89 +195,401 @@ def cache_emotes(emotes, emote_dir, overwrite):
         if os.path.isfile(manual_fname):
             debug(f"Using {e['name']:14} {manual_fname}")
             e["filename"] = os.path.abspath(manual_fname)
-        elif (lastmod != 0 and not overwrite) or lastmod > lastmod_softchat:
+            continue
+
+        with open(source_fname, "rb") as f:
+            src_hash = hashlib.sha256(f.read()).hexdigest()
+
+        # the fingerprint says which source and which settings
+        # an intermediate file was made from
+        want = f"{fp} {src_hash}"
+        try:
+            with open(fname + ".fp", "r", encoding="utf-8") as f:
+                have = f.read().strip()
+        except:
+            have = None
+
+        if have == want:
+            debug(f"Reusing {e['name']:14} {fname}")
+            done[src_hash] = fname
+        elif have is None and os.path.exists(fname) and not overwrite:
+            # from before fingerprints; keep unless --emote_refilter
             debug(f"Reusing {e['name']:14} {fname}")
         else:
+            todo.setdefault(src_hash, []).append([e, source_fname, fname])
+
+    # identical artwork under different emote IDs is very common,
+    # so convert each distinct source once and link the rest to it
+    convs = []
+    for src_hash, v in todo.items():
+        if src_hash not in done:
+            e, source_fname, fname = v[0]
             info(f"Converting {e['name']:14} {fname}")
-            fname2 = source_fname + ".bmp" if MACOS else fname
-            cmd = magick[:]
-            # fmt: off
-            cmd.extend([
-                source_fname,
-                "-fill", "white",
-                "-flatten",
-                "-filter", "Jinc",
-                "-resize", "1000x",
-                "-colorspace", "gray",
-                # Determined experimentally to be a good middle-ground.
-                # Higher black values catch more detail but values that are too
-                # high produce noisy, ugly output. Higher white values result
-                # in better handling of flat areas and gradients but values
-                # that are too high will destroy detail.
-                # There is no single best option for all emotes.
-                "-contrast-stretch", "3%x9%",
-                "-channel", "rgb",
-                "-negate",
-                fname2,
-            ])
-            # fmt: on
-
-            completed = sp.run(cmd)
-            if completed.returncode != 0:
-                error(f"Failed to convert {e['name']}")
+            convs.append([e["name"], source_fname, fname])
+
+    if convs:
+        with ThreadPoolExecutor(min(j, len(convs))) as ex:
+            errs = [x for x in ex.map(convert_emote, convs) if x]
+
+        if errs:
+            for name, cmd in errs:
+                error(f"Failed to convert {name}")
                 warn(shell_esc(cmd))
-                sys.exit(1)
 
-            if MACOS:
-                # imagemagick invokes potrace with unsupported input format
-                cmd = "potrace --svg --output".split()
-                cmd += [fname, fname2]
+            sys.exit(1)
+
+    for src_hash, v in todo.items():
+        src = done.get(src_hash, v[0][2])
+        for e, _, fname in v:
+            if fname != src:
+                debug(f"Linking {e['name']:14} {fname}")
+                link_file(src, fname)
+
+            with open(fname + ".fp", "w", encoding="utf-8") as f:
+                f.write(f"{fp} {src_hash}\n")
+
+
+def stand_in_emotes(emotes, emote_dir):
+    """
+    [shortcuts, filled_emotes] with made-up codepoints, for when
+    the emote font is still being built; it has to agree with the real
+    one on which emotes are filled, but not on the codepoints
+    """
+    ret = {}
+    for n, (k, e) in enumerate(emotes.items()):
+        fill_fname = os.path.join(emote_dir, e["id"].replace("/", "_")) + ".bg"
+        ret[k] = dict(e, point=FIRST_POINT + n, fill=os.path.exists(fill_fname))
+
+    return emote_map(ret)
+
+
+def build_emotes(emotes, ar, emote_dir, font_fn, font_name):
+    # download, convert, and make the font; returns [shortcuts, filled_emotes]
+    with EMOTE_LOCK:
+        cache_emotes(emotes, emote_dir, ar.emote_refilter, num_cores(ar))
+        return get_font(
+            emotes,
+            font_fn,
+            font_name,
+            ar.emote_nofont,
+            os.path.join(emote_dir, "fonts"),
+            generate_font,
+        )
+
+
+def emote_cmds(source_fname, fname):
+    """the commands which turn an emote source into an intermediate file"""
+    fname2 = source_fname + ".bmp" if MACOS else fname
+    cmd = find_magick()[:]
+    # fmt: off
+    cmd.extend([
+        source_fname,
+        "-fill", "white",
+        "-flatten",
+        "-filter", "Jinc",
+        "-resize", "1000x",
+        "-colorspace", "gray",
+        # Determined experimentally to be a good middle-ground.
+        # Higher black values catch more detail but values that are too
+        # high produce noisy, ugly output. Higher white values result
+        # in better handling of flat areas and gradients but values
+        # that are too high will destroy detail.
+        # There is no single best option for all emotes.
+        "-contrast-stretch", "3%x9%",
+        "-channel", "rgb",
+        "-negate",
+        fname2,
+    ])
+    # fmt: on
+    ret = [cmd]
+
+    if MACOS:
+        # imagemagick invokes potrace with unsupported input format
+        cmd = "potrace --svg --output".split()
+        cmd += [fname, fname2]
+        ret.append(cmd)
+
+    return ret
+
+
+def emote_fingerprint():
+    """changes whenever emote_cmds would make something different"""
+    cmds = emote_cmds("SRC", "DST.svg")
+    jtxt = json.dumps([EMOTE_CONV_VER, WINDOWS, cmds])
+    return hashlib.sha256(jtxt.encode("utf-8")).hexdigest()[:24]
+
+
+def convert_emote(a):
+    """returns [name, failed_cmd] or None if ok"""
+    import subprocess as sp
+
+    name, source_fname, fname = a
+
+    # into a new file, since fname can be a hardlink to other emotes
+    base, ext = os.path.splitext(fname)
+    tmp = base + ".tmp" + ext
+    for cmd in emote_cmds(source_fname, tmp):
+        completed = sp.run(cmd)
+        if completed.returncode != 0:
+            return [name, cmd]
+
+    os.replace(tmp, fname)
+    return None
+
+
+def link_file(src, dst):
+    tmp = dst + ".tmp"
+    try:
+        os.unlink(tmp)
+    except:
+        pass
+
+    try:
+        os.link(src, tmp)
+    except:
+        shutil.copy2(src, tmp)
+
+    os.replace(tmp, dst)
+
+
+def norm_msg(m, ar, emotes, deleted_messages, deleted_authors):
+    """
+    returns the chat item if it is a message to display, normalized;
+    takes note of deletions and emotes along the way
+    """
+    at = m.get("action_type", None)
+    if at == "mark_chat_item_as_deleted":
+        deleted_messages.add(m["target_message_id"])
+    elif at == "mark_chat_items_by_author_as_deleted":
+        deleted_authors.add(m["author"]["id"])
+
+    if (
+        ar.filter_gifts
+        and m.get("message_type", None) == "sponsorships_gift_redemption_announcement"
+    ):
+        return None
+
+    if "emotes" in m:
+        customs = []
+        stocks = []
+        for x in m["emotes"]:
+            if x.get("is_custom_emoji", True):
+                customs.append(x)
+            else:
+                stocks.append(x)
+
+        # only keep/convert the custom emotes
+        m["emotes"] = customs
+
+        # non-customs have regular unicode emojis as IDs,
+        # so swap out the shortcuts with those instead
+        for emote in stocks:
+            uchar = emote["id"]
+            if len(uchar) > 8:
+                continue
+
+            txt = m["message"]
+            if emote["shortcuts"] is not None:
+                for sc in emote["shortcuts"]:
+                    txt = txt.replace(sc, uchar)
+
+            m["message"] = txt
 
-                completed = sp.run(cmd)
-                if completed.returncode != 0:
-                    error(f"Failed to convert {e['name']}")
-                    warn(shell_esc(cmd))
-                    sys.exit(1)
+    if at is None and "message" in m:
+        # twitch
+        msg = m["message"]
+        at = "add_chat_item"
+        for emote in m.get("emotes", []):
+            if "shortcuts" in emote:
+                warn(f"expected no shortcuts, got [{emote['shortcuts']}]")
+                continue
+
+            shortcut = ":" + emote["name"] + ":"
+            msg = msg.replace(emote["name"], shortcut)
+            emote["shortcuts"] = [shortcut]
+
+        m["message"] = msg
+
+    if (
+        at != "add_chat_item"
+        or m.get("author", {}).get("id", None) is None
+        or (
+            m.get("message", False) is False
+            and "amount" not in m
+            and "money" not in m
+        )
+    ):
+        return None
+
+    # For now, assume emote shortcuts are unique so we can postpone processing them
+    if "emotes" in m:
+        for e in m["emotes"]:
+            if e["id"] not in emotes:
+                emotes[e["id"]] = e
+
+    return m
+
+
+class FFWorker(object):
+    """
+    a long-lived ffpython running softchat.fff --serve, so its startup
+    is only paid once per run instead of once per font; one json line
+    in, one json line out, and a new one is started if it dies
+    """
+
+    def __init__(self):
+        self.p = None
+        self.lock = threading.Lock()  # one request on the pipe at a time
+
+    def start(self):
+        import subprocess as sp
+
+        libdir = os.path.dirname(os.path.abspath(__file__))
+        libdir = os.path.join(libdir, "..")
+
+        env = os.environ.copy()
+        old_libdir = env.get("PYTHONPATH")
+        if old_libdir:
+            libdir = [x.strip(os.pathsep) for x in [libdir, old_libdir]]
+            libdir = os.pathsep.join(libdir)
+
+        env["PYTHONPATH"] = libdir
+
+        cmd = [have_fontforge(), "-m", "softchat.fff", "--serve"]
+        self.p = sp.Popen(cmd, env=env, stdin=sp.PIPE, stdout=sp.PIPE)
 
+    def call(self, args):
+        with self.lock:
+            return self.call_locked(args)
 
-def generate_font_with_ffpython(*args):
-    jtxt = json.dumps(args)
-    with tempfile.NamedTemporaryFile(
-        mode="w", encoding="utf-8", prefix="softchat-", delete=False
-    ) as tf:
-        tf_path = tf.name
-        tf.write(jtxt)
+    def call_locked(self, args):
+        req = (json.dumps(args) + "\n").encode("utf-8")
+        for _ in range(2):
+            if not self.p or self.p.poll() is not None:
+                self.start()
 
-    libdir = os.path.dirname(os.path.abspath(__file__))
-    libdir = os.path.join(libdir, "..")
+            try:
+                self.p.stdin.write(req)
+                self.p.stdin.flush()
+                ln = self.p.stdout.readline()
+            except OSError:
+                ln = None
+
+            if ln:
+                break
+
+            warn("the fontforge worker died; restarting it")
+            self.close()
+        else:
+            raise Exception("the fontforge worker keeps dying")
+
+        ret = json.loads(ln.decode("utf-8"))
+        if "err" in ret:
+            raise Exception("fontforge: " + ret["err"])
 
-    env = os.environ.copy()
-    old_libdir = env.get("PYTHONPATH")
-    if old_libdir:
-        libdir = [x.strip(os.pathsep) for x in [libdir, old_libdir]]
-        libdir = os.pathsep.join(libdir)
+        return ret["ok"]
 
-    env["PYTHONPATH"] = libdir
+    def close(self):
+        if not self.p:
+            return
+
+        try:
+            self.p.stdin.close()
+            self.p.wait(10)
+        except:
+            self.p.kill()
 
-    sp.check_call([HAVE_FONTFORGE, "-m", "softchat.fff", tf_path], env=env)
+        self.p = None
 
-    with open(tf_path, "r", encoding="utf-8") as f:
-        ret = f.read()
 
-    os.unlink(tf_path)
-    return json.loads(ret)
+ffworker = FFWorker()
+atexit.register(ffworker.close)
 
 
-def generate_font(emotes, font_fn, font_name, dont_write):
-    args = [emotes, font_fn, font_name, dont_write]
-    if HAVE_FONTFORGE is not True:
-        return generate_font_with_ffpython(*args)
+def generate_font(emotes, font_fn, font_name, dont_write, base_fn):
+    args = [emotes, font_fn, font_name, dont_write, base_fn]
+    if have_fontforge() is not True:
+        return ffworker.call(args)
 
     from . import fff
 
     return fff.gen_fonts(*args)
 
 
+def load_chat(fn, ar):
+    """the chat items in fn, or exits if it's not a chatlog"""
+    info(f"loading {fn}")
+    with zopen(fn, "r", encoding="utf-8") as f:
+        err = None
+        whole = True
+        try:
+            jd2 = None
+            if ar.t_from is not None or ar.t_to is not None:
+                # the json doesn't have --offset yet
+                ofs = ar.offset or 0
+                t_to = None if ar.t_to is None else ar.t_to - ofs
+                jd2 = load_window(fn, (ar.t_from or 0) - ofs, t_to)
+                whole = jd2 is None
+
+            if jd2 is None:
+                jd2 = json.load(f)
+        except Exception as ex:
+            err = repr(ex)
+            jd2 = None
+
+        if err and "Extra data" in err:
+            m = "input json is not a valid chat_downloader chatlog; trying to convert it..."
+            warn(m)
+            try:
+                jd2 = list(convert_file(f))
+                # debug("writing converted json")
+                # with open(fn + ".conv.json", "w", encoding="utf-8") as cf:
+                #     json.dump(jd2, cf, sort_keys=True, indent=2)
+                err = None
+            except Exception as ex:
+                err += "\nfconv: " + repr(ex)
+
+        if not err and not jd2:
+            err = "empty json file?"
+
+        if not err:
+            try:
+                if jd2 and "formats" in jd2:
+                    err = "this is a youtube-dl info file, not a chatlog"
+            except:
+                pass
+
+        if not err and not is_a_chatlog(jd2):
+            err = "does not look like a chatlog"
+
+        if err:
+            error(f"failed: {err}")
+            sys.exit(1)
+
+        if jd2 and jd2[0].get("author_id", None):
+            info(f"Converting legacy chat json {fn} to new format")
+            jd2 = [convert_old(x) for x in jd2]
+
+        if whole:
+            # for softchat.heatmap
+            save_density(fn, jd2)
+
+        return jd2
+
+
+def upgrade_msg(m):
+    """one chat item from yt-dlp or an old chat_downloader in the current format"""
+    if m.get("author_id", None):
+        return convert_old(m)
+
+    # yt-dlp is {"replayChatItemAction": ...} or {"addChatItemAction": ...} etc;
+    # not just anything without a timestamp, since deletions don't have one
+    if any(k.endswith("Action") for k in m):
+        return convert_action(m)
+
+    return m
+
+
 def is_a_chatlog(jd):
     try:
         hits = 0
@@ -271,16 +607,7 @@ class Okay(
     pass
 
 
-def main():
-    t0_main = time.time()
-
-    random.seed(b"nope")
-
-    vips = [
-        "UCkIccKaHDGA8lYVmUerLhag",
-        "UCI1KCp4Wa3dGfcmxgik1mCw",
-    ]
-
+def mk_argparser():
     ap = argparse.ArgumentParser(
         formatter_class=Okay,
         description="convert modified chat_replay_downloader.py json into box-confined or danmaku-style softsubs",
@@ -292,10 +619,13 @@ def main():
     ap.add_argument("-m", metavar="MODE", type=int, default=1, help="mode, 1=box, 2=danmaku")
     ap.add_argument("-r", metavar="WxH", type=str, default=None, help="video res, defaults to 1280x720 or 720x1280 if a vertical video is detected")
     ap.add_argument("-b", metavar="WxH+X+Y", type=str, default=None, help="subtitle area")
-    ap.add_argument("-j", metavar="CORES", type=int, default=0, help="number of cores to use (0=all, 1=single-threaded)")
+    ap.add_argument("-j", metavar="CORES", type=int, default=0, help="number of cores to use (0=auto, 1=single-threaded)")
+    ap.add_argument("--executor", metavar="KIND", choices=EXECUTORS, default="auto", help="measure with worker processes, threads (for free-threaded python), or serial; auto=process, or thread if the GIL is off")
     ap.add_argument("--sz", metavar="POINTS", type=int, default=0, help="font size")
     ap.add_argument("--spd", metavar="SPEED", type=int, default=256, help="[danmaku] pixels/sec")
     ap.add_argument("--spread", action="store_true", help="[danmaku] even distribution")
+    ap.add_argument("--dm_max", metavar="N", type=int, default=0, help="[danmaku] at most N messages on screen at once (0=unlimited); when it gets busier, short and repeated messages are dropped first, then normal ones, while superchats/mods/VIPs may use up to 2N")
+    ap.add_argument("--dm_cover", metavar="MUL", type=float, default=0, help="[danmaku] like --dm_max, but limits the total area of the messages on screen, as a multiple of the screen area (0=unlimited)")
     ap.add_argument("--kana", action="store_true", help="convert kanji to kana")
     ap.add_argument("--fontdir", metavar="DIR", type=str, default=None, help="path to noto-hinted")
     ap.add_argument("--dupe_thr", metavar="SEC", type=float, default=10, help="Hide duplicate messages from the same author within this many seconds")
@@ -308,8 +638,10 @@ def main():
     ap.add_argument("--emote_cache", metavar="EMOTE_DIR", type=str, default=None, help="Directory to store emotes in. By default it is $pwd/emotes, but using the same directory for all invocations is safe. Will be created if it does not exist.")
     ap.add_argument("--emote_sz", metavar="MUL", type=float, default=1, help="Emote size multiplier")
     ap.add_argument("--emote_fill", action="store_true", help="Fill emote backgrounds")
-    ap.add_argument("--emote_refilter", action="store_true", help="Replaces your preprocessed emotes (*.png) if this version of softchat is more recent than each png")
+    ap.add_argument("--emote_refilter", action="store_true", help="Replaces your preprocessed emotes (*.png/*.svg) unless they were made with the same source image and conversion settings as this version of softchat would use")
     ap.add_argument("--embed_files", action="store_true", help="Will attempt to embed the subtitles and emote font, if generated, into the media file. This will make a copy of the media file.")
+    ap.add_argument("--embed_pipe", action="store_true", help="like --embed_files, but feed the subtitles straight into ffmpeg instead of writing the .ass to disk first")
+    ap.add_argument("--subset_font", action="store_true", help="[embed_files] also embed a copy of the squished CJK font with just the glyphs that are used, named uniquely for this file, so players don't need it installed")
     ap.add_argument("--cleanup", action="store_true", help="If --embed_files is used, delete the produced subtitle and font files after embedding them. The original media file and chat downloads are never touched.")
     ap.add_argument("--media", metavar="MEDIA", type=str, default=None, help="The video file for the stream. Passing this is optional since it will be detected automatically if it shares a name with the chat replay file.")
     ap.add_argument("--emote_chat_file", metavar="EMOTE_DUMP", type=str, default=None, help="You probably don't need this. A chat file for another stream including emotes, for use with legacy chat files that do not include emotes when it's impossible to get a new chat replay download.")
@@ -317,9 +649,26 @@ def main():
     ap.add_argument("--emote_install", action="store_true", help="install emote fonts into media player folders")
     ap.add_argument("--emote_install_dir", type=str, default=None, help="Optional directory to install fonts, if not present will try to determine a default system location.")
     ap.add_argument("--no_errdep_emotes", action="store_true", help="ignore missing dependencies for requested emote stuff; disable the unsatisfiable arguments and continue")
-    ap.add_argument("fn", metavar="JSON_FILE", nargs="+")
-    ar = ap.parse_args()
+    ap.add_argument("--from", metavar="H:M:S", dest="t_from", type=unhms, default=None, help="only render the chat from this far into the video (seconds or h:m:s); sidecar index is created to speed up next time")
+    ap.add_argument("--to", metavar="H:M:S", dest="t_to", type=unhms, default=None, help="only render the chat until this far into the video")
+    ap.add_argument("--segment", metavar="MIN", type=float, default=0, help="split the .ass into one file per MIN minutes of video, plus a .segments.json; each one is complete on its own, so players only need to load the one at the playhead")
+    ap.add_argument("--follow", action="store_true", help="keep reading JSON_FILE while it is being written (live stream), appending to the .ass as messages arrive; use sub-reload in mpv to pick them up")
+    ap.add_argument("--follow_timeout", metavar="SEC", type=float, default=0, help="[follow] stop after this many seconds without new messages (0=never, ctrl-c to stop)")
+    ap.add_argument("--batch", action="store_true", help="convert each JSON_FILE on its own (instead of splicing them together), sharing the warmed-up workers between them")
+    ap.add_argument("--batch_list", metavar="TXT", type=str, default=None, help="like --batch, for the JSON_FILEs listed in this text file (one per line)")
+    ap.add_argument("--trace", metavar="FILE", type=str, default=None, help="[DEBUG] write a chrome/perfetto trace of where the time goes, in this process and each worker, into FILE")
+    ap.add_argument("fn", metavar="JSON_FILE", nargs="*")
     # fmt: on
+    return ap
+
+
+def main():
+    t0_main = time.time()
+
+    random.seed(b"nope")
+
+    ap = mk_argparser()
+    ar = ap.parse_args()
 
     have_fugashi = bool(load_fugashi(write_cfg=True))
     if ar.kana and not have_fugashi:
@@ -328,10 +677,10 @@ def main():
 
     if ar.emote_font:
         err = []
-        if not HAVE_MAGICK:
+        if not find_magick():
             err.append("imagemagick")
 
-        if not HAVE_FONTFORGE:
+        if not have_fontforge():
             err.append("fontforge")
 
         if err:
@@ -343,6 +692,107 @@ def main():
             else:
                 sys.exit(1)
 
+    if ar.embed_pipe:
+        ar.embed_files = True
+
+    if ar.follow:
+        err = [x for x in ["emote_font", "embed_files", "segment"] if getattr(ar, x)]
+        if len(ar.fn) > 1:
+            err.append("multiple JSON_FILEs")
+
+        if err:
+            error(f"--follow cannot be combined with {', '.join(err)}")
+            sys.exit(1)
+
+    if ar.batch_list:
+        ar.batch = True
+        with open(ar.batch_list, "r", encoding="utf-8") as f:
+            for ln in f:
+                ln = ln.strip()
+                if ln and not ln.startswith("#"):
+                    ar.fn.append(ln)
+
+    if not ar.fn:
+        ap.error("no JSON_FILE given")
+
+    if ar.batch and (ar.follow or ar.media):
+        error("--batch cannot be combined with --follow or --media")
+        sys.exit(1)
+
+    if not ar.sz:
+        ar.sz = 18 if ar.m == 1 else 24
+        info(f"fontsize {ar.sz} pt")
+
+    if ar.trace:
+        trace.start(ar.trace)
+
+    try:
+        if ar.batch:
+            return batch(ar, have_fugashi)
+
+        j = num_cores(ar, have_fugashi)
+        with get_executor(ar.executor, ar, have_fugashi, j) as ex:
+            for _ in convert(ar, have_fugashi, t0_main, ex):
+                pass
+    finally:
+        if ar.trace:
+            trace.finish()
+
+
+def batch(ar, have_fugashi):
+    """
+    --batch; converts each file on its own but with the same workers,
+    loading the next file while the current one is being measured
+    """
+    fns = ar.fn
+    failed = []
+    text_stuff(ar)  # makes the squished font if necessary, before the workers look
+    j = num_cores(ar, have_fugashi)
+    with get_executor(ar.executor, ar, have_fugashi, j) as ex, ThreadPoolExecutor(
+        1
+    ) as loader:
+
+        def load(fn):
+            a = copy.copy(ar)
+            a.fn = [fn]
+            gen = convert(a, have_fugashi, time.time(), ex)
+            return gen, loader.submit(next, gen, None)
+
+        nxt = load(fns[0])
+        for n, fn in enumerate(fns):
+            info(f"batch: file {n + 1} of {len(fns)}, {fn}")
+            gen, fut = nxt
+            if n + 1 < len(fns):
+                nxt = load(fns[n + 1])
+
+            try:
+                fut.result()
+                for _ in gen:
+                    pass
+            except (Exception, SystemExit) as ex:
+                error(f"batch: {fn} failed: {ex!r}")
+                failed.append(fn)
+
+    info(f"batch: {len(fns) - len(failed)} of {len(fns)} files converted")
+    if failed:
+        error("batch: these failed:\n  " + "\n  ".join(failed))
+        sys.exit(1)
+
+
+def convert(ar, have_fugashi, t0_main, ex):
+    """
+    converts the chat in ar.fn into an .ass; this is a generator
+    which yields once, when it's done loading and about to measure
+    """
+
+    if ar.segment and ar.embed_files:
+        error("--embed_files needs the whole .ass, so it cannot be used with --segment")
+        sys.exit(1)
+
+    if ar.subset_font and not ar.embed_files:
+        error("--subset_font only makes sense with --embed_files or --embed_pipe")
+        sys.exit(1)
+
     media_fn = None
     if ar.media and os.path.isfile(ar.media):
         media_fn = ar.media
@@ -382,141 +832,25 @@ def main():
         if not os.path.exists(emote_dir):
             os.mkdir(emote_dir)
 
-    if not ar.sz:
-        ar.sz = 18 if ar.m == 1 else 24
-        info(f"fontsize {ar.sz} pt")
+    font_name = FONT_NAME
+    if ar.follow:
+        return follow(ar, out_fn, text_stuff(ar), font_name, have_fugashi)
 
+    # things which don't need the normalized chat happen in the background;
+    # the font check, media probe and loading start right away,
+    # and the emotes as soon as we know which ones there are
+    bg = ThreadPoolExecutor(4)
+    z = bg.submit(text_stuff, ar)
+    probe = bg.submit(get_media_info, media_fn) if media_fn else None
+    loads = [bg.submit(load_chat, fn, ar) for fn in ar.fn]
 
-    z = TextStuff(ar.sz, ar.fontdir, ar.emote_sz)
     emotes = dict()
 
-    jd = []
     deleted_messages = set()
     deleted_authors = set()
-    seen = set()
-    for fn in ar.fn:
-        info(f"loading {fn}")
-        with zopen(fn, "r", encoding="utf-8") as f:
-            err = None
-            try:
-                jd2 = json.load(f)
-            except Exception as ex:
-                err = repr(ex)
-                jd2 = None
-
-            if err and "Extra data" in err:
-                m = "input json is not a valid chat_downloader chatlog; trying to convert it..."
-                warn(m)
-                try:
-                    jd2 = list(convert_file(f))
-                    # debug("writing converted json")
-                    # with open(fn + ".conv.json", "w", encoding="utf-8") as cf:
-                    #     json.dump(jd2, cf, sort_keys=True, indent=2)
-                    err = None
-                except Exception as ex:
-                    err += "\nfconv: " + repr(ex)
-
-            if not err and not jd2:
-                err = "empty json file?"
-
-            if not err:
-                try:
-                    if jd2 and "formats" in jd2:
-                        err = "this is a youtube-dl info file, not a chatlog"
-                except:
-                    pass
-
-            if not err and not is_a_chatlog(jd2):
-                err = "does not look like a chatlog"
-
-            if err:
-                error(f"failed: {err}")
-                sys.exit(1)
-
-            if jd2 and jd2[0].get("author_id", None):
-                info(f"Converting legacy chat json {fn} to new format")
-                jd2 = [convert_old(x) for x in jd2]
-
-            if not jd2:
-                continue
-
-            for m in jd2:
-                at = m.get("action_type", None)
-                if at == "mark_chat_item_as_deleted":
-                    deleted_messages.add(m["target_message_id"])
-                elif at == "mark_chat_items_by_author_as_deleted":
-                    deleted_authors.add(m["author"]["id"])
-
-                if (
-                    ar.filter_gifts
-                    and m.get("message_type", None) == "sponsorships_gift_redemption_announcement"
-                ):
-                    continue
-
-
-                if "emotes" in m:
-                    customs = []
-                    stocks = []
-                    for x in m["emotes"]:
-                        if x.get("is_custom_emoji", True):
-                            customs.append(x)
-                        else:
-                            stocks.append(x)
-
-                    # only keep/convert the custom emotes
-                    m["emotes"] = customs
-
-                    # non-customs have regular unicode emojis as IDs,
-                    # so swap out the shortcuts with those instead
-                    for emote in stocks:
-                        uchar = emote["id"]
-                        if len(uchar) > 8:
-                            continue
-
-                        txt = m["message"]
-                        if emote["shortcuts"] is not None:
-                            for sc in emote["shortcuts"]:
-                                txt = txt.replace(sc, uchar)
-
-                        m["message"] = txt
-
-                if at is None and "message" in m:
-                    # twitch
-                    msg = m["message"]
-                    at = "add_chat_item"
-                    for emote in m.get("emotes", []):
-                        if "shortcuts" in emote:
-                            warn(f"expected no shortcuts, got [{emote['shortcuts']}]")
-                            continue
-
-                        shortcut = ":" + emote["name"] + ":"
-                        msg = msg.replace(emote["name"], shortcut)
-                        emote["shortcuts"] = [shortcut]
-
-                    m["message"] = msg
-
-                if (
-                    at != "add_chat_item"
-                    or m.get("author", {}).get("id", None) is None
-                    or (
-                        m.get("message", False) is False
-                        and "amount" not in m
-                        and "money" not in m
-                    )
-                ):
-                    continue
-
-                # For now, assume emote shortcuts are unique so we can postpone processing them
-                if "emotes" in m:
-                    for e in m["emotes"]:
-                        if e["id"] not in emotes:
-                            emotes[e["id"]] = e
-
-                # Must use a composite ID here so that legacy json can be used with new json
-                key = f"{m['timestamp']}\n{m['author']['id']}"
-                if key not in seen:
-                    seen.add(key)
-                    jd.append(m)
+    chats = (x.result() for x in loads)
+    with span("load", fn=ar.fn[0]):
+        jd = merge_chats(chats, ar, emotes, deleted_messages, deleted_authors)
 
     if ar.emote_chat_file is not None:
         info(f"loading emotes from {ar.emote_chat_file}")
@@ -558,27 +892,246 @@ def main():
         info("No emotes found")
         ar.emote_font = False
 
-    font_name = "Squished Noto Sans CJK JP Regular"
+    # Try to avoid collisions if someone does install these as system fonts.
+    font_hash = hashlib.sha512(base_fn.encode("utf-8")).digest()
+    font_hash = base64.urlsafe_b64encode(font_hash)[:16].decode("ascii")
+
+    cjk_fn = None
+    if ar.subset_font:
+        cjk_fn = font_fn.rsplit(".", 1)[0] + ".cjk.otf"
+        font_name = f"SoftChat Noto Subset {font_hash}"
+        # (or with --emote_font, it joins that family instead)
+
     emote_shortcuts = dict()
     filled_emotes = []
+    emote_font = None
     if ar.emote_font:
         info(f"Generating custom font with {len(emotes)} emotes")
-        cache_emotes(emotes, emote_dir, ar.emote_refilter)
-
-        # Try to avoid collisions if someone does install these as system fonts.
-        font_hash = hashlib.sha512(base_fn.encode("utf-8")).digest()
-        font_hash = base64.urlsafe_b64encode(font_hash)[:16].decode("ascii")
         font_name = f"SoftChat Custom Emotes {font_hash}"
-        emote_shortcuts, filled_emotes = generate_font(
-            emotes, font_fn, font_name, ar.emote_nofont
-        )
+
+        # measuring can start with stand-in codepoints,
+        # which are swapped for the real ones when the font is done
+        emote_shortcuts, filled_emotes = stand_in_emotes(emotes, emote_dir)
         filled_emotes = set(filled_emotes)
+        emote_font = bg.submit(build_emotes, emotes, ar, emote_dir, font_fn, font_name)
 
     use_018 = "; please use softchat v0.18 or older if your chat json was created with a chat_replay_downloader from before 2021-01-29-something"
     if not jd:
         raise Exception("no messages were loaded" + use_018)
 
+    with span("fix_times"):
+        jd = fix_times(jd, ar, deleted_messages, deleted_authors)
+
+    cdur_msg = None
+    cdur_err = "could not verify chat duration"
+    v_dur = None
+    v_res = None
+    if not media_fn:
+        cdur_err += ": could not find media file"
+    else:
+        info("calculating media duration")
+        try:
+            ofs = 0
+            while True:
+                ofs -= 1
+                chat_dur = jd[ofs]["time_in_seconds"]
+                if chat_dur < 4096 * 4096:
+                    break
+
+            v_dur, v_res = probe.result()
+            delta = abs(chat_dur - v_dur)
+            perc = delta * 100.0 / max(v_dur, chat_dur)
+            if delta > 60:
+                cdur_err = f"media duration ({v_dur:.0f}sec) and chat duration ({chat_dur:.0f}sec) differ by {delta:.0f}sec ({perc:.2f}%)"
+            else:
+                cdur_err = None
+                cdur_msg = f"chat duration appears correct; {v_dur:.0f}sec - {chat_dur:.0f}sec = {delta:.0f}sec ({perc:.2f}%)"
+        except Exception as ex:
+            media_fn = None
+            cdur_err += ": " + repr(ex)
+
+
+    media_res = ar.r
+    if media_res is None:
+        if v_res is not None:
+            vid_w, vid_h = v_res
+            if vid_w >= vid_h:
+                media_res = "1280x720"
+            else:
+                media_res = "720x1280"
+                info(f"Detected vertical video, using resolution {media_res}")
+        else:
+            media_res = "1280x720"
+
+    vw, vh = [int(x) for x in media_res.split("x")]
+
+    bw, bh, bx, by = [
+        int(x) for x in re.split(r"[x,+]+", ar.b if ar.b else media_res + "+0+0")
+    ]
+
+    if cdur_err:
+        warn(cdur_err)
+    else:
+        info(cdur_msg)
+
+    z = z.result()
+
+    with span("nick_dupes"):
+        nick_dupes = find_nick_dupes(jd)
 
+    if ar.t_from is not None or ar.t_to is not None:
+        with span("clip_window"):
+            jd = clip_window(jd, ar, vw, bh, z.emote_vsz[1])
+
+        info(f"{len(jd)} msgs in the --from/--to window, including warmup")
+
+    # done loading; --batch gets to start on the next file
+    yield
+
+    msgs = []
+    info("converting")
+    conv_t0 = time.time()
+    with span("measure", msgs=len(jd)):
+        for n_msg, o in gen_msgs(
+            jd, vw, bw, ar, emote_shortcuts, filled_emotes, nick_dupes, ex
+        ):
+            if n_msg % 1000 == 0:
+                info(
+                    "  {} / {}   {}%   {}/s   {}\n   {}  \n".format(
+                        n_msg,
+                        len(jd),
+                        int((n_msg * 100) / len(jd)),
+                        int(n_msg / (time.time() - conv_t0)),
+                        o["ta"],
+                        o["plain"],
+                    )
+                )
+
+            msgs.append(o)
+
+            # if n_msg > 5000:  # opt
+            #    break
+
+    if emote_font:
+        # and now the real codepoints
+        with span("wait for emote font"):
+            shortcuts, _ = emote_font.result()
+
+        cps = {ord(v): shortcuts[k] for k, v in emote_shortcuts.items()}
+        cps = {k: v for k, v in cps.items() if chr(k) != v}
+        if cps:
+            for o in msgs:
+                txt = o["txt"]
+                if isinstance(txt, list):
+                    o["txt"] = [x.translate(cps) for x in txt]
+                else:
+                    o["txt"] = txt.translate(cps)
+
+    bg.shutdown()
+
+    mux = None
+    if ar.embed_pipe and media_fn:
+        # ffmpeg reads all of the ass before it muxes anything, so starting
+        # it earlier gains nothing; and only ass_out kills it on failure
+        mux = start_embed(media_fn, v_dur, embeds(ar, font_fn, cjk_fn))
+
+    if mux:
+        info(f"streaming the subtitles into {mux[1]}")
+    else:
+        info(f"creating {out_fn}" + (" in segments" if ar.segment else ""))
+
+    cmd = " ".join(map(shlex.quote, sys.argv[1:]))
+    hdr = ass_header(vw, vh, ar.sz, font_name, cmd)
+    with span("write"), ass_out(out_fn, hdr, ar.segment * 60, mux) as f:
+        if cjk_fn:
+            f.chars = set()
+
+        for t0, t1, ln in render(msgs, ar, vw, bh, bx, by, z.emote_vsz[1], ex):
+            f.write(t0, t1, ln)
+
+        if cjk_fn:
+            # before the .ass is closed, since --embed_pipe is about to mux it
+            cache_dir = os.path.join(emote_dir, "subsets")
+            with span("subset_font"):
+                subset_font(z.otf_mod, f.chars, cjk_fn, font_name, cache_dir)
+
+    if cdur_err:
+        warn(cdur_err)
+    else:
+        info(cdur_msg)
+
+    if ar.emote_font and ar.emote_install:
+        fontdir = None
+        if ar.emote_install_dir:
+            fontdir = ar.emote_install_dir
+        else:
+            if WINDOWS:
+                mpv_dir = os.path.expandvars(r"%appdata%/mpv")
+            else:
+                mpv_dir = os.path.expanduser(r"~/.config/mpv")
+
+            if not os.path.exists(mpv_dir):
+                warn(f"to enable emote font installation, create directory {mpv_dir}/")
+            else:
+                fontdir = os.path.join(mpv_dir, "fonts")
+
+        if fontdir:
+            if os.path.exists(fontdir) and not os.path.isdir(fontdir):
+                error(f"Requested font installation, but {fontdir} is not a directory")
+                fontdir = None
+            elif not os.path.exists(fontdir):
+                os.mkdir(fontdir)
+
+        if fontdir:
+            shutil.copy2(font_fn, fontdir)
+            info(f"emote font installed to {fontdir}")
+            if ar.cleanup and not ar.embed_files:
+                os.remove(font_fn)
+
+    if ar.embed_files and not media_fn:
+        error("you requested --embed_files but the media file could not be located")
+    elif ar.embed_files:
+        if not mux:
+            mux = start_embed(media_fn, v_dur, embeds(ar, font_fn, cjk_fn), out_fn)
+
+        with span("embed"):
+            finish_embed(mux, ar.cleanup and not ar.embed_pipe and out_fn)
+        if ar.cleanup:
+            for fn in embeds(ar, font_fn, cjk_fn):
+                os.remove(fn)
+
+    # pprint(msgs[-5:])
+    t1_main = time.time()
+    info(f"finished in {t1_main-t0_main:.2f} sec")
+
+
+def merge_chats(chats, ar, emotes, deleted_messages, deleted_authors):
+    """
+    the normalized messages of each list of chat items in chats (the VOD
+    first), minus the ones which are in more than one of them
+    """
+    jd = []
+    seen = set()
+    for items in chats:
+        for m in items or []:
+            m = norm_msg(m, ar, emotes, deleted_messages, deleted_authors)
+            if not m:
+                continue
+
+            # Must use a composite ID here so that legacy json can be used with new json
+            key = f"{m['timestamp']}\n{m['author']['id']}"
+            if key not in seen:
+                seen.add(key)
+                jd.append(m)
+
+    return jd
+
+
+def fix_times(jd, ar, deleted_messages, deleted_authors):
+    """
+    works out the video time of each message, sorts by it, and drops
+    the deleted ones and any dupes within --dupe_thr
+    """
     # jd.sort(key=operator.attrgetter("timestamp"))
     jd.sort(key=lambda x: x["timestamp"])
     unix_ofs = None
@@ -668,6 +1221,8 @@ def main():
                     warn(m)
                 else:
                     warn(m + ", probably fine")
+                import pprint
+
                 pprint.pprint({"prev": prev_msg, "this": x})
 
             unix_ofs = new_ofs
@@ -710,6 +1265,8 @@ def main():
             mtxt = m.get("message", "--") or "--"
             key = f"{m['author']['id']}\n{mtxt}"
         except:
+            import pprint
+
             raise Exception(pprint.pformat(m))
 
         try:
@@ -732,58 +1289,11 @@ def main():
         info(f"Dropping {len(droplist)} duplicate chat entries within threshold")
     jd = [m for m in jd if m["message_id"] not in droplist]
 
-    cdur_msg = None
-    cdur_err = "could not verify chat duration"
-    v_dur = None
-    v_res = None
-    if not media_fn:
-        cdur_err += ": could not find media file"
-    else:
-        info("calculating media duration")
-        try:
-            ofs = 0
-            while True:
-                ofs -= 1
-                chat_dur = jd[ofs]["time_in_seconds"]
-                if chat_dur < 4096 * 4096:
-                    break
+    return jd
 
-            v_dur, v_res = get_ff_info(media_fn)
-            delta = abs(chat_dur - v_dur)
-            perc = delta * 100.0 / max(v_dur, chat_dur)
-            if delta > 60:
-                cdur_err = f"media duration ({v_dur:.0f}sec) and chat duration ({chat_dur:.0f}sec) differ by {delta:.0f}sec ({perc:.2f}%)"
-            else:
-                cdur_err = None
-                cdur_msg = f"chat duration appears correct; {v_dur:.0f}sec - {chat_dur:.0f}sec = {delta:.0f}sec ({perc:.2f}%)"
-        except Exception as ex:
-            media_fn = None
-            cdur_err += ": " + repr(ex)
-
-
-    media_res = ar.r
-    if media_res is None:
-        if v_res is not None:
-            vid_w, vid_h = v_res
-            if vid_w >= vid_h:
-                media_res = "1280x720"
-            else:
-                media_res = "720x1280"
-                info(f"Detected vertical video, using resolution {media_res}")
-        else:
-            media_res = "1280x720"
-
-    vw, vh = [int(x) for x in media_res.split("x")]
-
-    bw, bh, bx, by = [
-        int(x) for x in re.split(r"[x,+]+", ar.b if ar.b else media_res + "+0+0")
-    ]
-
-    if cdur_err:
-        warn(cdur_err)
-    else:
-        info(cdur_msg)
 
+def find_nick_dupes(jd):
+    """nicknames which are used by more than one author"""
     info(f"deduping nicknames in {len(jd)} chat entries")
     pair_seen = set()
     nick_dupes = set()
@@ -818,535 +1328,427 @@ def main():
     for k, v in sorted(nick_list.items(), key=lambda x: [-len(x[1]), x[0]])[:20]:
         info(f"  {len(v)}x {k}")
 
-    msgs = []
-    info("converting")
-    conv_t0 = time.time()
-    for n_msg, msg, vtxt, vsz, t_fsec, t_hms, msg_emotes in gen_msgs(
-        jd, vw, bw, ar, emote_shortcuts, have_fugashi
-    ):
-        sx, sy = vsz
-        sy = int(sy - 10)
-
-        if n_msg % 1000 == 0:
-            info(
-                "  {} / {}   {}%   {}/s   {}   {}\n   {}  \n".format(
-                    n_msg,
-                    len(jd),
-                    int((n_msg * 100) / len(jd)),
-                    int(n_msg / (time.time() - conv_t0)),
-                    t_hms,
-                    [sx, sy],
-                    "\n   ".join(vtxt),
-                )
-            )
-
-        nick = msg["author"]["name"]
-        if nick in nick_dupes:
-            nick += f"  ({msg['author']['id']})"
-
-        o = {
-            "nick": nick,
-            "uid": msg["author"]["id"],
-            "t0": t_fsec,
-            "sx": sx,
-            "sy": sy,
-            "txt": vtxt,
-            "msg_emotes": msg_emotes,
-        }
-
-        if "amount" in msg or "money" in msg:
-            o["shrimp"] = msg["money"]["text"] if "money" in msg else msg["amount"]
-            color = None
-            for k in [
-                "body_background_colour",
-                "background_colour",
-                "money_chip_background_colour",
-            ]:
-                if k in msg:
-                    color = msg[k]
-                    break
-            o["color"] = color[1:][:-2] or "444444"  # "#1de9b6ff"
+    return nick_dupes
 
-        if "badges" in msg["author"]:
-            o["badges"] = [b["title"] for b in msg["author"]["badges"]]
 
-        msgs.append(o)
+def render(msgs, ar, vw, bh, bx, by, lineh, ex):
+    """
+    lays out the formatted messages (from gen_msgs) as a sidebar or
+    danmaku, yielding [t0, t1, dialogue] for each event
+    """
+    nickh = lineh * 0.7
+    sb = Sidebar(bx, by, bh, nickh)
 
-        # if n_msg > 5000:  # opt
-        #    break
+    # events which are over before --from are just warmup
+    t_from = ar.t_from or 0
+
+    n_msg = 0
+    msg = None
+    supers = []
+    dq = []  # danmaku to lay out
+    for next_msg in msgs + [None]:
+        if not msg or (next_msg and next_msg["t0"] <= 0):
+            msg = next_msg
+            continue
 
-    vis = []
+        n_msg += 1
+        if n_msg % 1000 == 1:
+            info(f"writing {msg['ta']}, #{n_msg} / {len(msgs)}")
+
+        if ar.m == 1:
+            ta = msg["ta"]
+            tb = next_msg["t0"] if next_msg else msg["t0"] + 10
+
+            sb.add(msg)
+            t0 = msg["t0"]
+            if tb <= t_from:
+                pass
+            elif t0 < t_from:
+                yield t_from, tb, dialogue(hms(t_from), hms(tb), sb.txt())
+            elif True:
+                yield t0, tb, dialogue(ta, hms(tb), sb.txt())
+            else:
+                for txt in sb.debug_txts():
+                    yield t0, tb, dialogue(ta, hms(tb), txt)
 
-    info(f"creating {out_fn}")
-    with open(out_fn, "wb") as f:
-        f.write(
-            """\
-[Script Info]
-Title: https://github.com/9001/softchat
-; {cmd}
-ScriptType: v4.00+
-WrapStyle: 0
-ScaledBorderAndShadow: yes
-YCbCr Matrix: None
-PlayResX: {vw}
-PlayResY: {vh}
-
-[Aegisub Project Garbage]
-Last Style Storage: Default
-Video File: ?dummy:30.000000:40000:{vw}:{vh}:47:163:254:
-Video AR Value: 1.777778
-Video Zoom Percent: 1.000000
-
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: a,{font},{sz},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,2,1,1,0,0,0,1
-
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-""".format(
-                vw=vw,
-                vh=vh,
-                sz=ar.sz,
-                font=font_name,
-                cmd=" ".join(map(shlex.quote, sys.argv[1:])),
-            ).encode(
-                "utf-8"
-            )
-        )
+        else:
+            dq.append(msg)
 
-        # Dialogue: 0,0:00:00.00,0:00:05.00,a,,0,0,0,,hello world
+        msg = next_msg
 
-        n_msg = 0
-        msg = None
-        supers = []
-        colormap = {}
-        for next_msg in msgs + [None]:
-            if not msg or (next_msg and next_msg["t0"] <= 0):
-                msg = next_msg
-                continue
+    if dq and (ar.dm_max or ar.dm_cover):
+        adm = Admission(vw, bh, ar.dm_max, ar.dm_cover)
+        with span("admission"):
+            dq = [m for m in dq if admit(adm, m)]
 
-            n_msg += 1
-            if n_msg % 1000 == 1:
-                info(f"writing {hms(msg['t0'])}, #{n_msg} / {len(msgs)}")
+        info(adm.summary())
 
-            nick = msg["nick"]
-            bgr_nick = colormap.get(nick, None)
-            if not bgr_nick:
-                if ar.m == 1:
-                    bri = 0.5
-                    sat = 1
-                else:
-                    bri = 0.4
-                    sat = 0.8
-
-                bgr_nick = zlib.crc32(nick.encode("utf-8")) & 0xFFFFFFFF
-                r, g, b = [
-                    int(x * 255)
-                    for x in colorsys.hsv_to_rgb((bgr_nick % 256) / 256.0, sat, bri)
-                ]
-                bgr_nick = f"{r:02x}{g:02x}{b:02x}"  # and its gonna stay that way
-                colormap[nick] = bgr_nick
-
-            # defaults from ass header
-            bord = 2
-            shad = 1
-
-            shrimp = None
-            bgr_msg = bgr_nick
-            bgr_fg = "ffffff"
-            if "shrimp" in msg:
-                bord = shad = 4
-                bgr_fg = "000000"
-                bgr_msg = msg["color"]
-                bgr_msg = f"{bgr_msg[4:6]}{bgr_msg[2:4]}{bgr_msg[0:2]}"  # thx ass
-                shrimp = rf"{{\bord{bord}\shad{shad}\3c&H{bgr_msg}&\c&H{bgr_fg}&}}{msg['shrimp']}"
-
-            nick = assan(nick)
-            msg["txt"] = [assan(x) for x in msg["txt"]]
-
-            if ar.m == 1:
-                # text = colored nick followed by the actual lines, ass-escaped
-                txt = [rf"{{\3c&H{bgr_nick}&\fs{ar.sz*0.67:.1f}}}{nick}"]
-                lineh = z.emote_vsz[1]
-                nickh = lineh * 0.7
-
-                badges = msg.get("badges", [])
-                if not set(badges).isdisjoint(["Moderator", "Owner", "Verified"]):
-                    txt[0] += r" {\bord16\shad6}*"
-                elif msg["uid"] in vips:
-                    txt[0] += r" {\bord16\shad4}----"
-
-                if shrimp:
-                    txt.append(rf"{{\fscx90\fscy90}}{shrimp}{{\fscx100\fscy100}}")
-                    msg["sy"] += lineh
-
-                txt.extend(msg["txt"])
-                txt[1] = rf"{{\fs{ar.sz}}}{txt[1]}"
-
-                if msg["msg_emotes"] and (
-                    ar.emote_fill or filled_emotes or ar.emote_sz > 1.01
-                ):
-                    txt = "\n".join(txt)
-                    msegs = segment_msg(txt, ar.emote_fill, filled_emotes)
-                    txt = render_msegs(
-                        msegs, ar.sz, ar.sz * ar.emote_sz, bgr_msg, bgr_fg, bord, shad
-                    )
-                    txt = txt.split("\n")
-
-                # show new messages bottom-left (heh)
-                msg["txt"] = txt
-                msg["px"] = bx
-                msg["py"] = by + bh - msg["sy"] - nickh
-
-                ta = hms(msg["t0"])
-                tb = hms(next_msg["t0"] if next_msg else msg["t0"] + 10)
-
-                rm = 0
-                for m in vis:
-                    m["py"] -= msg["sy"] + nickh
-                    if m["py"] < by:
-                        # debug('drop {} at {}'.format(hms(m["t0"]), ta))
-                        rm += 1
-
-                vis = vis[rm:] + [msg]
-
-                if True:
-                    # rely on squished font for linespacing reduction
-                    txt = r"{{\pos({:.1f},{:.1f})}}".format(bx, by + bh)
-                    for m in vis:
-                        pad = ""
-                        for ln in m["txt"]:
-                            txt += pad + ln + r"\N{\r}"
-                            pad = r"\h\h"
-
-                    f.write(f"Dialogue: 0,{ta},{tb},a,,0,0,0,,{txt}\n".encode("utf-8"))
-                else:
-                    # verification, one ass entry for each line
-                    for m in vis:
-                        step = nickh
-                        x = m["px"]
-                        y = m["py"]
-                        for ln in m["txt"]:
-                            txt = r"{{\pos({:.1f},{:.1f})}}{}".format(x, y, ln)
-                            x = m["px"] + 8
-                            y += step
-                            step = m["sy"] / (len(m["txt"]) - 1)
-                            txt = f"Dialogue: 0,{ta},{tb},a,,0,0,0,,{txt}\n"
-                            f.write(txt.encode("utf-8"))
+    if dq:
+        info(f"laying out {len(dq)} danmaku")
+        lq = [[m["t0"], m["w"], m["h"], m["td"]] for m in dq]
+        with span("layout", msgs=len(lq)):
+            ys = layout(lq, vw, bh, ar.spread, ex.j, ex)
+
+        for m, y in zip(dq, ys):
+            t0 = m["t0"]
+            t1 = t0 + m["td"]
+            if t1 <= t_from:
+                continue
 
+            ln = dialogue(m["ta"], m["tb"], move_txt(m, y, vw, by))
+            if m["super"]:
+                supers.append([t0, t1, ln])
             else:
-                txts, t0, w, h, msg_emotes = [
-                    msg[x] for x in ["txt", "t0", "sx", "sy", "msg_emotes"]
-                ]
-                txt = "\\N".join(txts)
-
-                lineh = z.emote_vsz[1]
-                nickh = lineh * 0.6
-
-                # ass linespacing is huge, compensate (wild guess btw)
-                h += int(ar.sz * 0.25 * (len(txts) - 1) + 0.99 + nickh)
-
-                # plus some horizontal margin between the messages
-                w += 8
-
-                shrimp_mul = 1
-                if shrimp:
-                    txt = f"{shrimp} {txt}"
-                    shrimp_mul = 2
-                    w += h * 4  # donation is not included, TODO maybe
-
-                vip = False
-                badges = msg.get("badges", [])
-                if not set(badges).isdisjoint(["Moderator", "Owner", "Verified"]):
-                    bord = shad = 6
-                    badge_sz = int(12 * ar.badge_sz)
-                    txt = rf"{{\bord{badge_sz}\shad{shad}}}*{{\bord{bord}}}{txt}"
-                    vip = True
-                elif msg["uid"] in vips:
-                    bord = shad = 4
-                    badge_sz = int(8 * ar.badge_sz)
-                    txt = rf"{{\bord{badge_sz}\shad{shad}}}_{{\bord{bord}}}{txt}"
-                    vip = True
-
-                len_boost = 0.7
-                td = (vw + w - w * len_boost) * shrimp_mul / ar.spd
-                t1 = t0 + td
-
-                # collision detection polls at certain points from the left,
-                # so figure out timestamps when the right-side hits those
-                abs_spd = (vw + w * 1.0) / td
-                p9 = t0 + (w + vw * 0.1) / abs_spd  # 10% right
-                p8 = t0 + (w + vw * 0.2) / abs_spd
-                p5 = t0 + (w + vw * 0.5) / abs_spd
-                p3 = t0 + (w + vw * 0.7) / abs_spd
-                p1 = t0 + (w + vw * 0.9) / abs_spd  # 10% left
-
-                # and when the left-side hits those,
-                # to compare against other pN's and find a free slot
-                a9 = t0 + (vw * 0.1) / abs_spd
-                a8 = t0 + (vw * 0.2) / abs_spd
-                a5 = t0 + (vw * 0.5) / abs_spd
-                a3 = t0 + (vw * 0.7) / abs_spd
-                a1 = t0 + (vw * 0.9) / abs_spd
-
-                rm = []
-                taken_best = []  # 10..90%
-                taken_good = []  # 30..90%
-                taken_okay = []  # 60..80%
-                for m in vis:
-                    m_py, m_sy, m_p9, m_p8, m_p5, m_p3, m_p1, m_txt = [
-                        m[x] for x in ["py", "sy", "p9", "p8", "p5", "p3", "p1", "txt"]
-                    ]
-
-                    if t0 > m_p5:
-                        rm.append(m)
-                        continue
+                yield t0, t1, ln
 
-                    entry = [m_py, m_py + m_sy, id(m)]
-
-                    if a8 < m_p8 or a5 < m_p5:
-                        # add txt to avoid sorted() trying to compare m's
-                        taken_okay.append(entry)
-
-                    if a9 < m_p9 or a3 < m_p3:
-                        taken_good.append(entry)
-
-                    if a9 < m_p9 or a1 < m_p1:
-                        taken_best.append(entry)
-
-                for m in rm:
-                    vis.remove(m)
-
-                ymax = bh - h
-                if ymax < 1:
-                    ymax = 1  # thx emotes
-
-                overlap_mul = 0.9
-                frees_merged = []  # crit + prefer
-                for lst in [taken_best, taken_good, taken_okay]:
-                    frees = [[ymax, 0, ymax]]  # size, y0, y1
-                    for y1, y2, _ in sorted(lst):
-                        rm = []
-                        add = []
-                        for free in frees:
-                            _, fy1, fy2 = free
-
-                            if fy1 >= y2 or y1 >= fy2:
-                                # does not intersect
-                                continue
-
-                            elif fy1 <= y1 and fy2 >= y2:
-                                # sub slices range in half, split it
-                                rm.append(free)
-
-                                nfsz = y1 - fy1
-                                if nfsz > h * overlap_mul:
-                                    # h/3 to ensure less than 10% overlap
-                                    add.append([nfsz, fy1, y1])
-
-                                nfsz = fy2 - y2
-                                if nfsz > h * overlap_mul:
-                                    add.append([nfsz, y2, fy2])
-
-                            elif y2 >= fy1:
-                                # sub slices top of free
-                                rm.append(free)
-
-                                nfsz = fy2 - y2
-                                if nfsz > h * overlap_mul:
-                                    add.append([nfsz, y2, fy2])
-
-                            elif y1 <= fy2:
-                                # slices bottom
-                                rm.append(free)
-
-                                nfsz = y1 - fy1
-                                if nfsz > h * overlap_mul:
-                                    add.append([nfsz, fy1, y1])
-
-                            else:
-                                raise Exception("fug")
-
-                        for x in rm:
-                            frees.remove(x)
-
-                        frees.extend(add)
-
-                    frees_merged.append(frees)
-                    overlap_mul = 0.8  # allow 20% overlap in critical
-
-                # use the first non-zero list of free slots
-                # (ordered by least amount of horizontal collision)
-                frees = next((x for x in frees_merged if x), None)
-
-                if not frees:
-                    # can't be helped, pick a random y to collide in
-                    y = int(random.randrange(ymax))
-                elif ar.spread:
-                    avail, y0, y1 = sorted(frees)[-1]
-                    if avail <= h:
-                        y = int(y0 + avail / 2)
-                    else:
-                        # just centering looks boring, let's rand
-                        y = y0 + random.randrange(avail - h)
-                else:
-                    y = None
-                    best = 5318008
-                    target = bh / 2
-                    # print(json.dumps([target, frees], indent=4, sort_keys=True))
-                    for avail, y0, y1 in frees:
-                        if y0 <= target and y1 >= target + h:
-                            y = target
-                            break
-                        elif y0 >= target:
-                            this = y0 - target
-                            if best > this:
-                                best = this
-                                y = y0
-                        elif y1 <= target + h:
-                            this = target - (y1 - h)
-                            if best > this:
-                                best = this
-                                y = y1 - h
-
-                if msg_emotes and (
-                    ar.emote_fill or filled_emotes or ar.emote_sz > 1.01
-                ):
-                    msegs = segment_msg(txt, ar.emote_fill, filled_emotes)
-                    txt = render_msegs(
-                        msegs, ar.sz, ar.sz * ar.emote_sz, bgr_msg, bgr_fg, bord, shad
-                    )
+    for t0, t1, ln in supers:
+        yield t0, t1, ln
 
-                y = int(y)
-                txt = rf"{{\move({vw:.1f},{y+h+by:.1f},{-w:.1f},{y+h+by:.1f})\3c&H{bgr_nick}&}}{txt}{{\fscx40\fscy40\bord1}}\N{nick}"
-
-                msg["t1"] = t1
-                msg["p9"] = p9
-                msg["p8"] = p8
-                msg["p5"] = p5
-                msg["p3"] = p3
-                msg["p1"] = p1
-                msg["px"] = vw
-                msg["py"] = y
-                msg["sy"] = h
-                msg["txt"] = txt
-                vis.append(msg)
-
-                ln = "Dialogue: 0,{},{},a,,0,0,0,,{}\n".format(
-                    hms(t0), hms(msg["t1"]), msg["txt"]
-                ).encode("utf-8")
-
-                if shrimp or vip:
-                    supers.append(ln)
-                else:
-                    f.write(ln)
 
-            msg = next_msg
+def embeds(ar, font_fn, cjk_fn):
+    # the fonts to attach
+    ret = [font_fn] if ar.emote_font else []
+    return ret + [cjk_fn] if cjk_fn else ret
 
-        for ln in supers:
-            f.write(ln)
 
-    if cdur_err:
-        warn(cdur_err)
+def start_embed(media_fn, v_dur, fonts, sub_fn=None):
+    """
+    starts muxing media_fn, the subtitles (sub_fn, or written into
+    stdin if None) and the fonts into a new mkv;
+    returns [ffmpeg, merged_fn, stderr]
+    """
+    split = media_fn.rsplit(".", 1)
+    merged_fn = split[0] + ".softchat-merged.mkv"
+    info(f"Producing merged file {merged_fn}.")
+
+    # fmt: off
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-i", media_fn,
+    ]
+
+    if sub_fn:
+        cmd.extend(["-i", sub_fn])
     else:
-        info(cdur_msg)
+        cmd.extend(["-f", "ass", "-i", "pipe:0"])
+
+    cmd.extend([
+        "-map", "0:v",
+        "-map", "0:a",
+        "-map", "1",
+        # Subtitles will still run longer than the video due to in-progress
+        # animations past the end of the video, but only about 10 seconds
+        # unless there's a poorly timed superchat.
+        "-t", str(v_dur),
+        "-codec", "copy",
+        "-disposition:s:0", "default",
+    ])
+
+    for n, font_fn in enumerate(fonts):
+        mime = "vnd.ms-opentype" if font_fn.endswith(".otf") else "x-truetype-font"
+        cmd.extend([
+            "-attach", font_fn,
+            f"-metadata:s:t:{n}", "mimetype=application/" + mime,
+        ])
+    # fmt: on
 
-    if ar.emote_font and ar.emote_install:
-        fontdir = None
-        if ar.emote_install_dir:
-            fontdir = ar.emote_install_dir
+    cmd.extend([merged_fn, "-y"])
+
+    import subprocess as sp
+
+    # stderr into a file, since nobody reads it until ffmpeg is done
+    stderr = tempfile.TemporaryFile()
+    stdin = sp.DEVNULL if sub_fn else sp.PIPE
+    p = sp.Popen(cmd, stdin=stdin, stdout=sp.DEVNULL, stderr=stderr)
+    return [p, merged_fn, stderr]
+
+
+@contextmanager
+def ass_out(out_fn, hdr, seg_len, mux):
+    # AssWriter, but a failed conversion must not be muxed
+    with AssWriter(out_fn, hdr, seg_len, mux and mux[0].stdin) as f:
+        try:
+            yield f
+        except:
+            if mux:
+                mux[0].kill()
+            raise
+
+
+def finish_embed(mux, rm_fn):
+    p, merged_fn, stderr = mux
+    if p.wait() == 0:
+        info(
+            "Merged media file finished. "
+            "You should check the new file before removing the old file."
+        )
+        if rm_fn:
+            os.remove(rm_fn)
+    else:
+        error(f"Failed to embed files into {merged_fn}")
+        stderr.seek(0)
+        error(stderr.read().decode("utf-8", "replace"))
+        sys.exit(1)
+
+
+def clip_window(jd, ar, vw, bh, lineh):
+    """
+    drops the messages outside --from/--to, except for the ones
+    right before --from which are needed to warm up the layout
+    """
+    t_from = ar.t_from or 0
+    ts = [x["time_in_seconds"] for x in jd]
+    n0 = bisect_left(ts, t_from)
+    n1 = len(jd) if ar.t_to is None else bisect_left(ts, ar.t_to)
+
+    if ar.m == 1:
+        # enough to fill the sidebar with the smallest possible messages
+        n0 -= int(bh / max(lineh * 1.7 - 10, 1)) + 1
+    else:
+        # anything that could still be on screen; widest msg is vw/2
+        # plus superchat stuff, and superchats scroll at half speed
+        w = vw / 2 + 8 + bh * 4
+        td = (vw + w * 0.3) * 2 / ar.spd
+        while n0 > 0 and ts[n0 - 1] > t_from - td:
+            n0 -= 1
+
+    return jd[max(n0, 0) : n1]
+
+
+def follow(ar, out_fn, z, font_name, have_fugashi):
+    """
+    --follow; converts the chat as it arrives, appending each new
+    event to the .ass right away so it is never more than a poll behind
+    """
+    vw, vh = [int(x) for x in (ar.r or "1280x720").split("x")]
+    bw, bh, bx, by = [
+        int(x) for x in re.split(r"[x,+]+", ar.b if ar.b else f"{vw}x{vh}+0+0")
+    ]
+
+    unix_ofs = None
+    if ar.start_time is not None:
+        if ar.start_time.isnumeric():
+            unix_ofs = int(ar.start_time)
         else:
-            if WINDOWS:
-                mpv_dir = os.path.expandvars(r"%appdata%/mpv")
-            else:
-                mpv_dir = os.path.expanduser(r"~/.config/mpv")
+            unix_ofs = datetime.datetime.fromisoformat(ar.start_time).timestamp()
 
-            if not os.path.exists(mpv_dir):
-                warn(f"to enable emote font installation, create directory {mpv_dir}/")
-            else:
-                fontdir = os.path.join(mpv_dir, "fonts")
+    # no multiprocessing here; a handful of messages per poll
+    # is not worth the roundtrip, so measure in this process
+    nick_dupes = set()
+    ctx = Ctx(ar, have_fugashi)
+    ctx.args = [ar, vw, bw, {}, set(), nick_dupes]
 
-        if fontdir:
-            if os.path.exists(fontdir) and not os.path.isdir(fontdir):
-                error(f"Requested font installation, but {fontdir} is not a directory")
-                fontdir = None
-            elif not os.path.exists(fontdir):
-                os.mkdir(fontdir)
+    emotes = dict()
+    deleted_messages = set()
+    deleted_authors = set()
+    seen = set()
+    said = {}  # [author-id, message-text] to timestamp, for dupe_thr
+    nick_list = {}
 
-        if fontdir:
-            shutil.copy2(font_fn, fontdir)
-            info(f"emote font installed to {fontdir}")
-            if ar.cleanup and not ar.embed_files:
-                os.remove(font_fn)
+    sb = Sidebar(bx, by, bh, z.emote_vsz[1] * 0.7)
+    dm = Danmaku(vw, bh, ar.spread, random.Random(b"nope"))
+    adm = None
+    if ar.dm_max or ar.dm_cover:
+        adm = Admission(vw, bh, ar.dm_max, ar.dm_cover)
+
+    # mode 1: the sidebar has looked like this since sb_t0, and stays
+    # until the next msg, or until sb_t1 if that never shows up; while
+    # chat is quiet, its event (at sb_pos) is extended up to sb_end
+    # in place, rather than adding another one every second
+    sb_t0 = sb_t1 = sb_end = sb_pos = None
+
+    # the capture's idea of now; newest msg plus time since it arrived
+    t_last = w_last = None
+
+    def sb_write(t):
+        # (re)writes the current sidebar event, until t
+        nonlocal sb_end, sb_pos
+        if sb_pos is None:
+            sb_pos = f.tell()
+        else:
+            f.seek(sb_pos)
+            f.truncate()
+
+        if t > sb_t0:
+            f.write(dialogue(hms(sb_t0), hms(t), sb.txt()))
+
+        sb_end = t
+
+    def ingest(m):
+        nonlocal unix_ofs
+        m = upgrade_msg(m)
+        if not m:
+            return None
+
+        m = norm_msg(m, ar, emotes, deleted_messages, deleted_authors)
+        if not m:
+            return None
+
+        uid = m["author"]["id"]
+        key = f"{m['timestamp']}\n{uid}"
+        if key in seen:
+            return None
+
+        seen.add(key)
+        if not ar.no_del and (
+            m["message_id"] in deleted_messages or uid in deleted_authors
+        ):
+            return None
+
+        mtxt = m.get("message", "--") or "--"
+        key = f"{uid}\n{mtxt}"
+        ts = m["timestamp"]
+        if key in said and ts - said[key] < 1_000_000 * ar.dupe_thr:
+            return None
+
+        said[key] = ts
+
+        unix = ts / 1_000_000.0
+        t = m.get("time_in_seconds", None)
+        if "amount" in m or "money" in m:
+            t = None
 
-    if ar.embed_files and not media_fn:
-        error("you requested --embed_files but the media file could not be located")
-    elif ar.embed_files:
-        split = media_fn.rsplit(".", 1)
-        merged_fn = split[0] + ".softchat-merged.mkv"
-        info(f"Producing merged file {merged_fn}.")
-
-        # fmt: off
-        cmd = [
-            "ffmpeg",
-            "-hide_banner",
-            "-i", media_fn,
-            "-i", out_fn,
-            "-map", "0:v",
-            "-map", "0:a",
-            "-map", "1",
-            # Subtitles will still run longer than the video due to in-progress
-            # animations past the end of the video, but only about 10 seconds
-            # unless there's a poorly timed superchat.
-            "-t", str(v_dur),
-            "-codec", "copy",
-            "-disposition:s:0", "default",
-        ]
-
-        if ar.emote_font:
-            cmd.extend([
-                "-attach", font_fn,
-                "-metadata:s:t", "mimetype=application/x-truetype-font",
-            ])
-        # fmt: on
-
-        cmd.extend([merged_fn, "-y"])
-
-        completed = sp.run(cmd, capture_output=True)
-        if completed.returncode == 0:
-            info(
-                "Merged media file finished. "
-                "You should check the new file before removing the old file."
-            )
-            if ar.cleanup:
-                os.remove(out_fn)
-                if ar.emote_font:
-                    os.remove(font_fn)
-        if completed.returncode != 0:
-            error(f"Failed to embed files into {merged_fn}")
-            error(completed.stderr.decode("utf-8"))
-            sys.exit(1)
+        if t is not None and t >= 10:
+            unix_ofs = unix - t
+        elif unix_ofs is None:
+            warn("no time_in_seconds and no --start_time; first message is 0:00")
+            unix_ofs = unix
 
-    # pprint(msgs[-5:])
-    t1_main = time.time()
-    info(f"finished in {t1_main-t0_main:.2f} sec")
+        if t is None or t < 10:
+            t = unix - unix_ofs
+
+        if ar.offset is not None:
+            t += ar.offset
+
+        m["time_in_seconds"] = t
+        m["time_text"] = tt(t)
+
+        nick = m["author"].get("name", None) or uid
+        m["author"]["name"] = nick
+        uids = nick_list.setdefault(nick, [])
+        if uid not in uids:
+            uids.append(uid)
+            if len(uids) > 1:
+                nick_dupes.add(nick)
 
+        return gen_msg_thr(ctx, [[0, m]])[0][1]
 
-def gen_msgs(jd, vw, bw, ar, emote_shortcuts, have_fugashi):
-    j = ar.j
-    if j == 0:
-        j = os.cpu_count()
+    n_msg = 0
+    info(f"following {ar.fn[0]} into {out_fn}")
+    with open(out_fn, "wb") as f:
+        cmd = " ".join(map(shlex.quote, sys.argv[1:]))
+        f.write(ass_header(vw, vh, ar.sz, font_name, cmd))
+        f.flush()
+        try:
+            for jd in tail_json(ar.fn[0], ar.follow_timeout):
+                for m in jd:
+                    o = ingest(m)
+                    if not o or o["t0"] <= 0:
+                        continue
+
+                    n_msg += 1
+                    if t_last is None or t_last < o["t0"]:
+                        t_last = o["t0"]
+                        w_last = time.time()
+
+                    if n_msg % 1000 == 1:
+                        info(f"writing {o['ta']}, #{n_msg}")
+
+                    if ar.m == 1:
+                        t0 = o["t0"]
+                        if sb_t0 is not None:
+                            t0 = max(t0, sb_t0)
+                            sb_write(t0)
+                            sb_pos = None  # done with that one
+
+                        sb.add(o)
+                        sb_t0 = sb_end = t0
+                        sb_t1 = t0 + 10
+                    elif not adm or admit(adm, o):
+                        y = dm.place(o["t0"], o["w"], o["h"], o["td"])
+                        f.write(dialogue(o["ta"], o["tb"], move_txt(o, y, vw, by)))
+
+                if sb_t0 is not None:
+                    # keep the sidebar up until now, in whole seconds
+                    now = t_last + time.time() - w_last
+                    if now >= sb_end + 1:
+                        sb_write(now)
+
+                f.flush()
+
+        except KeyboardInterrupt:
+            info("stopping")
+
+        if sb_t0 is not None:
+            sb_write(max(sb_t1, sb_end))
+
+    info(f"wrote {n_msg} messages")
+    if adm:
+        info(adm.summary())
+
+
+def admit(adm, m):
+    return adm.admit(m["t0"], m["td"], m["w"], m["h"], m["plain"], m["super"])
+
+
+def num_cores(ar, have_fugashi=False):
+    """-j, or whatever the affinity/cgroup quota and free memory allow"""
+    if ar.j:
+        return ar.j
 
-    initargs = [gen_msg_thr, ar, vw, bw, emote_shortcuts, have_fugashi]
+    j = cpu_limit()
+    mem = mem_avail()
+    if mem is not None:
+        each = WORKER_MEM + (FUGASHI_MEM if have_fugashi else 0)
+        j = max(1, min(j, mem // each))
 
-    with multiprocessing.Pool(
-        j, initializer=gen_msg_initializer, initargs=initargs
-    ) as pool:
-        # Cannot return the generator directly, since the context manager will close the pool
-        # 100 was picked experimentally and seems to perform well for both 4c8t and 16c/32t.
-        for x in pool.imap(gen_msg_thr, enumerate(jd), 100):
+    return j
+
+
+def text_stuff(ar):
+    # one for all the files in a --batch
+    k = (ar.sz, ar.fontdir, ar.emote_sz)
+    if k not in TEXT_STUFF:
+        TEXT_STUFF[k] = TextStuff(*k)
+
+    return TEXT_STUFF[k]
+
+
+TEXT_STUFF = {}
+
+
+def gen_msgs(jd, vw, bw, ar, emote_shortcuts, filled_emotes, nick_dupes, ex):
+    args = [ar, vw, bw, emote_shortcuts, filled_emotes, nick_dupes]
+
+    # chat repeats itself a lot, so measure each distinct text once
+    tasks = {}
+    for n_msg, msg in enumerate(jd):
+        k = memo_key(msg, ar, vw, bw)
+        try:
+            tasks[k].append([n_msg, msg])
+        except:
+            tasks[k] = [[n_msg, msg]]
+
+    tasks = list(tasks.values())
+    info(f"{len(tasks)} distinct messages")
+    yield from in_order(ex.measure(args, tasks))
+
+
+def in_order(rets):
+    # Results come back grouped by text; put them back in chat order
+    done = {}
+    n_next = 0
+    for group in rets:
+        for n_msg, x in group:
+            done[n_msg] = x
+
+        while n_next in done:
+            x = done.pop(n_next)
             if x:
-                yield x
+                yield n_next, x
+
+            n_next += 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+# softchat as a library; chat items in, ass lines out, with the
+# fonts and workers kept warm between conversions:
+#
+#   from softchat.api import Converter, options
+#   with Converter(options(m=2, sz=26)) as conv:
+#       for fn in fns:
+#           with open(fn + ".ass", "w", encoding="utf-8") as f:
+#               f.writelines(conv.convert(load_the_chat(fn)))
+
+import re
+from .__main__ import mk_argparser, num_cores, text_stuff
+from .__main__ import upgrade_msg, merge_chats, fix_times, find_nick_dupes
+from .__main__ import clip_window, gen_msgs, render, FONT_NAME
+from .executor import get_executor
+from .ass import ass_header
+from .util import load_fugashi
+
+
+# these need files next to the chat, so they're for the cli only
+CLI_ONLY = [
+    "emote_font",
+    "embed_files",
+    "embed_pipe",
+    "subset_font",
+    "segment",
+    "follow",
+    "batch",
+    "batch_list",
+    "media",
+    "emote_chat_file",
+    "trace",
+]
+
+
+def options(**kw):
+    """
+    the command-line defaults with kw on top; same names as the
+    arguments (t_from/t_to for --from/--to, in seconds)
+    """
+    ar = mk_argparser().parse_args([])
+    for k, v in kw.items():
+        if not hasattr(ar, k) or k == "fn":
+            raise TypeError(f"unknown option {k!r}")
+
+        setattr(ar, k, v)
+
+    if not ar.sz:
+        ar.sz = 18 if ar.m == 1 else 24
+
+    return ar
+
+
+class Converter(object):
+    """
+    turns chats into ass; holds the squished font, the measuring
+    workers (started on first use, see executor.py) and mecab,
+    so a long-running service only pays for them once
+    """
+
+    def __init__(self, opts=None):
+        ar = opts or options()
+        bad = [x for x in CLI_ONLY if getattr(ar, x, None)]
+        if bad:
+            raise ValueError(f"not supported in the api: {', '.join(bad)}")
+
+        self.ar = ar
+        self.have_fugashi = bool(load_fugashi(write_cfg=True))
+        if ar.kana and not self.have_fugashi:
+            raise Exception("kana was requested but mecab failed to load")
+
+        self.z = text_stuff(ar)
+        j = num_cores(ar, self.have_fugashi)
+        self.ex = get_executor(ar.executor, ar, self.have_fugashi, j)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def close(self):
+        self.ex.close()
+
+    def convert(self, chat, cmd="softchat.api"):
+        """
+        yields the lines of the ass (as str, each ending with a newline)
+        for chat, an iterable of chat_downloader (or yt-dlp) items;
+        cmd goes into a comment in the header
+        """
+        ar = self.ar
+        deleted_messages = set()
+        deleted_authors = set()
+        items = [x for x in map(upgrade_msg, chat) if x]
+        jd = merge_chats([items], ar, {}, deleted_messages, deleted_authors)
+        if not jd:
+            raise Exception("no messages in the chat")
+
+        jd = fix_times(jd, ar, deleted_messages, deleted_authors)
+
+        vw, vh = [int(x) for x in (ar.r or "1280x720").split("x")]
+        bw, bh, bx, by = [
+            int(x) for x in re.split(r"[x,+]+", ar.b if ar.b else f"{vw}x{vh}+0+0")
+        ]
+
+        nick_dupes = find_nick_dupes(jd)
+        lineh = self.z.emote_vsz[1]
+        if ar.t_from is not None or ar.t_to is not None:
+            jd = clip_window(jd, ar, vw, bh, lineh)
+
+        hdr = ass_header(vw, vh, ar.sz, FONT_NAME, cmd).decode("utf-8")
+        yield from hdr.splitlines(True)
+
+        msgs = gen_msgs(jd, vw, bw, ar, {}, [], nick_dupes, self.ex)
+        msgs = [o for _, o in msgs]
+        for _, _, ln in render(msgs, ar, vw, bh, bx, by, lineh, self.ex):
+            yield ln.decode("utf-8")
+
+
+def convert(chat, opts=None):
+    """one-off Converter(opts).convert(chat)"""
+    with Converter(opts) as conv:
+        yield from conv.convert(chat)
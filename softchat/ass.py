@@ -1,5 +1,14 @@
+import os
+import re
+import json
+import math
+from itertools import groupby
+
 ZEROWIDTH_SPACE = "\u200b"
 
+# the private use area which fff puts the emotes in
+ptn_emotes = re.compile("[\ue000-\uf8ff]+|[^\ue000-\uf8ff]+")
+
 
 def assan(x):
     # there is no standardization on escaping ["{", "}", "\\"]:
@@ -10,81 +19,223 @@ def assan(x):
     # return x.replace("{", "<").replace("}", ">").replace('\\', '\\{}')
 
     # mpv:
-    ret = ""
-    for c, nc in zip(x, x[1:] + "\n"):
-        if c == "{":
-            ret += "\\{"
-        elif c == "}":
-            ret += "\\}"
-        elif c == "\\" and nc in ["N", "n", "h"]:
-            ret += "\\\\"
-        else:
-            ret += c
+    #   (str.replace beats both translate and re.sub for this)
+    if "{" in x or "}" in x:
+        x = x.replace("{", "\\{").replace("}", "\\}")
+
+    if "\\" not in x:
+        return x
+
+    x = x.replace("\\N", "\\\\N").replace("\\n", "\\\\n").replace("\\h", "\\\\h")
 
     # mpv:
     #   there is no way to encode a literal \ before a markup {
-    if ret.endswith("\\"):
-        ret += ZEROWIDTH_SPACE
+    if x.endswith("\\"):
+        x += ZEROWIDTH_SPACE
 
-    return ret
+    return x
 
 
 def segment_msg(txt, fill_all, fill_list):
     ret = []
-    plv = 0
-    buf = ""
-    for c, u in list(zip(txt, [ord(x) for x in txt])) + [[None, 0]]:
-        if u >= 0xE000 and u <= 0xF8FF:
-            if fill_all or c in fill_list:
-                nlv = 2
-            else:
-                nlv = 1
-        else:
-            nlv = 0
-
-        if plv == nlv and c:
-            buf += c
+    for m in ptn_emotes.finditer(txt):
+        seg = m.group()
+        if seg[0] < "\ue000" or seg[0] > "\uf8ff":
+            ret.append([0, seg])
+        elif fill_all:
+            ret.append([2, seg])
+        elif not fill_list:
+            ret.append([1, seg])
         else:
-            if buf:
-                ret.append([plv, buf])
-            buf = c
-
-        plv = nlv
+            for filled, grp in groupby(seg, fill_list.__contains__):
+                ret.append([2 if filled else 1, "".join(grp)])
 
     return ret
 
 
 def render_msegs(msegs, tsz, esz, bg, fg, bord, shad):
-    ret = ""
-    plv = 0
-    for lv, txt in msegs + [[0, ""]]:
-        cmd = ""
+    fs_emote = f"\\fs{esz:.1f}"
+    fs_text = f"\\fs{tsz:.1f}"
 
+    ret = []
+    plv = 0
+    for lv, txt in msegs:
         if not lv and txt.endswith("\\"):
             txt += ZEROWIDTH_SPACE
 
-        if plv < 1 and lv > 0:
-            cmd += f"\\fs{esz:.1f}"
+        if lv == plv:
+            ret.append(txt)
+            continue
+
+        ret.append("{")
+        if plv < 1:
+            ret.append(fs_emote)
 
-        if plv < 2 and lv > 1:
+        if lv > 1:
             # compensate the 1100 padding in fff by subtracting a constant,
             scx = int(len(txt) * 110) - 10  # ~109 otherwise
 
             # and bump this a bit to shift some of the padding to the left
             fsp = esz / 0.9111  # 0.9091
 
-            cmd += f"\\c&H{bg}\\fscx{scx:.2f}\\fsp-{fsp:.2f}}}\ue000{{\\fscx100\\fsp0\\c&H{fg}\\1a&H00&\\bord1\\shad0"
+            ret.append(
+                f"\\c&H{bg}\\fscx{scx:.2f}\\fsp-{fsp:.2f}}}\ue000{{\\fscx100\\fsp0\\c&H{fg}\\1a&H00&\\bord1\\shad0"
+            )
 
-        if plv > 1 and lv < 2:
-            cmd += f"\\bord{bord}\\shad{shad}"
+        if plv > 1:
+            ret.append(f"\\bord{bord}\\shad{shad}")
 
-        if plv > 0 and lv < 1:
-            cmd += f"\\fs{tsz:.1f}"
+        if lv < 1:
+            ret.append(fs_text)
 
+        ret.append("}")
+        ret.append(txt)
         plv = lv
-        if cmd:
-            ret += f"{{{cmd}}}{txt}"
-        else:
-            ret += txt
 
-    return ret
+    if plv > 1:
+        ret.append(f"{{\\bord{bord}\\shad{shad}{fs_text}}}")
+    elif plv:
+        ret.append("{" + fs_text + "}")
+
+    return "".join(ret)
+
+
+def ass_header(vw, vh, sz, font_name, cmd):
+    return """\
+[Script Info]
+Title: https://github.com/9001/softchat
+; {cmd}
+ScriptType: v4.00+
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+YCbCr Matrix: None
+PlayResX: {vw}
+PlayResY: {vh}
+
+[Aegisub Project Garbage]
+Last Style Storage: Default
+Video File: ?dummy:30.000000:40000:{vw}:{vh}:47:163:254:
+Video AR Value: 1.777778
+Video Zoom Percent: 1.000000
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: a,{font},{sz},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,2,1,1,0,0,0,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+""".format(
+        vw=vw,
+        vh=vh,
+        sz=sz,
+        font=font_name,
+        cmd=cmd,
+    ).encode("utf-8")
+
+
+def dialogue(ta, tb, txt):
+    # Dialogue: 0,0:00:00.00,0:00:05.00,a,,0,0,0,,hello world
+    return f"Dialogue: 0,{ta},{tb},a,,0,0,0,,{txt}\n".encode("utf-8")
+
+
+class AssWriter(object):
+    """
+    writes the events into out_fn, or with seg_len (seconds) into one
+    file per segment named like out_fn.000.ass, each with the header and
+    every event which is on screen at any point during that segment,
+    plus a .segments.json listing them; or into the binary file f
+    (like the stdin of an ffmpeg) instead of out_fn if given;
+    set chars to a set() to collect all the characters written
+    """
+
+    def __init__(self, out_fn, header, seg_len=0, f=None):
+        self.out_fn = out_fn
+        self.header = header
+        self.seg_len = seg_len
+        self.segs = {}  # segment number to the events not written yet
+        self.done = set()  # segments which are on disk
+        self.n0 = 0
+        self.piped = bool(f)
+        self.chars = None
+        if not seg_len:
+            self.f = f or open(out_fn, "wb")
+            self.write(0, 0, header)
+
+    def seg_fn(self, n):
+        return "{}.{:03d}.ass".format(self.out_fn.rsplit(".", 1)[0], n)
+
+    def write(self, t0, t1, ln):
+        if self.chars is not None:
+            self.chars.update(ln.decode("utf-8"))
+
+        if not self.seg_len:
+            try:
+                self.f.write(ln)
+            except BrokenPipeError:
+                # ffmpeg gave up; it will say why
+                self.f = open(os.devnull, "wb")
+            return
+
+        n0 = int(t0 // self.seg_len)
+        n1 = max(n0, math.ceil(t1 / self.seg_len) - 1)
+        for n in range(n0, n1 + 1):
+            self.segs.setdefault(n, []).append(ln)
+
+        if n0 > self.n0:
+            # the events are mostly in order, so the ones before
+            # are done; an hours-long stream is thousands of files
+            self.n0 = n0
+            for n in [x for x in self.segs if x < n0]:
+                self.put(n)
+
+    def put(self, n):
+        # anything after the first write is appended (rare)
+        with open(self.seg_fn(n), "ab" if n in self.done else "wb") as f:
+            if n not in self.done:
+                f.write(self.header)
+
+            f.writelines(self.segs.pop(n))
+
+        self.done.add(n)
+
+    def close(self):
+        if not self.seg_len:
+            try:
+                self.f.close()
+            except BrokenPipeError:
+                pass
+
+            return [] if self.piped else [self.out_fn]
+
+        # no gaps, so players can always load the one at the playhead
+        for n in range(max(list(self.segs) + list(self.done), default=-1) + 1):
+            if n not in self.done and n not in self.segs:
+                self.segs[n] = []
+
+        for n in list(self.segs):
+            self.put(n)
+
+        ret = []
+        manifest = []
+        for n in sorted(self.done):
+            ret.append(self.seg_fn(n))
+            manifest.append(
+                {
+                    "t0": n * self.seg_len,
+                    "t1": (n + 1) * self.seg_len,
+                    "fn": os.path.basename(self.seg_fn(n)),
+                }
+            )
+
+        jfn = self.out_fn.rsplit(".", 1)[0] + ".segments.json"
+        with open(jfn, "w", encoding="utf-8") as f:
+            jd = {"seg_len": self.seg_len, "segments": manifest}
+            json.dump(jd, f, indent=2)
+
+        return ret
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
@@ -0,0 +1,113 @@
+# sidecar index for --from/--to; remembers where in a chatlog each
+# part of the video is, so a time window can be read without
+# parsing everything before it
+
+import json
+from .util import debug, info, sidecar_load, sidecar_save
+
+
+# one index entry for every this many chat items
+IDX_EVERY = 256
+
+# read this many seconds more than asked on either side;
+# superchat times wobble a bit, and deletions come after the msg
+MARGIN = 120
+
+IDX_VER = 1
+
+
+def scan(f, ofs):
+    """
+    yields [start, obj, raw] for each chat item in the json array f,
+    starting at byte ofs; decoded as latin-1 so the offsets are in
+    bytes, meaning strings in obj are garbled but numbers are fine
+    (raw.encode("latin-1") is the original json of the item)
+    """
+    dec = json.JSONDecoder()
+    f.seek(ofs)
+    buf = ""
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in "[], \t\r\n":
+            pos += 1
+
+        try:
+            obj, end = dec.raw_decode(buf, pos)
+        except ValueError:
+            more = f.read(1024 * 1024)
+            if not more:
+                return
+
+            ofs += pos
+            buf = buf[pos:] + more.decode("latin-1")
+            pos = 0
+            continue
+
+        yield ofs + pos, obj, buf[pos:end]
+        pos = end
+
+
+def build_index(f):
+    """[running max of time_in_seconds, byte offset] every IDX_EVERY items"""
+    ret = []
+    t_max = None
+    for n, (ofs, obj, _) in enumerate(scan(f, 0)):
+        if n % IDX_EVERY == 0 and t_max is not None:
+            ret.append([t_max, ofs])
+
+        t = obj.get("time_in_seconds", None)
+        if t is not None and (t_max is None or t_max < t):
+            t_max = t
+
+    return ret
+
+
+def load_index(fn, f):
+    idx = sidecar_load(fn, ".softchat-idx", IDX_VER)
+    if idx is not None:
+        return idx
+
+    info(f"indexing {fn}")
+    idx = build_index(f)
+    if idx:
+        sidecar_save(fn, ".softchat-idx", IDX_VER, idx)
+
+    return idx
+
+
+def load_window(fn, t_from, t_to):
+    """
+    the chat items of fn from around t_from to t_to (seconds into the
+    video, None = until the end), or None if fn cannot be indexed
+    (compressed, not a chat_downloader chatlog, no time_in_seconds)
+    """
+    if fn.endswith((".gz", ".bz2", ".xz", ".zst")):
+        return None
+
+    with open(fn, "rb") as f:
+        if f.read(1) != b"[":
+            return None
+
+        idx = load_index(fn, f)
+        if not idx:
+            return None
+
+        # the last entry safely before the window, and then one more
+        # (IDX_EVERY msgs) for the layout to warm up with
+        ofs = 0
+        for n, (t, _) in enumerate(idx):
+            if t >= t_from - MARGIN:
+                break
+
+            ofs = idx[n - 1][1] if n else 0
+
+        ret = []
+        for _, obj, raw in scan(f, ofs):
+            t = obj.get("time_in_seconds", None)
+            if t_to is not None and t is not None and t > t_to + MARGIN:
+                break
+
+            ret.append(json.loads(raw.encode("latin-1").decode("utf-8")))
+
+    debug(f"read {len(ret)} chat items from offset {ofs}")
+    return ret
@@ -0,0 +1,263 @@
+# danmaku layout; decides which y each scrolling message goes at
+
+import heapq
+import random
+from bisect import bisect_left, insort
+from .util import debug
+
+
+def find_frees(spans, ymax, minsz):
+    """
+    free [size, y0, y1] ranges between spans (sorted by y0,y1),
+    in ascending order; pieces smaller than minsz are discarded
+
+    this is a single sweep which gives the same result as the
+    old approach of splitting a list of free ranges for each span,
+    including its quirk where a span which sticks out of the top
+    of the remaining free range also eats the gap below it
+    """
+    ret = []
+    c = 0
+    for y1, y2 in spans:
+        if y1 >= ymax:
+            break
+
+        if y2 <= c:
+            continue
+
+        if c <= y1 and y2 <= ymax and y1 - c > minsz:
+            ret.append([y1 - c, c, y1])
+
+        c = y2
+        if ymax - c <= minsz:
+            return ret
+
+    ret.append([ymax - c, c, ymax])
+    return ret
+
+
+def polls(t0, w, td, vw):
+    # collision detection polls at certain points from the left,
+    # so figure out timestamps when the right-side hits those
+    abs_spd = (vw + w * 1.0) / td
+    p9 = t0 + (w + vw * 0.1) / abs_spd  # 10% right
+    p8 = t0 + (w + vw * 0.2) / abs_spd
+    p5 = t0 + (w + vw * 0.5) / abs_spd
+    p3 = t0 + (w + vw * 0.7) / abs_spd
+    p1 = t0 + (w + vw * 0.9) / abs_spd  # 10% left
+
+    # and when the left-side hits those,
+    # to compare against other pN's and find a free slot
+    a9 = t0 + (vw * 0.1) / abs_spd
+    a8 = t0 + (vw * 0.2) / abs_spd
+    a5 = t0 + (vw * 0.5) / abs_spd
+    a3 = t0 + (vw * 0.7) / abs_spd
+    a1 = t0 + (vw * 0.9) / abs_spd
+
+    return [p9, p8, p5, p3, p1], [a9, a8, a5, a3, a1]
+
+
+class Danmaku(object):
+    def __init__(self, vw, bh, spread, rng=random):
+        self.vw = vw
+        self.bh = bh
+        self.spread = spread
+        self.rng = rng
+        self.seq = 0
+
+        # [p5, seq, lane] of on-screen messages, soonest-gone first
+        self.expiry = []
+
+        # on-screen messages sorted by y; [y1, y2, seq, p9, p8, p5, p3, p1]
+        self.lanes = []
+
+    def expire(self, t0):
+        while self.expiry and self.expiry[0][0] < t0:
+            _, _, lane = heapq.heappop(self.expiry)
+            del self.lanes[bisect_left(self.lanes, lane)]
+
+    def place(self, t0, w, h, td):
+        bh = self.bh
+        [p9, p8, p5, p3, p1], [a9, a8, a5, a3, a1] = polls(t0, w, td, self.vw)
+
+        self.expire(t0)
+
+        ymax = bh - h
+        if ymax < 1:
+            ymax = 1  # thx emotes
+
+        # use the first tier with any free slots
+        # (ordered by least amount of horizontal collision)
+        lanes = self.lanes
+        frees = find_frees(  # 10..90%
+            [(x[0], x[1]) for x in lanes if a9 < x[3] or a1 < x[7]], ymax, h * 0.9
+        )
+        if not frees:
+            frees = find_frees(  # 30..90%
+                [(x[0], x[1]) for x in lanes if a9 < x[3] or a3 < x[6]], ymax, h * 0.8
+            )
+        if not frees:
+            frees = find_frees(  # 60..80%
+                [(x[0], x[1]) for x in lanes if a8 < x[4] or a5 < x[5]], ymax, h * 0.8
+            )
+
+        if not frees:
+            # can't be helped, pick a random y to collide in
+            y = int(self.rng.randrange(ymax))
+        elif self.spread:
+            avail, y0, y1 = max(frees)
+            if avail <= h:
+                y = int(y0 + avail / 2)
+            else:
+                # just centering looks boring, let's rand
+                y = y0 + self.rng.randrange(avail - h)
+        else:
+            y = None
+            best = 5318008
+            target = bh / 2
+            for avail, y0, y1 in frees:
+                if y0 <= target and y1 >= target + h:
+                    y = target
+                    break
+                elif y0 >= target:
+                    this = y0 - target
+                    if best > this:
+                        best = this
+                        y = y0
+                elif y1 <= target + h:
+                    this = target - (y1 - h)
+                    if best > this:
+                        best = this
+                        y = y1 - h
+
+        y = int(y)
+        self.seq += 1
+        lane = [y, y + h, self.seq, p9, p8, p5, p3, p1]
+        insort(self.lanes, lane)
+        heapq.heappush(self.expiry, [p5, self.seq, lane])
+        return y
+
+
+class Admission(object):
+    """
+    decides which danmaku to show when chat is busier than the screen
+    can take; at most cap on screen at once, covering at most cover
+    times the screen area (0 = no limit). superchats/mods/VIPs can use
+    twice that, while short and repeated messages get half, so they
+    are the first to go, and it never gets worse than 2x no matter
+    how busy it is
+    """
+
+    # messages this short are probably spam ("w", "草", "!!!")
+    SHORT = 3
+
+    # and the same text again within this many seconds is a dupe
+    DUPE_SEC = 10
+
+    # of cap and cover, for priority / normal / short-or-dupe
+    LIMITS = [2, 1, 0.5]
+
+    def __init__(self, vw, bh, cap, cover):
+        self.cap = cap
+        self.max_area = cover * vw * bh
+        self.shown = []  # [t1, area] of what's on screen
+        self.area = 0
+        self.recent = {}  # text to when it was last seen
+        self.stats = [[0, 0] for _ in self.LIMITS]  # [shown, dropped]
+        self.peak = 0
+
+    def admit(self, t0, td, w, h, txt, prio):
+        while self.shown and self.shown[0][0] <= t0:
+            self.area -= heapq.heappop(self.shown)[1]
+
+        txt = txt.strip()
+        if prio:
+            cls = 0
+        elif len(txt) <= self.SHORT or t0 - self.recent.get(txt, -1e9) < self.DUPE_SEC:
+            cls = 2
+        else:
+            cls = 1
+
+        self.recent[txt] = t0
+        if len(self.recent) > 8192:
+            t = t0 - self.DUPE_SEC
+            self.recent = {k: v for k, v in self.recent.items() if v > t}
+
+        lim = self.LIMITS[cls]
+        area = w * h
+        ok = (not self.cap or len(self.shown) < self.cap * lim) and (
+            not self.max_area or self.area + area <= self.max_area * lim
+        )
+        self.stats[cls][not ok] += 1
+        if ok:
+            heapq.heappush(self.shown, [t0 + td, area])
+            self.area += area
+            self.peak = max(self.peak, len(self.shown))
+
+        return ok
+
+    def summary(self):
+        n = sum(x[1] for x in self.stats)
+        ret = [f"danmaku admission: dropped {n} of {sum(map(sum, self.stats))}"]
+        names = ["priority", "normal", "short/dupe"]
+        for k, (shown, dropped) in zip(names, self.stats):
+            ret.append(f"{dropped} of {shown + dropped} {k}")
+
+        return ", ".join(ret) + f"; at most {self.peak} on screen"
+
+
+def split_quiet(msgs, vw):
+    """
+    splits [t0, w, h, td] into independent runs of messages,
+    cutting wherever the previous messages have all expired
+    """
+    ret = []
+    seg = []
+    p5max = 0
+    for x in msgs:
+        t0, w, _, td = x
+        if seg and p5max < t0:
+            ret.append(seg)
+            seg = []
+
+        p5max = max(p5max, polls(t0, w, td, vw)[0][2])
+        seg.append(x)
+
+    if seg:
+        ret.append(seg)
+
+    return ret
+
+
+def layout_segment(a):
+    vw, bh, spread, msgs = a
+
+    # seeded by the segment start rather than its index, so
+    # a given stretch of chat looks the same however it's cut
+    rng = random.Random(b"nope %.3f" % (msgs[0][0],))
+    dm = Danmaku(vw, bh, spread, rng)
+    return [dm.place(*x) for x in msgs]
+
+
+def layout(msgs, vw, bh, spread, j, pool=None):
+    """returns the y of each [t0, w, h, td] in msgs"""
+    segs = [[vw, bh, spread, x] for x in split_quiet(msgs, vw)]
+    debug(f"danmaku layout: {len(segs)} independent segments")
+
+    if j < 2 or len(segs) < 2:
+        ys = map(layout_segment, segs)
+    elif pool:
+        ys = pool.map(layout_segment, segs, 4)
+    else:
+        import multiprocessing
+
+        with multiprocessing.Pool(min(j, len(segs))) as pool:
+            ys = pool.map(layout_segment, segs, 4)
+
+    return [y for seg in ys for y in seg]
+
+
+def move_txt(m, y, vw, by):
+    """the final event text for a formatted message m at y"""
+    y += m["h"] + by
+    return r"{{\move({:.1f},{:.1f},{:.1f},{:.1f}){}".format(vw, y, -m["w"], y, m["txt"])
@@ -0,0 +1,177 @@
+# where the measuring happens; worker processes (the default), threads
+# (free-threaded python, or hosts which don't let us fork), or right here
+
+import os
+import sys
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .mproc import Ctx, proc_init, proc_measure, gen_msg_thr
+from .util import debug
+from . import trace
+
+
+EXECUTORS = ["auto", "process", "thread", "serial"]
+
+# fewer distinct messages than this are measured in this process
+# even if there are workers; ~7ms each, so about what it takes to
+# spin up the pool (the workers are only started when needed)
+SERIAL_MAX = 200
+
+# groups of messages per roundtrip to a worker
+CHUNK = 100
+
+
+def free_threaded():
+    f = getattr(sys, "_is_gil_enabled", None)
+    return bool(f and not f())
+
+
+def get_executor(kind, ar, have_fugashi, j):
+    if kind == "auto":
+        if j < 2:
+            kind = "serial"
+        elif free_threaded():
+            kind = "thread"
+        else:
+            kind = "process"
+
+    debug(f"measuring with the {kind} executor, j={j}")
+    cls = {"process": Procs, "thread": Threads, "serial": Serial}[kind]
+    return cls(ar, have_fugashi, j)
+
+
+class Serial(object):
+    """measures in this process; also the fallback for small chats"""
+
+    def __init__(self, ar, have_fugashi, j=1):
+        self.ar = ar
+        self.have_fugashi = have_fugashi
+        self.j = j
+        self.ctx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def close(self):
+        pass
+
+    def serial(self, args, groups):
+        if not self.ctx:
+            self.ctx = Ctx(self.ar, self.have_fugashi)
+
+        self.ctx.args = args
+        for group in groups:
+            yield gen_msg_thr(self.ctx, group)
+
+    def measure(self, args, groups):
+        """yields the gen_msg_thr result of each group, in any order"""
+        return self.serial(args, groups)
+
+    def map(self, fn, items, chunksize=1):
+        return list(map(fn, items))
+
+
+class Procs(Serial):
+    """a multiprocessing pool which stays warm for the next file"""
+
+    def __init__(self, ar, have_fugashi, j):
+        super().__init__(ar, have_fugashi, j)
+        self.pool = None
+
+    def close(self):
+        if self.pool and trace.TRACE:
+            # let the workers exit on their own, so they save their spans
+            self.pool.close()
+            self.pool.join()
+        elif self.pool:
+            self.pool.terminate()
+
+        self.pool = None
+
+    def measure(self, args, groups):
+        if not self.pool and len(groups) < SERIAL_MAX:
+            debug(f"measuring {len(groups)} messages in-process")
+            return self.serial(args, groups)
+
+        if not self.pool:
+            import multiprocessing
+
+            initargs = [self.ar, self.have_fugashi]
+            with trace.span("start pool", "pool", j=self.j):
+                self.pool = multiprocessing.Pool(self.j, proc_init, initargs)
+
+        return self.run(args, groups)
+
+    def run(self, args, groups):
+        # the workers pick up this file's args from a pickle, so they
+        # only have to load it once rather than once per message
+        with tempfile.NamedTemporaryFile(
+            prefix="softchat-", suffix=".ctx", delete=False
+        ) as f, trace.span("pickle args", "pool"):
+            pickle.dump(args, f)
+
+        try:
+            tasks = [[f.name, x] for x in groups]
+            rets = self.pool.imap_unordered(proc_measure, tasks, CHUNK)
+            yield from trace.waits(rets, "wait for workers")
+        finally:
+            os.unlink(f.name)
+
+    def map(self, fn, items, chunksize=1):
+        if self.pool:
+            return self.pool.map(fn, items, chunksize)
+
+        # not worth warming up measuring workers for this
+        import multiprocessing
+
+        with multiprocessing.Pool(min(self.j, len(items))) as pool:
+            return pool.map(fn, items, chunksize)
+
+
+class Threads(Serial):
+    """
+    a thread pool; each thread gets its own Ctx since the font and
+    canvas are not thread-safe. only faster than serial when the
+    interpreter is free-threaded (3.13t and later)
+    """
+
+    def __init__(self, ar, have_fugashi, j):
+        super().__init__(ar, have_fugashi, j)
+        self.tls = threading.local()
+        self.ex = None
+
+    def close(self):
+        if self.ex:
+            self.ex.shutdown()
+            self.ex = None
+
+    def measure(self, args, groups):
+        if not self.ex and len(groups) < SERIAL_MAX:
+            debug(f"measuring {len(groups)} messages in-process")
+            return self.serial(args, groups)
+
+        if not self.ex:
+            self.ex = ThreadPoolExecutor(self.j)
+
+        def one(chunk):
+            ctx = getattr(self.tls, "ctx", None)
+            if not ctx:
+                ctx = self.tls.ctx = Ctx(self.ar, self.have_fugashi)
+
+            ctx.args = args
+            return [gen_msg_thr(ctx, x) for x in chunk]
+
+        chunks = [groups[n : n + CHUNK] for n in range(0, len(groups), CHUNK)]
+        rets = trace.waits(self.ex.map(one, chunks), "wait for threads")
+        return (x for chunk in rets for x in chunk)
+
+    def map(self, fn, items, chunksize=1):
+        if not self.ex:
+            self.ex = ThreadPoolExecutor(self.j)
+
+        return list(self.ex.map(fn, items))
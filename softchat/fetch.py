@@ -0,0 +1,74 @@
+# downloads emotes; many small files from the same few hosts,
+# so keep the connections alive and fetch a bunch at a time
+
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .util import debug, warn
+
+
+TIMEOUT = (10, 30)  # connect, read
+RETRIES = 3
+
+
+def mk_session(j):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=j, pool_maxsize=j, max_retries=retry)
+
+    s = requests.Session()
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+def fetch(s, url, fn):
+    """downloads url into fn"""
+    with s.get(url, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        body = r.content
+
+    # write next to the destination and rename into place,
+    # so an interrupted run never leaves a truncated emote
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+
+        os.replace(tmp, fn)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def fetch_all(jobs, j=8):
+    """
+    downloads each [url, fn] in jobs, j at a time;
+    returns the list of [url, fn, exception] which failed
+    """
+    if not jobs:
+        return []
+
+    j = max(1, min(j, len(jobs)))
+    s = mk_session(j)
+
+    def one(job):
+        url, fn = job
+        try:
+            fetch(s, url, fn)
+            debug(f"downloaded: {fn}")
+            return None
+        except Exception as ex:
+            warn(f"failed to download {url}: {ex!r}")
+            return [url, fn, ex]
+
+    with s, ThreadPoolExecutor(j) as ex:
+        return [x for x in ex.map(one, jobs) if x]
@@ -6,11 +6,21 @@ import json
 import tempfile
 import fontforge
 
-from .util import debug, warn, init_logger
+from .util import debug, init_logger
+from .fontcache import emote_map
 
 
-def gen_fonts(emotes, font_fn, font_name, dont_write):
-    shortcuts = dict()
+def gen_fonts(emotes, font_fn, font_name, dont_write, base_fn=None):
+    # each emote has a point from fontcache.plan, and base_fn
+    # (if any) already has some of them, so only add the rest
+    if base_fn:
+        font = fontforge.open(base_fn)
+        have = set(g.unicode for g in font.glyphs())
+        font.familyname = font_name
+        gen_glyphs(font, have, emotes, font_fn, dont_write)
+        font.close()
+        return emote_map(emotes)
+
     # Start of one of the private use areas.
     # The other two don't work with embedded subtitle files for some reason.
     point = 0xE000
@@ -35,15 +45,24 @@ def gen_fonts(emotes, font_fn, font_name, dont_write):
     g = font.createChar(point)
     g.importOutlines(blk_svg)
     g.width = 1100
-    point += 1
 
-    filled_emotes = []
+    gen_glyphs(font, set([point]), emotes, font_fn, dont_write)
+    os.unlink(blk_svg)
+    return emote_map(emotes)
+
+
+def gen_glyphs(font, have, emotes, font_fn, dont_write):
     for e in emotes.values():
-        g = font.createChar(point)
+        point = e["point"]
         src_fn = e["filename"]
         if not os.path.exists(src_fn):
             raise Exception("not found: " + src_fn)
 
+        if point in have:
+            continue  # same image as another emote, or from base_fn
+
+        have.add(point)
+        g = font.createChar(point)
         if not dont_write:
             debug("src: " + src_fn)
             g.importOutlines(src_fn)
@@ -54,26 +73,36 @@ def gen_fonts(emotes, font_fn, font_name, dont_write):
         # Could do better, maybe will, but good enough for now.
         g.width = 1100
 
-        for s in e["shortcuts"]:
-            if s in shortcuts:
-                warn("Found duplicate emote shortcut " + s)
-
-            ch = chr(point)
-            shortcuts[s] = ch
-            if e["fill"]:
-                filled_emotes.append(ch)
-
-        point += 1
-
     if not dont_write:
         font.correctDirection()
         font.generate(font_fn)
 
-    os.unlink(blk_svg)
-    return [shortcuts, filled_emotes]
+
+def serve():
+    """
+    stays up for as many fonts as the parent wants; each line on
+    stdin is the json args for gen_fonts, answered with one line
+    on stdout, either {"ok": ret} or {"err": "what went wrong"}
+    """
+    # fontforge likes to print things, so give it stderr instead
+    out = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    for ln in sys.stdin:
+        try:
+            ret = {"ok": gen_fonts(*json.loads(ln))}
+        except Exception as ex:
+            ret = {"err": repr(ex)}
+
+        out.write(json.dumps(ret) + "\n")
+        out.flush()
 
 
 def main():
+    if sys.argv[1] == "--serve":
+        return serve()
+
     tf_path = sys.argv[1]
     with open(tf_path, "r", encoding="utf-8") as f:
         args = f.read()
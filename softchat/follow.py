@@ -0,0 +1,112 @@
+# live follow mode; reads a chat capture while it is still being written
+
+import json
+import time
+import zlib
+import codecs
+from .util import debug
+
+
+def unzipper(fn):
+    """incremental decompressor for fn, picked by extension like zopen"""
+    if fn.endswith(".gz"):
+        # gzip files can be several members glued together
+        st = [zlib.decompressobj(47)]
+
+        def gunzip(buf):
+            ret = b""
+            while buf:
+                ret += st[0].decompress(buf)
+                buf = b""
+                if st[0].eof:
+                    buf = st[0].unused_data
+                    st[0] = zlib.decompressobj(47)
+
+            return ret
+
+        return gunzip
+
+    if fn.endswith(".bz2"):
+        import bz2
+
+        return bz2.BZ2Decompressor().decompress
+
+    if fn.endswith(".xz"):
+        import lzma
+
+        return lzma.LZMADecompressor().decompress
+
+    if fn.endswith(".zst"):
+        from zstandard import ZstdDecompressor
+
+        try:
+            ctx = ZstdDecompressor(max_window_size=1024 * 1024 * 1024 * 2)
+        except:
+            ctx = ZstdDecompressor(max_window_size=1024 * 1024 * 2)
+
+        return ctx.decompressobj().decompress
+
+    return lambda buf: buf
+
+
+class JsonTail(object):
+    """
+    splits a growing json array (chat_downloader) or
+    json-per-line (yt-dlp) stream into its objects
+    """
+
+    def __init__(self):
+        self.dec = json.JSONDecoder()
+        self.buf = ""
+
+    def feed(self, txt):
+        buf = self.buf + txt
+        ret = []
+        ofs = 0
+        while True:
+            # the stuff between objects; array brackets, commas, whitespace
+            while ofs < len(buf) and buf[ofs] in "[], \t\r\n":
+                ofs += 1
+
+            if ofs >= len(buf):
+                break
+
+            try:
+                obj, ofs = self.dec.raw_decode(buf, ofs)
+            except ValueError:
+                # probably incomplete, try again when there's more
+                break
+
+            ret.append(obj)
+
+        self.buf = buf[ofs:]
+        if len(self.buf) > 16 * 1024 * 1024:
+            raise Exception("follow: unparseable json at " + repr(self.buf[:128]))
+
+        return ret
+
+
+def tail_json(fn, timeout, poll=0.25):
+    """
+    yields a list of new json objects from fn each time it grows,
+    or an empty list every poll seconds while it doesn't;
+    gives up after timeout seconds without new data (0 = never)
+    """
+    unz = unzipper(fn)
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    jt = JsonTail()
+    t_data = time.time()
+    with open(fn, "rb") as f:
+        while True:
+            buf = f.read(512 * 1024)
+            if buf:
+                t_data = time.time()
+                yield jt.feed(utf8.decode(unz(buf)))
+                continue
+
+            if timeout and time.time() - t_data > timeout:
+                debug(f"follow: nothing new in {timeout} sec, stopping")
+                return
+
+            yield []
+            time.sleep(poll)
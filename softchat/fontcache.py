@@ -0,0 +1,193 @@
+# content-addressed cache of emote fonts; rendering the same stream
+# again (or another one from that channel) reuses the whole font,
+# or at least the glyphs it has in common with an earlier one
+
+import os
+import json
+import shutil
+import hashlib
+from .util import debug, info, warn
+
+
+# bump this if fff starts making different glyphs
+FONT_VER = 1
+
+# keep this many fonts around
+CACHE_SZ = 16
+
+# the first point is the black box from fff, emotes go after it
+FIRST_POINT = 0xE001
+
+
+def file_hash(fn):
+    with open(fn, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:32]
+
+
+def emote_map(emotes):
+    """[shortcuts, filled_emotes] for emotes with a point each"""
+    shortcuts = dict()
+    filled_emotes = []
+    for e in emotes.values():
+        ch = chr(e["point"])
+        for s in e["shortcuts"]:
+            if s in shortcuts:
+                warn("Found duplicate emote shortcut " + s)
+
+            shortcuts[s] = ch
+            if e["fill"]:
+                filled_emotes.append(ch)
+
+    return [shortcuts, filled_emotes]
+
+
+def load_manifests(cache_dir):
+    ret = []
+    try:
+        fns = os.listdir(cache_dir)
+    except:
+        return ret
+
+    for fn in fns:
+        if not fn.endswith(".json"):
+            continue
+
+        fn = os.path.join(cache_dir, fn)
+        try:
+            with open(fn, "r", encoding="utf-8") as f:
+                jd = json.load(f)
+
+            if jd["ver"] == FONT_VER and os.path.isfile(fn[:-5] + ".ttf"):
+                ret.append(jd)
+        except Exception as ex:
+            debug(f"ignoring {fn}: {ex!r}")
+
+    return ret
+
+
+def plan(emotes, cache_dir):
+    """
+    gives each emote a point (shared by identical ones) and returns
+    [key, hit, base]; hit is the cached font for this exact set of
+    emotes, or base is the one to start from (or both None)
+    """
+    glyphs = {}
+    for e in emotes.values():
+        gk = file_hash(e["filename"]) + ("-fill" if e["fill"] else "")
+        glyphs[e["id"]] = gk
+
+    key = [FONT_VER, [[eid, gk] for eid, gk in glyphs.items()]]
+    key = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()[:32]
+
+    want = set(glyphs.values())
+    best = None
+    n_best = 0
+    for jd in load_manifests(cache_dir):
+        if jd["key"] == key:
+            best = jd
+            break
+
+        # reuse whatever has the most glyphs in common,
+        # unless most of the font would be dead weight
+        n = len(want.intersection(jd["glyphs"]))
+        if n > n_best and len(jd["glyphs"]) < len(want) * 2 + 32:
+            best = jd
+            n_best = n
+
+    points = {}
+    nxt = FIRST_POINT
+    if best:
+        points = {k: v for k, v in best["glyphs"].items() if k in want}
+        nxt = max(best["glyphs"].values()) + 1
+
+    for gk in glyphs.values():
+        if gk not in points:
+            points[gk] = nxt
+            nxt += 1
+
+    for e in emotes.values():
+        e["point"] = points[glyphs[e["id"]]]
+
+    if not best:
+        return [key, None, None]
+
+    fn = os.path.join(cache_dir, best["key"] + ".ttf")
+    if best["key"] == key:
+        return [key, fn, None]
+
+    info(f"emote font: reusing {n_best} of {len(want)} glyphs from the cache")
+    return [key, None, fn]
+
+
+def rename(fn, old, new):
+    """changes the font name of fn from old to new"""
+    from fontTools.ttLib import TTFont
+
+    font = TTFont(fn)
+    for rec in font["name"].names:
+        try:
+            txt = rec.toUnicode()
+        except:
+            continue
+
+        if old in txt:
+            rec.string = txt.replace(old, new)
+
+    font.save(fn)
+
+
+def store(font_fn, font_name, key, base, emotes, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    glyphs = {}
+    if base:
+        with open(base[:-4] + ".json", "r", encoding="utf-8") as f:
+            glyphs = json.load(f)["glyphs"]
+
+    for e in emotes.values():
+        gk = file_hash(e["filename"]) + ("-fill" if e["fill"] else "")
+        glyphs[gk] = e["point"]
+
+    dst = os.path.join(cache_dir, key)
+    shutil.copy2(font_fn, dst + ".ttf")
+    jd = {"ver": FONT_VER, "key": key, "name": font_name, "glyphs": glyphs}
+    with open(dst + ".json", "w", encoding="utf-8") as f:
+        json.dump(jd, f)
+
+    # forget the least recently used
+    jds = load_manifests(cache_dir)
+    fns = [os.path.join(cache_dir, x["key"]) for x in jds]
+    fns.sort(key=lambda x: os.stat(x + ".ttf").st_mtime, reverse=True)
+    for fn in fns[CACHE_SZ:]:
+        for ext in [".json", ".ttf"]:
+            try:
+                os.unlink(fn + ext)
+            except:
+                pass
+
+
+def get_font(emotes, font_fn, font_name, dont_write, cache_dir, gen):
+    """
+    generates the emote font into font_fn using gen (generate_font),
+    unless the cache already has it; returns [shortcuts, filled_emotes]
+    """
+    key, hit, base = plan(emotes, cache_dir)
+    if dont_write:
+        return gen(emotes, font_fn, font_name, True, None)
+
+    if hit:
+        info(f"emote font: cache hit {hit}")
+        with open(hit[:-4] + ".json", "r", encoding="utf-8") as f:
+            old_name = json.load(f)["name"]
+
+        shutil.copy2(hit, font_fn)
+        rename(font_fn, old_name, font_name)
+        os.utime(hit)  # lru
+        return emote_map(emotes)
+
+    ret = gen(emotes, font_fn, font_name, False, base)
+    try:
+        store(font_fn, font_name, key, base, emotes, cache_dir)
+    except Exception as ex:
+        warn(f"could not cache the emote font: {ex!r}")
+
+    return ret
@@ -0,0 +1,223 @@
+# differential harness; renders synthetic (and any sample) chats with a
+# bunch of argument combinations, and checks that the events come out
+# the same as on a known-good version, and the same for any -j
+#
+#   python -m softchat.golden --update   # on the known-good version
+#   python -m softchat.golden            # after changing things
+
+import os
+import sys
+import json
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import importlib.util
+import subprocess as sp
+
+
+# bump this if synth_chat or COMBOS change, so old goldens are dropped
+GOLDEN_VER = 1
+
+# [mode, args]; each is rendered with -j 1 and -j N
+COMBOS = [
+    ["-m1"],
+    ["-m1", "--sz", "30"],
+    ["-m1", "-b", "360x500+24+40"],
+    ["-m1", "--emote_sz", "1.6"],
+    ["-m2"],
+    ["-m2", "--spread"],
+    ["-m2", "--emote_sz", "1.6"],
+    ["-m2", "--dm_max", "20"],
+]
+
+WORDS = "lol kusa 草 hello world {brace} back\\slash \\N gg wp nice pog xD ああ 日本語 テスト www omg LETS GOOO"
+WORDS += " 漢字を読む 今日は晴れです 、 。 ！ 「かっこ」 :grinning: :_custom: ｗｗｗ supercalifragilisticexpialidocious"
+
+
+def synth_chat(seed, n):
+    """
+    n chat_downloader items with a bit of everything; bursts and quiet
+    gaps, wrapping, japanese, superchats, mods/VIPs, nickname clashes,
+    dupes, stock emotes and deletions
+    """
+    rng = random.Random(seed)
+    words = WORDS.split()
+    base = 1_600_000_000_000_000
+    ret = []
+    prev = None
+    t = 12.0
+    for i in range(n):
+        t += rng.choice([0.05, 0.1, 0.3, 1, 2]) if rng.random() > 0.02 else 40
+        uid = "UC%05d" % rng.randrange(200)
+        txt = " ".join(rng.choice(words) for _ in range(rng.randrange(1, 25)))
+        m = {
+            "action_type": "add_chat_item",
+            "author": {"id": uid, "name": "nick%d" % (int(uid[2:]) % 150)},
+            "message": txt,
+            "message_id": "id%d" % i,
+            "timestamp": base + int(t * 1e6),
+            "time_in_seconds": t,
+        }
+        h, s = divmod(int(t), 3600)
+        mm, s = divmod(s, 60)
+        m["time_text"] = f"{h}:{mm:02d}:{s:02d}" if h else f"{mm}:{s:02d}"
+
+        r = rng.random()
+        if r < 0.02:
+            m["money"] = {"text": "$5.00"}
+            m["body_background_colour"] = "#1de9b6ff"
+        elif r < 0.03:
+            m["amount"] = "¥500"
+            m["message"] = None
+            m["background_colour"] = "#ffca28ff"
+        elif r < 0.06:
+            m["author"]["badges"] = [{"title": "Moderator"}]
+        elif r < 0.07:
+            m["author"]["id"] = "UCkIccKaHDGA8lYVmUerLhag"
+        elif r < 0.1 and prev:
+            m["message"] = prev["message"] or "--"  # dupe-ish
+            m["author"] = prev["author"]
+
+        if ":grinning:" in (m["message"] or ""):
+            emote = {"id": "😀", "shortcuts": [":grinning:"], "is_custom_emoji": False}
+            m["emotes"] = [emote]
+
+        ret.append(m)
+        prev = m
+
+        if rng.random() < 0.005:
+            victim = ret[rng.randrange(len(ret))]
+            d = {"action_type": "mark_chat_item_as_deleted"}
+            d["target_message_id"] = victim["message_id"]
+            ret.append(d)
+
+    return ret
+
+
+def fingerprint(ass_fn):
+    """hash of the events in ass_fn, so the header doesn't matter"""
+    h = hashlib.sha256()
+    n = 0
+    with open(ass_fn, "rb") as f:
+        for ln in f:
+            if ln.startswith(b"Dialogue: "):
+                h.update(ln)
+                n += 1
+
+    return f"{n}:{h.hexdigest()[:32]}"
+
+
+def env_key(fontdir):
+    """
+    what else decides the output; goldens from a different
+    font or freetype can't be compared, only -j against -j
+    """
+    from PIL import features
+    from .mproc import TextStuff
+
+    z = TextStuff(24, fontdir, 1)
+    with open(z.otf_src, "rb") as f:
+        font = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    fugashi = bool(importlib.util.find_spec("fugashi"))
+    return [GOLDEN_VER, font, features.version("freetype2"), fugashi]
+
+
+def render(chat_fn, args, j, fontdir):
+    cmd = [sys.executable, "-m", "softchat", "-j", str(j)] + args
+    if fontdir:
+        cmd += ["--fontdir", fontdir]
+
+    cmd.append(chat_fn)
+    p = sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    if p.returncode:
+        raise Exception(p.stderr.decode("utf-8", "replace")[-2000:])
+
+    return fingerprint(chat_fn.rsplit(".json", 1)[0] + ".ass")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="softchat differential harness")
+
+    # fmt: off
+    ap.add_argument("--golden", metavar="FN", default="softchat-golden.json", help="golden fingerprints")
+    ap.add_argument("--update", action="store_true", help="store the current output as the golden")
+    ap.add_argument("-j", metavar="N", type=int, default=4, help="the -j to compare against -j 1")
+    ap.add_argument("-n", metavar="MSGS", type=int, default=1500, help="messages per synthetic chat")
+    ap.add_argument("--fontdir", metavar="DIR", default=None, help="path to noto-hinted")
+    ap.add_argument("samples", metavar="JSON_FILE", nargs="*", help="real chats to include")
+    # fmt: on
+
+    ar = ap.parse_args()
+
+    env = env_key(ar.fontdir)
+    combos = COMBOS[:]
+    if env[-1]:
+        combos += [["-m1", "--kana"], ["-m2", "--kana"]]
+
+    golden = {}
+    try:
+        with open(ar.golden, "r", encoding="utf-8") as f:
+            jd = json.load(f)
+
+        if jd["env"] == env:
+            golden = jd["prints"]
+        elif not ar.update:
+            print(f"{ar.golden} was made with {jd['env']}, this is {env};")
+            print(f"  only checking -j 1 against -j {ar.j}")
+    except FileNotFoundError:
+        if not ar.update:
+            print(f"no {ar.golden} yet; only checking -j 1 against -j {ar.j}")
+
+    td = tempfile.mkdtemp(prefix="softchat-golden-")
+    chats = []
+    for seed in [1, 2]:
+        fn = os.path.join(td, f"synth{seed}.json")
+        with open(fn, "w", encoding="utf-8") as f:
+            json.dump(synth_chat(seed, ar.n), f)
+
+        chats.append(fn)
+
+    for fn in ar.samples:
+        dst = os.path.join(td, os.path.basename(fn))
+        shutil.copy2(fn, dst)
+        chats.append(dst)
+
+    prints = {}
+    bad = 0
+    try:
+        for fn in chats:
+            for args in combos:
+                k = " ".join([os.path.basename(fn)] + args)
+                fp1 = render(fn, args, 1, ar.fontdir)
+                fpn = render(fn, args, ar.j, ar.fontdir)
+                prints[k] = fp1
+
+                msg = "ok"
+                if fp1 != fpn:
+                    msg = f"-j1 {fp1} != -j{ar.j} {fpn}"
+                elif k in golden and golden[k] != fp1:
+                    msg = f"CHANGED; was {golden[k]}, now {fp1}"
+                elif not golden:
+                    msg = "ok (no golden)"
+
+                bad += not msg.startswith("ok")
+                print(f"{msg:>24}  {k}" if msg.startswith("ok") else f"{k}\n  {msg}")
+    finally:
+        shutil.rmtree(td)
+
+    if ar.update:
+        with open(ar.golden, "w", encoding="utf-8") as f:
+            json.dump({"env": env, "prints": prints}, f, indent=1, sort_keys=True)
+
+        print(f"wrote {len(prints)} fingerprints to {ar.golden}")
+
+    if bad:
+        print(f"{bad} of {len(prints)} differ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# how busy the chat is at each point of the video; for finding the
+# hype moments in a pile of VODs without opening any of them:
+#
+#   python3 -m softchat.heatmap -w 10,60 --top 20 *.json
+#
+# the chat is boiled down to messages per second, which is cached in a
+# .softchat-density sidecar (written by softchat when it converts the
+# chat, or by this on the first run) so the next look is milliseconds
+
+import sys
+import json
+import heapq
+import argparse
+from operator import sub
+from itertools import accumulate
+from .util import init_logger, zopen, sidecar_load, sidecar_save
+
+
+DENSITY_VER = 1
+
+
+def item_time(m):
+    """seconds into the video for a chat message, or None if it's not one"""
+    a = m.get("replayChatItemAction")
+    if a:
+        # yt-dlp
+        if "addChatItemAction" not in a["actions"][0]:
+            return None
+
+        t = a.get("videoOffsetTimeMsec")
+        return None if t in (None, "isLive") else float(t) / 1000
+
+    if m.get("action_type", "add_chat_item") != "add_chat_item":
+        return None  # deletions, tickers, ...
+
+    return m.get("time_in_seconds")
+
+
+def density(items):
+    """number of messages in each second"""
+    ret = []
+    for m in items:
+        t = item_time(m)
+        if t is None or t < 0 or t > 4096 * 4096:
+            continue
+
+        t = int(t)
+        if t >= len(ret):
+            ret.extend([0] * (t + 1 - len(ret)))
+
+        ret[t] += 1
+
+    return ret
+
+
+def load_density(fn):
+    """the cached density of chat fn, or None if it's missing or outdated"""
+    return sidecar_load(fn, ".softchat-density", DENSITY_VER)
+
+
+def save_density(fn, items):
+    """caches the density of chat fn, unless it already is"""
+    if load_density(fn) is None:
+        sidecar_save(fn, ".softchat-density", DENSITY_VER, density(items))
+
+
+def read_items(fn):
+    with zopen(fn, "r", encoding="utf-8") as f:
+        txt = f.read()
+
+    try:
+        return json.loads(txt)
+    except ValueError:
+        # yt-dlp; one item per line
+        return [json.loads(x) for x in txt.split("\n") if x.strip()]
+
+
+def ass_density(fn):
+    # one event per message, at least in .ass files from softchat
+    ret = []
+    with open(fn, "rb") as f:
+        for ln in f:
+            if not ln.startswith(b"Dialogue: 0,"):
+                continue
+
+            h, m, s = ln.split(b",", 2)[1].split(b":")
+            t = int(60 * (60 * int(h) + int(m)) + float(s))
+            if t >= len(ret):
+                ret.extend([0] * (t + 1 - len(ret)))
+
+            ret[t] += 1
+
+    return ret
+
+
+def load_counts(fn):
+    """messages per second in a chat json (or .ass)"""
+    if fn.endswith(".ass"):
+        return ass_density(fn)
+
+    ret = load_density(fn)
+    if ret is None:
+        items = read_items(fn)
+        save_density(fn, items)
+        ret = density(items)
+
+    return ret
+
+
+def windows(counts, sizes):
+    """
+    for each window size w, the number of messages in the
+    w seconds up to and including each second
+    """
+    acc = list(accumulate(counts))
+    ret = []
+    for w in sizes:
+        lag = [0] * min(w, len(acc)) + acc[: max(0, len(acc) - w)]
+        ret.append(list(map(sub, acc, lag)))
+
+    return ret
+
+
+def peaks(counts, sizes, bucket):
+    """
+    [t, [[n, t_n], ...]] for each bucket of seconds; the busiest
+    window of each size which ends within it, and when it ends
+    """
+    wins = windows(counts, sizes)
+    ret = []
+    for t in range(0, len(counts), bucket):
+        row = []
+        for win in wins:
+            part = win[t : t + bucket]
+            n = max(part)
+            row.append([n, t + part.index(n)])
+
+        ret.append([t, row])
+
+    return ret
+
+
+def fmt_t(t):
+    m, s = divmod(int(t), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="chat activity over time")
+
+    # fmt: off
+    ap.add_argument("-w", metavar="SEC,..", type=str, default="10", help="window sizes; the first one decides the ranking and which time is shown")
+    ap.add_argument("-b", metavar="SEC", type=int, default=30, help="one line per this many seconds")
+    ap.add_argument("--top", metavar="N", type=int, default=0, help="just the N busiest moments across all the files")
+    ap.add_argument("fn", metavar="FILE", nargs="+", help="chat json (or .ass from softchat)")
+    # fmt: on
+
+    ar = ap.parse_args()
+    sizes = [int(x) for x in ar.w.split(",")]
+
+    best = []
+    for fn in ar.fn:
+        try:
+            rows = peaks(load_counts(fn), sizes, ar.b)
+        except Exception as ex:
+            print(f"{fn}: {ex!r}", file=sys.stderr)
+            continue
+
+        if ar.top:
+            # keep the list short while going through hundreds of files
+            best.extend([row[0][0], row[0][1], fn, row] for _, row in rows)
+            best = heapq.nlargest(ar.top, best, key=lambda x: x[0])
+            continue
+
+        if len(ar.fn) > 1:
+            print(f"\n# {fn}")
+
+        for _, row in rows:
+            n, t = row[0]
+            more = "".join(f" {x[0]:4d}" for x in row[1:])
+            print(f"{n:4d}{more} {t:5d}  {fmt_t(t)}")
+
+    for n, t, fn, row in best:
+        more = "".join(f" {x[0]:4d}" for x in row[1:])
+        print(f"{n:4d}{more} {t:5d}  {fmt_t(t)}  {fn}")
+
+
+if __name__ == "__main__":
+    init_logger(False)
+    main()
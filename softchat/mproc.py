@@ -2,10 +2,12 @@
 
 import re
 import os
+import zlib
+import pickle
 import tempfile
-from multiprocessing import current_process
-from PIL import ImageFont, ImageDraw, Image
-from .util import debug, info, warn, error, WINDOWS, load_fugashi
+from .util import debug, info, warn, error, WINDOWS, load_fugashi, hms
+from .ass import assan, segment_msg, render_msegs
+from . import trace
 
 
 message_translation_table = "".maketrans(
@@ -16,9 +18,25 @@ message_translation_table = "".maketrans(
 )
 
 
+vips = [
+    "UCkIccKaHDGA8lYVmUerLhag",
+    "UCI1KCp4Wa3dGfcmxgik1mCw",
+]
+
+mod_badges = ["Moderator", "Owner", "Verified"]
+
+# rough memory use of a measuring worker; the 4k canvas, the
+# CJK font and the pads in TextStuff, plus UniDic if it's loaded
+WORKER_MEM = 128 * 1024 * 1024
+FUGASHI_MEM = 256 * 1024 * 1024
+
+
 class TextStuff(object):
     def __init__(self, sz, fontdir, emote_scale):
+        from PIL import ImageFont, ImageDraw, Image
+
         self.sz = sz
+        self.phases = None  # --trace
 
         if fontdir:
             fontdir = fontdir.rstrip(os.sep)
@@ -211,6 +229,9 @@ class TextStuff(object):
         for w in words:
             offsets.append(offsets[-1] + self.vsize(w + "_", msg_emotes)[0])
 
+        if self.phases:
+            self.phases.mark("measure")
+
         minima = [0] + [10**20] * count
         breaks = [0] * (count + 1)
         for i in range(count):
@@ -235,44 +256,117 @@ class TextStuff(object):
         return lines
 
 
-def gen_msg_initializer(fn, ar, vw, bw, emote_shortcuts, have_fugashi):
-    fn.args = [ar, vw, bw, emote_shortcuts]
+class Ctx(object):
+    """
+    what a worker needs to measure messages; the expensive part (font,
+    canvas, mecab) is made once per worker, and args is swapped out for
+    each file: [ar, vw, bw, emote_shortcuts, filled_emotes, nick_dupes]
+    """
 
-    ptn_kanji = re.compile(r"[\u4E00-\u9FAF]")
-    ptn_kana = re.compile(r"[\u3040-\u30FF]")
-    ptn_ascii = re.compile(r"[a-zA-Z]")
-    ptn_pre = re.compile(r"([　、。〇〉》」』】〕〗〙〛〜〞〟・…⋯！＂）＊－．／＞？＠＼］＿～｡｣･￭￮]+)")
-    ptn_post = re.compile(r"([〈《「『【〔〖〘〚〝（＜［｀｢]+)")
+    def __init__(self, ar, have_fugashi):
+        self.args = None
+        self.ctx_fn = None
+        self.colormap = {}
 
-    fn.regs = [ptn_kanji, ptn_kana, ptn_ascii, ptn_pre, ptn_post]
+        ptn_kanji = re.compile(r"[\u4E00-\u9FAF]")
+        ptn_kana = re.compile(r"[\u3040-\u30FF]")
+        ptn_ascii = re.compile(r"[a-zA-Z]")
+        ptn_pre = re.compile(
+            r"([　、。〇〉》」』】〕〗〙〛〜〞〟・…⋯！＂）＊－．／＞？＠＼］＿～｡｣･￭￮]+)"
+        )
+        ptn_post = re.compile(r"([〈《「『【〔〖〘〚〝（＜［｀｢]+)")
 
-    fn.z = TextStuff(ar.sz, ar.fontdir, ar.emote_sz)
-    if have_fugashi:
-        try:
-            fn.wakati, fn.yomi = load_fugashi()
-        except Exception as ex:
-            msg = "\033[33m\nfailed to load fugashi in worker:\n{}\n\033[0m\n"
-            print(msg.format(repr(ex)), end="")
+        self.regs = [ptn_kanji, ptn_kana, ptn_ascii, ptn_pre, ptn_post]
 
+        self.z = TextStuff(ar.sz, ar.fontdir, ar.emote_sz)
+        self.wakati = self.yomi = None
+        if have_fugashi:
+            try:
+                self.wakati, self.yomi = load_fugashi()
+            except Exception as ex:
+                msg = "\033[33m\nfailed to load fugashi in worker:\n{}\n\033[0m\n"
+                print(msg.format(repr(ex)), end="")
 
-def gen_msg_thr(a):
-    n_msg, msg = a
-    [ar, vw, bw, emote_shortcuts] = gen_msg_thr.args
-    [ptn_kanji, ptn_kana, ptn_ascii, ptn_pre, ptn_post] = gen_msg_thr.regs
+        self.phases = None
+        if trace.TRACE:
+            self.phases = self.z.phases = trace.Phases("gen_msg_thr")
 
-    z = gen_msg_thr.z
-    try:
-        wakati = gen_msg_thr.wakati
-        yomi = gen_msg_thr.yomi
-        have_fugashi = True
-    except:
-        have_fugashi = False
 
+# the Ctx of this process, when it's a worker in a process pool
+CTX = None
+
+
+def proc_init(ar, have_fugashi):
+    global CTX
+    if ar.trace:
+        trace.worker(ar.trace)
+
+    with trace.span("init", "worker"):
+        CTX = Ctx(ar, have_fugashi)
+
+
+def proc_measure(a):
+    """
+    gen_msg_thr in a process pool; takes [ctx_fn, group] where
+    ctx_fn is a pickle of the Ctx.args for the file it belongs to
+    """
+    ctx_fn, group = a
+    if CTX.ctx_fn != ctx_fn:
+        with trace.span("load args", "worker"), open(ctx_fn, "rb") as f:
+            CTX.args = pickle.load(f)
+
+        CTX.ctx_fn = ctx_fn
+
+    return gen_msg_thr(CTX, group)
+
+
+def norm_txt(msg):
     txt = msg.get("message", "") or ""
     txt = txt.translate(message_translation_table)
     if "amount" not in msg and "money" not in msg and txt == "":
         txt = "--"
 
+    return txt
+
+
+def memo_key(msg, ar, vw, bw):
+    """messages with the same key will wrap and measure the same"""
+    wrap_width = bw if ar.m == 1 else vw / 2
+    return (norm_txt(msg), wrap_width, ar.m, ar.sz, ar.emote_sz, ar.kana)
+
+
+def gen_msg_thr(ctx, a):
+    """
+    takes [[n_msg, msg], ...] of messages with the same memo_key;
+    the text is measured once and then formatted for each message
+    """
+    ret = []
+    measured = None
+    pt = ctx.phases
+    if pt:
+        pt.begin()
+
+    for n_msg, msg in a:
+        t_fsec = check_time(msg)
+        if t_fsec is None:
+            ret.append([n_msg, None])
+            continue
+
+        if not measured:
+            measured = measure(ctx, norm_txt(msg), n_msg)
+
+        vtxt, vsz, msg_emotes = measured
+        ret.append([n_msg, fmt_msg(ctx, msg, vtxt, vsz, t_fsec, msg_emotes)])
+        if pt:
+            pt.mark("format")
+
+    if pt:
+        pt.end(len(a))
+
+    return ret
+
+
+def check_time(msg):
     t_fsec = msg["time_in_seconds"]
     t_isec = int(t_fsec)
     t_hms = msg["time_text"]
@@ -295,6 +389,20 @@ def gen_msg_thr(a):
         raise Exception(
             f"time drift [{t_fsec}] [{t_isec}] [{t_isec2}] [{t_hms}]\n  (pls provide this chat-rip to ed)"
         )
+
+    return t_fsec
+
+
+def measure(ctx, txt, n_msg):
+    [ar, vw, bw, emote_shortcuts, _, _] = ctx.args
+    [ptn_kanji, ptn_kana, ptn_ascii, ptn_pre, ptn_post] = ctx.regs
+
+    z = ctx.z
+    wakati = ctx.wakati
+    yomi = ctx.yomi
+    have_fugashi = wakati is not None
+    pt = ctx.phases
+
     msg_emotes = []
     if ":" in txt and ar.emote_font:
         old_txt = txt
@@ -321,6 +429,9 @@ def gen_msg_thr(a):
             txt2 += c
         txt = txt2
 
+    if pt:
+        pt.mark("emote")
+
     n_ascii = len(ptn_ascii.findall(txt))
     n_kanji = len(ptn_kanji.findall(txt))
     n_kana = len(ptn_kana.findall(txt))
@@ -328,6 +439,8 @@ def gen_msg_thr(a):
     # if the amount of ascii compared to kanji/kana
     # is less than 30%, assume we'll need MeCab
     is_jp = (n_kanji + n_kana) / (n_kanji + n_kana + n_ascii + 0.1) > 0.7
+    if pt:
+        pt.mark("classify")
 
     # transcription from kanji to kana if requested
     if ar.kana and is_jp and n_kanji:
@@ -342,6 +455,9 @@ def gen_msg_thr(a):
             else:
                 txt += ch
 
+        if pt:
+            pt.mark("kana")
+
     if ar.m == 1:
         wrap_width = bw
     else:
@@ -354,7 +470,12 @@ def gen_msg_thr(a):
     # wrap to specified width
     # by splitting on ascii whitespace
     vtxt = z.unrag(txt, wrap_width, msg_emotes)
+    if pt:
+        pt.mark("wrap")
+
     vsz = z.vsize("\n".join(vtxt), msg_emotes)
+    if pt:
+        pt.mark("measure")
 
     if vsz[0] >= bw and is_jp:
         # too wide, is japanese,
@@ -363,10 +484,16 @@ def gen_msg_thr(a):
         vtxt = ptn_post.sub("\n\\1", vtxt)
         vtxt = vtxt.split("\n")
         vsz = z.vsize("\n".join(vtxt), msg_emotes)
+        if pt:
+            pt.mark("measure")
 
         if vsz[0] >= bw and have_fugashi:
             # still too wide, wrap on word-boundaries
-            vtxt = z.unrag(wakati.parse(txt), bw, msg_emotes)
+            txt2 = wakati.parse(txt)
+            if pt:
+                pt.mark("mecab")
+
+            vtxt = z.unrag(txt2, bw, msg_emotes)
             vtxt = [x.replace(" ", "") for x in vtxt]
 
             for n in range(1, len(vtxt)):
@@ -378,7 +505,162 @@ def gen_msg_thr(a):
                     vtxt[n] = ln[m.end() :]
 
             vsz = z.vsize("\n".join(vtxt), msg_emotes)
+            if pt:
+                pt.mark("wrap")
 
     vtxt = [x for x in vtxt if x.strip()]
 
-    return [n_msg, msg, vtxt, vsz, t_fsec, t_hms, msg_emotes]
+    return vtxt, vsz, msg_emotes
+
+
+def nick_color(ctx, nick, mode):
+    colormap = ctx.colormap
+    try:
+        return colormap[nick]
+    except:
+        pass
+
+    import colorsys
+
+    if mode == 1:
+        bri = 0.5
+        sat = 1
+    else:
+        bri = 0.4
+        sat = 0.8
+
+    bgr_nick = zlib.crc32(nick.encode("utf-8")) & 0xFFFFFFFF
+    r, g, b = [
+        int(x * 255) for x in colorsys.hsv_to_rgb((bgr_nick % 256) / 256.0, sat, bri)
+    ]
+    bgr_nick = f"{r:02x}{g:02x}{b:02x}"  # and its gonna stay that way
+    colormap[nick] = bgr_nick
+    return bgr_nick
+
+
+def fmt_msg(ctx, msg, vtxt, vsz, t_fsec, msg_emotes):
+    """
+    everything about the ass event which does not depend on layout;
+    the writer only has to position it
+    """
+    [ar, vw, bw, _, filled_emotes, nick_dupes] = ctx.args
+    z = ctx.z
+
+    sx, sy = vsz
+    sy = int(sy - 10)
+
+    uid = msg["author"]["id"]
+    nick = msg["author"]["name"]
+    if nick in nick_dupes:
+        nick += f"  ({uid})"
+
+    bgr_nick = nick_color(ctx, nick, ar.m)
+
+    # defaults from ass header
+    bord = 2
+    shad = 1
+
+    shrimp = None
+    bgr_msg = bgr_nick
+    bgr_fg = "ffffff"
+    if "amount" in msg or "money" in msg:
+        color = None
+        for k in [
+            "body_background_colour",
+            "background_colour",
+            "money_chip_background_colour",
+        ]:
+            if k in msg:
+                color = msg[k]
+                break
+
+        bord = shad = 4
+        bgr_fg = "000000"
+        bgr_msg = color[1:][:-2] or "444444"  # "#1de9b6ff"
+        bgr_msg = f"{bgr_msg[4:6]}{bgr_msg[2:4]}{bgr_msg[0:2]}"  # thx ass
+        amount = msg["money"]["text"] if "money" in msg else msg["amount"]
+        shrimp = rf"{{\bord{bord}\shad{shad}\3c&H{bgr_msg}&\c&H{bgr_fg}&}}{amount}"
+
+    nick = assan(nick)
+    txts = [assan(x) for x in vtxt]
+
+    badges = [b["title"] for b in msg["author"].get("badges", [])]
+    is_mod = not set(badges).isdisjoint(mod_badges)
+
+    rich = msg_emotes and (ar.emote_fill or filled_emotes or ar.emote_sz > 1.01)
+    lineh = z.emote_vsz[1]
+
+    o = {"t0": t_fsec, "ta": hms(t_fsec), "plain": "".join(vtxt)}  # for --dm_max
+    if ar.m == 1:
+        # text = colored nick followed by the actual lines, ass-escaped
+        txt = [rf"{{\3c&H{bgr_nick}&\fs{ar.sz*0.67:.1f}}}{nick}"]
+
+        if is_mod:
+            txt[0] += r" {\bord16\shad6}*"
+        elif uid in vips:
+            txt[0] += r" {\bord16\shad4}----"
+
+        if shrimp:
+            txt.append(rf"{{\fscx90\fscy90}}{shrimp}{{\fscx100\fscy100}}")
+            sy += lineh
+
+        txt.extend(txts)
+        txt[1] = rf"{{\fs{ar.sz}}}{txt[1]}"
+
+        if rich:
+            txt = "\n".join(txt)
+            msegs = segment_msg(txt, ar.emote_fill, filled_emotes)
+            txt = render_msegs(
+                msegs, ar.sz, ar.sz * ar.emote_sz, bgr_msg, bgr_fg, bord, shad
+            )
+            txt = txt.split("\n")
+
+        o["txt"] = txt
+        o["sy"] = sy
+        return o
+
+    txt = "\\N".join(txts)
+    w = sx
+    h = sy
+
+    # ass linespacing is huge, compensate (wild guess btw)
+    nickh = lineh * 0.6
+    h += int(ar.sz * 0.25 * (len(txts) - 1) + 0.99 + nickh)
+
+    # plus some horizontal margin between the messages
+    w += 8
+
+    shrimp_mul = 1
+    if shrimp:
+        txt = f"{shrimp} {txt}"
+        shrimp_mul = 2
+        w += h * 4  # donation is not included, TODO maybe
+
+    vip = False
+    if is_mod:
+        bord = shad = 6
+        badge_sz = int(12 * ar.badge_sz)
+        txt = rf"{{\bord{badge_sz}\shad{shad}}}*{{\bord{bord}}}{txt}"
+        vip = True
+    elif uid in vips:
+        bord = shad = 4
+        badge_sz = int(8 * ar.badge_sz)
+        txt = rf"{{\bord{badge_sz}\shad{shad}}}_{{\bord{bord}}}{txt}"
+        vip = True
+
+    len_boost = 0.7
+    td = (vw + w - w * len_boost) * shrimp_mul / ar.spd
+
+    if rich:
+        msegs = segment_msg(txt, ar.emote_fill, filled_emotes)
+        txt = render_msegs(
+            msegs, ar.sz, ar.sz * ar.emote_sz, bgr_msg, bgr_fg, bord, shad
+        )
+
+    o["tb"] = hms(t_fsec + td)
+    o["w"] = w
+    o["h"] = h
+    o["td"] = td
+    o["txt"] = rf"\3c&H{bgr_nick}&}}{txt}{{\fscx40\fscy40\bord1}}\N{nick}"
+    o["super"] = bool(shrimp or vip)
+    return o
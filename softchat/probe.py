@@ -0,0 +1,249 @@
+# media duration and resolution; reads the container headers directly
+# for mkv/webm/mp4 and only asks ffprobe when that doesn't work out
+
+import os
+import json
+import struct
+from .util import debug, sidecar_load, sidecar_save
+
+
+PROBE_VER = 1
+
+# give up on a container after reading this many bytes of headers
+MAX_HDR = 16 * 1024 * 1024
+
+
+def ebml_vint(f, mask=True):
+    """reads an ebml varint; None at eof, -1 for unknown-size"""
+    b = f.read(1)
+    if not b:
+        return None
+
+    b = b[0]
+    n = 1
+    while n <= 8 and not b & (0x80 >> (n - 1)):
+        n += 1
+
+    if n > 8:
+        raise Exception("bad ebml vint")
+
+    v = b & (0xFF >> n) if mask else b
+    for x in f.read(n - 1):
+        v = (v << 8) | x
+
+    if mask and v == (1 << (7 * n)) - 1:
+        return -1
+
+    return v
+
+
+def ebml_children(f, end):
+    """yields [id, size, data_ofs] for each element until end (None = eof)"""
+    while end is None or f.tell() < end:
+        eid = ebml_vint(f, False)
+        if eid is None:
+            return
+
+        sz = ebml_vint(f)
+        if sz is None:
+            return
+
+        ofs = f.tell()
+        yield eid, sz, ofs
+        if sz < 0:
+            continue  # unknown-size; descend into it
+
+        f.seek(ofs + sz)
+
+
+def ebml_num(f, sz, fmt=None):
+    buf = f.read(sz)
+    if fmt:
+        return struct.unpack(fmt, buf)[0]
+
+    return int.from_bytes(buf, "big")
+
+
+def mkv_info(f):
+    """[duration, [w, h]] of a matroska/webm, or None if incomplete"""
+    eid, sz, ofs = next(ebml_children(f, None))
+    if eid != 0x1A45DFA3:
+        return None
+
+    f.seek(ofs + sz)
+    eid, sz, ofs = next(ebml_children(f, None))
+    if eid != 0x18538067:  # segment
+        return None
+
+    seg_end = None if sz < 0 else ofs + sz
+    scale = 1000000
+    dur = None
+    res = None
+    for eid, sz, ofs in ebml_children(f, seg_end):
+        if ofs > MAX_HDR or eid == 0x1F43B675:  # cluster; headers are done
+            break
+
+        if eid == 0x1549A966:  # info
+            for eid, sz, ofs in ebml_children(f, ofs + sz):
+                if eid == 0x2AD7B1:
+                    scale = ebml_num(f, sz)
+                elif eid == 0x4489:
+                    dur = ebml_num(f, sz, ">f" if sz == 4 else ">d")
+
+        elif eid == 0x1654AE6B and not res:  # tracks
+            for eid, sz, ofs in ebml_children(f, ofs + sz):
+                if eid != 0xAE:
+                    continue
+
+                kind = None
+                wh = None
+                for eid, sz, ofs in ebml_children(f, ofs + sz):
+                    if eid == 0x83:
+                        kind = ebml_num(f, sz)
+                    elif eid == 0xE0:
+                        wh = [0, 0]
+                        for eid, sz, ofs in ebml_children(f, ofs + sz):
+                            if eid in (0xB0, 0xBA):
+                                wh[eid == 0xBA] = ebml_num(f, sz)
+
+                if kind == 1 and wh:
+                    res = wh
+                    break
+
+        if dur is not None and res:
+            break
+
+    if dur is None or not res:
+        return None
+
+    return [dur * scale / 1e9, res]
+
+
+def mp4_boxes(f, end):
+    """yields [type, data_ofs, end] for each box until end (None = eof)"""
+    while end is None or f.tell() + 8 <= end:
+        ofs = f.tell()
+        hdr = f.read(8)
+        if len(hdr) < 8:
+            return
+
+        sz, kind = struct.unpack(">I4s", hdr)
+        if sz == 1:
+            sz = struct.unpack(">Q", f.read(8))[0]
+        elif sz == 0:
+            sz = os.fstat(f.fileno()).st_size - ofs
+
+        if sz < 8:
+            raise Exception("bad mp4 box")
+
+        yield kind, f.tell(), ofs + sz
+        f.seek(ofs + sz)
+
+
+def mp4_hdr(f):
+    # mvhd/mdhd; version 1 has 64bit times. returns [timescale, duration]
+    ver = f.read(4)[0]
+    if ver == 1:
+        return struct.unpack(">16xIQ", f.read(28))
+
+    return struct.unpack(">8xII", f.read(16))
+
+
+def mp4_info(f):
+    """[duration, [w, h]] of an mp4 (video track if any), or None"""
+    dur = None
+    res = None
+    for kind, ofs, end in mp4_boxes(f, None):
+        if kind != b"moov":
+            continue
+
+        for kind, ofs, end in mp4_boxes(f, end):
+            if kind == b"mvhd" and dur is None:
+                ts, d = mp4_hdr(f)
+                dur = d / ts
+
+            if kind != b"trak":
+                continue
+
+            wh = None
+            vdur = None
+            video = False
+            for kind, ofs, end in mp4_boxes(f, end):
+                if kind == b"tkhd":
+                    f.seek(end - 8)
+                    w, h = struct.unpack(">II", f.read(8))
+                    wh = [w >> 16, h >> 16]
+                elif kind == b"mdia":
+                    for kind, ofs, end in mp4_boxes(f, end):
+                        if kind == b"mdhd":
+                            ts, d = mp4_hdr(f)
+                            vdur = d / ts
+                        elif kind == b"hdlr":
+                            video = f.read(12)[8:] == b"vide"
+
+            if video and not res:
+                res = wh
+                dur = vdur or dur
+
+        break
+
+    if dur is None or not res:
+        return None
+
+    return [dur, res]
+
+
+def ffprobe_info(fn):
+    import subprocess as sp
+
+    ents = "format=duration:stream=codec_type,width,height,duration"
+    ents += ":stream_tags=DURATION"
+    cmd = ["ffprobe", "-hide_banner", "-v", "error", "-of", "json"]
+    cmd += ["-show_entries", ents, fn]
+    jd = json.loads(sp.check_output(cmd).decode("utf-8"))
+
+    # prefer the video stream's duration; mp4 format duration is a bit longer
+    vs = [x for x in jd.get("streams", []) if x.get("codec_type") == "video"]
+    if not vs:
+        raise Exception(f"no video stream in {fn}")
+
+    vs = vs[0]
+    dur = vs.get("duration") or vs.get("tags", {}).get("DURATION")
+    if dur and ":" in dur:
+        h, m, s = [float(x) for x in dur.split(":")]
+        dur = 60 * (60 * h + m) + s
+
+    dur = float(dur or jd["format"]["duration"])
+    return [dur, [int(vs["width"]), int(vs["height"])]]
+
+
+def read_info(fn):
+    readers = {"mkv": mkv_info, "webm": mkv_info, "mp4": mp4_info}
+    reader = readers.get(fn.lower().rsplit(".", 1)[-1])
+    if reader:
+        try:
+            with open(fn, "rb") as f:
+                ret = reader(f)
+
+            if ret:
+                return ret
+
+            debug(f"{fn} has no duration in its headers; asking ffprobe")
+        except Exception as ex:
+            debug(f"could not read {fn}: {ex!r}; asking ffprobe")
+
+    return ffprobe_info(fn)
+
+
+def get_media_info(fn):
+    """
+    returns [duration, (w, h)] of the video in fn; remembered in a
+    sidecar file until fn changes, so reconverting is free
+    """
+    ret = sidecar_load(fn, ".softchat-probe", PROBE_VER)
+    if ret:
+        return ret[0], tuple(ret[1])
+
+    dur, res = read_info(fn)
+    sidecar_save(fn, ".softchat-probe", PROBE_VER, [dur, res])
+    return dur, tuple(res)
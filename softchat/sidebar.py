@@ -0,0 +1,50 @@
+# sidebar layout (mode 1); new messages appear at the bottom of the box
+# and push the older ones up and out
+
+
+class Sidebar(object):
+    def __init__(self, bx, by, bh, nickh):
+        self.bx = bx
+        self.by = by
+        self.bh = bh
+        self.nickh = nickh
+        self.vis = []
+
+    def add(self, msg):
+        # show new messages bottom-left (heh)
+        msg["px"] = self.bx
+        msg["py"] = self.by + self.bh - msg["sy"] - self.nickh
+
+        rm = 0
+        for m in self.vis:
+            m["py"] -= msg["sy"] + self.nickh
+            if m["py"] < self.by:
+                rm += 1
+
+        self.vis = self.vis[rm:] + [msg]
+
+    def txt(self):
+        # rely on squished font for linespacing reduction
+        txt = r"{{\pos({:.1f},{:.1f})}}".format(self.bx, self.by + self.bh)
+        for m in self.vis:
+            pad = ""
+            for ln in m["txt"]:
+                txt += pad + ln + r"\N{\r}"
+                pad = r"\h\h"
+
+        return txt
+
+    def debug_txts(self):
+        # verification, one ass entry for each line
+        ret = []
+        for m in self.vis:
+            step = self.nickh
+            x = m["px"]
+            y = m["py"]
+            for ln in m["txt"]:
+                ret.append(r"{{\pos({:.1f},{:.1f})}}{}".format(x, y, ln))
+                x = m["px"] + 8
+                y += step
+                step = m["sy"] / (len(m["txt"]) - 1)
+
+        return ret
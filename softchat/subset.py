@@ -0,0 +1,106 @@
+# --subset_font; a copy of the squished CJK font with just the glyphs
+# which are actually used, small enough to embed into every file
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from .util import debug, info
+
+
+# bump this if the subsets should be made differently
+SUBSET_VER = 1
+
+# keep this many subsets around
+CACHE_SZ = 32
+
+# always included; cheap, and players draw some of these by themselves
+BASE_CHARS = [chr(x) for x in range(0x20, 0x7F)] + ["…", "�"]
+
+
+def subset_key(otf_src, chars):
+    st = os.stat(otf_src)
+    cps = sorted(set(ord(x) for x in chars))
+    key = [SUBSET_VER, os.path.basename(otf_src), st.st_size, st.st_mtime_ns, cps]
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()[:32]
+
+
+def make_subset(otf_src, chars, dst):
+    from fontTools import subset
+
+    opts = subset.Options()
+    opts.name_IDs = ["*"]
+    opts.layout_features = ["*"]
+    opts.notdef_outline = True
+    font = subset.load_font(otf_src, opts)
+    sub = subset.Subsetter(opts)
+    sub.populate(unicodes=[ord(x) for x in chars])
+    sub.subset(font)
+    subset.save_font(font, dst, opts)
+
+
+def set_name(fn, font_name):
+    """
+    makes fn part of the font family font_name; libass looks through
+    all the fonts in a family for missing glyphs, so this can share
+    the name of the emote font and fill in the rest of the text
+    """
+    from fontTools.ttLib import TTFont
+
+    full_name = font_name + " CJK"
+    ps_name = "".join(x for x in full_name if x.isalnum() or x in "-_")
+    font = TTFont(fn)
+    tab = font["name"]
+    names = {1: font_name, 3: f"{ps_name};{SUBSET_VER}", 4: full_name, 6: ps_name}
+    for nid in list(names) + [16, 17]:
+        tab.removeNames(nameID=nid)
+
+    for nid, txt in names.items():
+        tab.setName(txt, nid, 3, 1, 0x409)  # windows
+        tab.setName(txt, nid, 1, 0, 0)  # mac
+
+    if "CFF " in font:
+        cff = font["CFF "].cff
+        top = cff[cff.fontNames[0]]
+        cff.fontNames = [ps_name]
+        top.FullName = full_name
+        top.FamilyName = font_name
+
+    font.save(fn)
+
+
+def subset_font(otf_src, chars, out_fn, font_name, cache_dir):
+    """
+    writes the glyphs for chars from otf_src into out_fn as font_name;
+    the subsets are cached by the set of chars, so similar chats and
+    reconverts don't have to subset the whole font again
+    """
+    chars = set(chars).union(BASE_CHARS)
+    key = subset_key(otf_src, chars)
+    cache_fn = os.path.join(cache_dir, key + ".otf")
+    if os.path.isfile(cache_fn):
+        info(f"cjk subset: cache hit {cache_fn}")
+        os.utime(cache_fn)  # lru
+    else:
+        info(f"cjk subset: {len(chars)} chars from {otf_src}")
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            make_subset(otf_src, chars, tmp)
+            os.replace(tmp, cache_fn)
+        except:
+            os.unlink(tmp)
+            raise
+
+        # forget the least recently used
+        fns = [os.path.join(cache_dir, x) for x in os.listdir(cache_dir)]
+        fns = [x for x in fns if x.endswith(".otf")]
+        fns.sort(key=lambda x: os.stat(x).st_mtime, reverse=True)
+        for fn in fns[CACHE_SZ:]:
+            debug(f"cjk subset: dropping {fn}")
+            os.unlink(fn)
+
+    shutil.copy2(cache_fn, out_fn)
+    set_name(out_fn, font_name)
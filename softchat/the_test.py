@@ -1,5 +1,19 @@
+import os
+import sys
+import gzip
+import json
+import random
 import pytest
-from .ass import segment_msg, render_msegs
+import threading
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+from .ass import assan, segment_msg, render_msegs, ZEROWIDTH_SPACE, AssWriter
+from .danmaku import Danmaku, Admission, split_quiet, layout
+from .follow import JsonTail, unzipper
+from .chatidx import IDX_EVERY, load_window
+from .fetch import fetch_all
+from .fontcache import get_font, emote_map
+from .probe import get_media_info
 
 
 tx = "a"
@@ -18,6 +32,45 @@ def rend(sl):
     return render_msegs(sl, 3, 5, "", "", 7, 9)
 
 
+def stand_in_noto(tmp_path):
+    """a noto-hinted with a tiny font of boxes, for TextStuff; returns the fontdir"""
+    from fontTools.fontBuilder import FontBuilder
+    from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+    chars = [chr(x) for x in range(0x21, 0x7F)]
+    names = [".notdef", "space"] + ["g%d" % (ord(x),) for x in chars]
+    glyphs = {}
+    for x in names:
+        pen = TTGlyphPen(None)
+        if x != "space":
+            pen.moveTo((50, 0))
+            pen.lineTo((50, 700))
+            pen.lineTo((450, 700))
+            pen.lineTo((450, 0))
+            pen.closePath()
+
+        glyphs[x] = pen.glyph()
+
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(names)
+    cmap = {ord(c): g for c, g in zip(chars, names[2:])}
+    cmap[0x20] = "space"
+    fb.setupCharacterMap(cmap)
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics({x: (500, 50) for x in names})
+    fb.setupHorizontalHeader(ascent=880, descent=-120)
+    fb.setupNameTable({"familyName": "Noto Sans CJK JP", "styleName": "Regular"})
+    fb.setupOS2(
+        sTypoAscender=880, sTypoDescender=-120, usWinAscent=880, usWinDescent=120
+    )
+    fb.setupPost()
+    os.makedirs(str(tmp_path / "noto-hinted"), exist_ok=True)
+    for fn in ["NotoSansCJKjp-Regular.otf", "SquishedNotoSansCJKjp-Regular.otf"]:
+        fb.save(str(tmp_path / "noto-hinted" / fn))
+
+    return str(tmp_path)
+
+
 def test_segment_msg():
     assert seg(tx) == [atx]
     assert seg(tx) == [atx]
@@ -32,10 +85,977 @@ def test_segment_msg():
 
 def test_render_msegs():
     assert rend([atx]) == "a"
-    assert rend([aem]) == f"{{\\fs5}}{em}{{\\fs3}}"
+    assert rend([aem]) == f"{{\\fs5.0}}{em}{{\\fs3.0}}"
     r = rend([afi])
     print(r)
     assert len(r.split(fi)) == 2
     assert len(r.split(r"\fs5")) == 2
     assert len(r.split(r"\fs3")) == 2
     assert len(r.split(r"\fscx")) == 3
+
+
+# the char-by-char versions from before the rewrite
+
+
+def legacy_assan(x):
+    ret = ""
+    for c, nc in zip(x, x[1:] + "\n"):
+        if c == "{":
+            ret += "\\{"
+        elif c == "}":
+            ret += "\\}"
+        elif c == "\\" and nc in ["N", "n", "h"]:
+            ret += "\\\\"
+        else:
+            ret += c
+
+    if ret.endswith("\\"):
+        ret += ZEROWIDTH_SPACE
+
+    return ret
+
+
+def legacy_segment_msg(txt, fill_all, fill_list):
+    ret = []
+    plv = 0
+    buf = ""
+    for c, u in list(zip(txt, [ord(x) for x in txt])) + [[None, 0]]:
+        if u >= 0xE000 and u <= 0xF8FF:
+            if fill_all or c in fill_list:
+                nlv = 2
+            else:
+                nlv = 1
+        else:
+            nlv = 0
+
+        if plv == nlv and c:
+            buf += c
+        else:
+            if buf:
+                ret.append([plv, buf])
+            buf = c
+
+        plv = nlv
+
+    return ret
+
+
+def legacy_render_msegs(msegs, tsz, esz, bg, fg, bord, shad):
+    ret = ""
+    plv = 0
+    for lv, txt in msegs + [[0, ""]]:
+        cmd = ""
+
+        if not lv and txt.endswith("\\"):
+            txt += ZEROWIDTH_SPACE
+
+        if plv < 1 and lv > 0:
+            cmd += f"\\fs{esz:.1f}"
+
+        if plv < 2 and lv > 1:
+            scx = int(len(txt) * 110) - 10
+            fsp = esz / 0.9111
+            cmd += f"\\c&H{bg}\\fscx{scx:.2f}\\fsp-{fsp:.2f}}}\ue000{{\\fscx100\\fsp0\\c&H{fg}\\1a&H00&\\bord1\\shad0"
+
+        if plv > 1 and lv < 2:
+            cmd += f"\\bord{bord}\\shad{shad}"
+
+        if plv > 0 and lv < 1:
+            cmd += f"\\fs{tsz:.1f}"
+
+        plv = lv
+        if cmd:
+            ret += f"{{{cmd}}}{txt}"
+        else:
+            ret += txt
+
+    return ret
+
+
+def rand_txt(gen):
+    chars = "ab {}\\Nnh\n\u200b\ue000\ue001\ue002\uf8ff\uf900草"
+    return "".join(gen.choice(chars) for _ in range(gen.randrange(24)))
+
+
+def test_ass_vs_legacy():
+    gen = random.Random(1)
+    fill_lists = [[], ["\ue001"], {"\ue001", "\uf8ff"}]
+    for _ in range(20000):
+        tx = rand_txt(gen)
+        assert assan(tx) == legacy_assan(tx)
+
+        fill_all = gen.random() < 0.2
+        fill_list = gen.choice(fill_lists)
+        segs = segment_msg(tx, fill_all, fill_list)
+        assert segs == legacy_segment_msg(tx, fill_all, fill_list)
+
+        args = [12, 18.5, "00ff00", "ffffff", 4, 2]
+        assert render_msegs(segs, *args) == legacy_render_msegs(segs, *args)
+
+
+def bench():
+    import timeit
+
+    gen = random.Random(1)
+    words = "kusa lol 草 \\N {wow} \ue001 \ue002\ue002 ああ LETS GOOO".split()
+    txts = []
+    for _ in range(2000):
+        txts.append(" ".join(gen.choice(words) for _ in range(gen.randrange(1, 12))))
+
+    args = [12, 18.5, "00ff00", "ffffff", 4, 2]
+    segs = [segment_msg(x, False, ["\ue001"]) for x in txts]
+    for name, new, old, inputs in [
+        ["assan", assan, legacy_assan, [[x] for x in txts]],
+        [
+            "segment_msg",
+            segment_msg,
+            legacy_segment_msg,
+            [[x, False, ["\ue001"]] for x in txts],
+        ],
+        ["render_msegs", render_msegs, legacy_render_msegs, [[x] + args for x in segs]],
+    ]:
+        t_new = min(
+            timeit.repeat(lambda: [new(*x) for x in inputs], number=10, repeat=5)
+        )
+        t_old = min(
+            timeit.repeat(lambda: [old(*x) for x in inputs], number=10, repeat=5)
+        )
+        print(
+            f"{name:13} {t_old*1000:7.1f} ms -> {t_new*1000:7.1f} ms  ({t_old/t_new:.1f}x)"
+        )
+
+
+def legacy_danmaku(msgs, vw, bh, spread, rng):
+    # the layout loop from before the Danmaku engine, to compare against
+    vis = []
+    ret = []
+    for t0, w, h, td in msgs:
+        abs_spd = (vw + w * 1.0) / td
+        p = [t0 + (w + vw * x) / abs_spd for x in [0.1, 0.2, 0.5, 0.7, 0.9]]
+        a9, a8, a5, a3, a1 = [
+            t0 + (vw * x) / abs_spd for x in [0.1, 0.2, 0.5, 0.7, 0.9]
+        ]
+        vis = [m for m in vis if t0 <= m[3][2]]
+        taken_best = [m[:2] for m in vis if a9 < m[3][0] or a1 < m[3][4]]
+        taken_good = [m[:2] for m in vis if a9 < m[3][0] or a3 < m[3][3]]
+        taken_okay = [m[:2] for m in vis if a8 < m[3][1] or a5 < m[3][2]]
+        ymax = max(bh - h, 1)
+        overlap_mul = 0.9
+        frees_merged = []
+        for lst in [taken_best, taken_good, taken_okay]:
+            frees = [[ymax, 0, ymax]]
+            for y1, y2 in sorted(lst):
+                rm = []
+                add = []
+                for free in frees:
+                    _, fy1, fy2 = free
+                    if fy1 >= y2 or y1 >= fy2:
+                        continue
+                    rm.append(free)
+                    if fy1 <= y1 and fy2 >= y2 and y1 - fy1 > h * overlap_mul:
+                        add.append([y1 - fy1, fy1, y1])
+                    if fy2 - y2 > h * overlap_mul:
+                        add.append([fy2 - y2, y2, fy2])
+                for x in rm:
+                    frees.remove(x)
+                frees.extend(add)
+            frees_merged.append(frees)
+            overlap_mul = 0.8
+        frees = next((x for x in frees_merged if x), None)
+        if not frees:
+            y = int(rng.randrange(ymax))
+        elif spread:
+            avail, y0, y1 = sorted(frees)[-1]
+            y = int(y0 + avail / 2) if avail <= h else y0 + rng.randrange(avail - h)
+        else:
+            y = None
+            best = 5318008
+            target = bh / 2
+            for avail, y0, y1 in frees:
+                if y0 <= target and y1 >= target + h:
+                    y = target
+                    break
+                elif y0 >= target and best > y0 - target:
+                    best = y0 - target
+                    y = y0
+                elif y0 < target and y1 <= target + h and best > target - (y1 - h):
+                    best = target - (y1 - h)
+                    y = y1 - h
+        y = int(y)
+        vis.append([y, y + h, len(ret), p])
+        ret.append(y)
+    return ret
+
+
+@pytest.mark.parametrize("spread", [False, True])
+def test_danmaku(spread):
+    gen = random.Random(spread)
+    for rate in [1, 10, 100]:
+        t = 0
+        msgs = []
+        for _ in range(2000):
+            t += gen.random() * 2 / rate
+            w = gen.randrange(40, 700)
+            h = gen.randrange(30, 140)
+            msgs.append([t, w, h, (1280 + w * 0.3) * gen.choice([1, 1, 2]) / 256])
+
+        ref = legacy_danmaku(msgs, 1280, 720, spread, random.Random(rate))
+        dm = Danmaku(1280, 720, spread, random.Random(rate))
+        assert [dm.place(*x) for x in msgs] == ref
+
+
+def test_danmaku_split():
+    gen = random.Random(1)
+    t = 0
+    msgs = []
+    for n in range(600):
+        t += 30 if n % 100 == 0 else gen.random() / 20
+        msgs.append([t, gen.randrange(40, 700), 60, 5.0])
+
+    assert len(split_quiet(msgs, 1280)) == 6
+    assert layout(msgs, 1280, 720, True, 1) == layout(msgs, 1280, 720, True, 3)
+
+
+def test_danmaku_admission():
+    adm = Admission(1280, 720, 4, 0)
+
+    def go(t0, txt, prio=False):
+        return adm.admit(t0, 5.0, 100, 40, txt, prio)
+
+    # plenty of room; even spam gets in
+    assert [go(0, "w"), go(0, "hello there")] == [True, True]
+
+    # half full; no more spam or dupes, but normal msgs are fine
+    assert not go(1, "草") and not go(1, "hello there")
+    assert [go(1, "msg %d" % (n,)) for n in range(3)] == [True, True, False]
+
+    # full; superchats still get in, up to twice the cap
+    assert [go(2, "$5 hi", True) for n in range(5)] == [True] * 4 + [False]
+
+    # and it all scrolls away
+    assert go(8, "w")
+    assert [x[1] for x in adm.stats] == [1, 1, 2]
+
+
+@pytest.mark.parametrize("fmt", ["array", "lines", "gz"])
+def test_follow_jsontail(fmt):
+    items = [{"n": n, "txt": "日本語 [x], {y}" * (n % 5)} for n in range(300)]
+    if fmt == "array":
+        buf = json.dumps(items, indent=2, ensure_ascii=False).encode("utf-8")
+    else:
+        buf = "".join(json.dumps(x) + "\n" for x in items).encode("utf-8")
+
+    fn = "x.json"
+    if fmt == "gz":
+        buf = gzip.compress(buf[:5000]) + gzip.compress(buf[5000:])
+        fn += ".gz"
+
+    # as if the file was growing in random steps
+    gen = random.Random(1)
+    unz = unzipper(fn)
+    jt = JsonTail()
+    txt = b""
+    ret = []
+    while buf:
+        n = gen.randrange(1, 300)
+        txt += unz(buf[:n])
+        buf = buf[n:]
+        try:
+            ret += jt.feed(txt.decode("utf-8"))
+            txt = b""
+        except UnicodeDecodeError:
+            pass
+
+    assert ret == items
+
+
+@pytest.mark.parametrize("mode", [1, 2])
+def test_follow(tmp_path, mode):
+    from .__main__ import mk_argparser, follow, text_stuff
+    from .golden import synth_chat
+
+    # deletions have no timestamp, and must not be mistaken for yt-dlp
+    chat = synth_chat(1, 400)
+    assert any(x["action_type"] == "mark_chat_item_as_deleted" for x in chat)
+    fn = str(tmp_path / "a.json")
+    with open(fn, "w", encoding="utf-8") as f:
+        json.dump(chat, f)
+
+    args = ["-m%d" % (mode,), "--sz", "24", "--fontdir", stand_in_noto(tmp_path)]
+    args += ["--follow", "--follow_timeout", "1.6", fn]
+    ar = mk_argparser().parse_args(args)
+    out_fn = str(tmp_path / "a.ass")
+    follow(ar, out_fn, text_stuff(ar), "x", False)
+    with open(out_fn, "r", encoding="utf-8") as f:
+        evs = [x.split(",", 9) for x in f if x.startswith("Dialogue: ")]
+
+    assert len(evs) > 300
+    if mode == 1:
+        # one event per look of the sidebar, even while it's quiet
+        txts = [x[9] for x in evs]
+        assert all(a != b for a, b in zip(txts, txts[1:]))
+        assert all(a[2] == b[1] for a, b in zip(evs, evs[1:]))
+
+
+def test_chatidx(tmp_path):
+    items = [
+        {"time_in_seconds": n * 0.5, "message": "日本語 %d" % n} for n in range(5000)
+    ]
+    fn = str(tmp_path / "x.json")
+    with open(fn, "w", encoding="utf-8") as f:
+        json.dump(items, f, indent=2, ensure_ascii=False)
+
+    for _ in range(2):  # build the index, then use it
+        ret = load_window(fn, 1500, 1600)
+        assert ret[0]["time_in_seconds"] < 1500 - 120 - IDX_EVERY * 0.5
+        assert ret[-1]["time_in_seconds"] >= 1600 + 120
+        assert ret == items[items.index(ret[0]) :][: len(ret)]
+
+    assert len(ret) < len(items) / 2
+    assert load_window(fn, 0, 5)[0] == items[0]
+
+
+def test_segments(tmp_path):
+    fn = str(tmp_path / "x.ass")
+    with AssWriter(fn, b"hdr\n", 60) as aw:
+        aw.write(10, 20, b"a\n")
+        aw.write(50, 70, b"b\n")  # carried over into the 2nd
+        aw.write(190, 200, b"c\n")  # leaving the 3rd one empty
+        aw.write(119, 120, b"d\n")  # ends right at the boundary
+
+    segs = []
+    for n in range(4):
+        with open(str(tmp_path / ("x.%03d.ass" % n)), "rb") as f:
+            segs.append(f.read())
+
+    assert segs == [b"hdr\na\nb\n", b"hdr\nb\nd\n", b"hdr\n", b"hdr\nc\n"]
+    with open(str(tmp_path / "x.segments.json"), "rb") as f:
+        jd = json.load(f)
+
+    assert [x["t0"] for x in jd["segments"]] == [0, 60, 120, 180]
+
+    # lots of short segments; nothing is kept open
+    fn = str(tmp_path / "y.ass")
+    with AssWriter(fn, b"hdr\n", 1) as aw:
+        for n in range(3000):
+            aw.write(n + 0.5, n + 1.5, b"%d\n" % (n,))
+            assert len(aw.segs) < 3
+
+    with open(str(tmp_path / "y.2999.ass"), "rb") as f:
+        assert f.read() == b"hdr\n2998\n2999\n"
+
+
+def test_embed_pipe(tmp_path, monkeypatch):
+    from . import __main__ as sc
+
+    # an ffmpeg which just copies the subtitles it gets into the output,
+    # or dies right away if the media is called "bad"
+    ff = """#!{}
+import sys
+a = sys.argv[1:]
+if a[a.index("-i") + 1].endswith("bad.mp4"):
+    sys.exit("nope")
+with open(a[-2], "wb") as f:
+    f.write(sys.stdin.buffer.read())
+"""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    with open(str(bindir / "ffmpeg"), "w") as f:
+        f.write(ff.format(sys.executable))
+
+    os.chmod(str(bindir / "ffmpeg"), 0o755)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+
+    for name in ["ok", "bad"]:
+        media = str(tmp_path / (name + ".mp4"))
+        mux = sc.start_embed(media, 60, [])
+        with sc.ass_out(media[:-4] + ".ass", b"hdr\n", 0, mux) as aw:
+            for n in range(9999):
+                aw.write(n, n + 1, b"line %d\n" % (n,))
+
+        if name == "bad":
+            with pytest.raises(SystemExit):
+                sc.finish_embed(mux, None)
+            continue
+
+        sc.finish_embed(mux, None)
+        with open(mux[1], "rb") as f:
+            assert f.read().split(b"\n")[:3] == [b"hdr", b"line 0", b"line 1"]
+
+    assert not [x for x in os.listdir(str(tmp_path)) if x.endswith(".ass")]
+
+
+class EmoteSrv(http.server.BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path == "/flaky" and self.hits.count("/flaky") < 2:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/404":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            body = self.path.encode("ascii") * 1000
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass
+
+
+def test_fetch_all(tmp_path):
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), EmoteSrv)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/" % (srv.server_address[1],)
+    try:
+        jobs = [[url + "e%d" % n, str(tmp_path / str(n))] for n in range(20)]
+        jobs.append([url + "flaky", str(tmp_path / "flaky")])
+        assert fetch_all(jobs, 4) == []
+        for u, fn in jobs:
+            with open(fn, "rb") as f:
+                assert f.read() == u[len(url) - 1 :].encode("ascii") * 1000
+
+        # a broken one is replaced
+        with open(jobs[0][1], "wb") as f:
+            f.write(b"<html>error</html>")
+
+        assert fetch_all(jobs[:1], 4) == []
+        with open(jobs[0][1], "rb") as f:
+            assert f.read() == b"/e0" * 1000
+
+        errs = fetch_all([[url + "404", str(tmp_path / "404")]])
+        assert len(errs) == 1 and not os.path.exists(errs[0][1])
+        assert sorted(os.listdir(str(tmp_path))) == sorted(
+            [os.path.basename(x[1]) for x in jobs]
+        )
+    finally:
+        srv.shutdown()
+
+
+def test_emote_conv(tmp_path, monkeypatch):
+    from PIL import Image
+    from . import __main__ as sc
+
+    # stand-in for imagemagick; copies the source and counts the runs
+    conv = "import sys, shutil; shutil.copy(sys.argv[1], sys.argv[-1]); "
+    conv += "open(sys.argv[1] + '.n', 'a').write('x')"
+    monkeypatch.setattr(sc, "magick", [sys.executable, "-c", conv])
+    monkeypatch.setattr(sc, "MACOS", False)
+
+    emotes = {}
+    for n in range(6):
+        eid = "UCx/e%d" % (n,)
+        emotes[eid] = {"id": eid, "name": eid, "images": []}
+        im = Image.new("RGB", (8, 8), (n % 2, 0, 0))  # only 2 distinct
+        im.save(str(tmp_path / ("UCx_e%d" % (n,))), "PNG")
+
+    def run(overwrite):
+        sc.cache_emotes(emotes, str(tmp_path), overwrite, 4)
+        nconv = 0
+        for fn in os.listdir(str(tmp_path)):
+            if fn.endswith(".n"):
+                with open(str(tmp_path / fn)) as f:
+                    nconv += len(f.read())
+
+        return nconv
+
+    def check():
+        for e in emotes.values():
+            with open(e["filename"], "rb") as f1:
+                src = e["filename"].rsplit(".", 1)[0]
+                with open(src, "rb") as f2:
+                    assert f1.read() == f2.read()
+
+    assert run(False) == 2
+    check()
+
+    assert run(True) == 2  # fingerprints match; nothing to do
+    monkeypatch.setattr(sc, "EMOTE_CONV_VER", -1)
+    assert run(False) == 4
+
+    # new artwork for one of the linked ones; the others keep theirs
+    Image.new("RGB", (8, 8), (7, 0, 0)).save(str(tmp_path / "UCx_e0"), "PNG")
+    assert run(False) == 5
+    check()
+
+
+def test_stand_in_emotes(tmp_path):
+    from . import __main__ as sc
+
+    emotes = {}
+    for n in range(3):
+        eid = "UCx/e%d" % (n,)
+        emotes[eid] = {"id": eid, "name": eid, "shortcuts": [":e%d:" % (n,)]}
+
+    open(str(tmp_path / "UCx_e1.bg"), "w").close()
+    shortcuts, filled = sc.stand_in_emotes(emotes, str(tmp_path))
+    assert sorted(shortcuts) == [":e0:", ":e1:", ":e2:"]
+    assert len(set(shortcuts.values())) == 3
+    assert filled == [shortcuts[":e1:"]]
+    assert "\ue000" not in shortcuts.values()  # that's the fill
+    assert "point" not in emotes["UCx/e0"]
+
+
+def test_fontcache(tmp_path):
+    from fontTools.fontBuilder import FontBuilder
+    from fontTools.ttLib import TTFont
+    from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+    # stand-in for fontforge; records what it was asked to do
+    gens = []
+
+    def gen(emotes, font_fn, font_name, dont_write, base_fn):
+        gens.append([base_fn, {e["id"]: e["point"] for e in emotes.values()}])
+        fb = FontBuilder(1000, isTTF=True)
+        fb.setupGlyphOrder([".notdef"])
+        fb.setupCharacterMap({})
+        fb.setupGlyf({".notdef": TTGlyphPen(None).glyph()})
+        fb.setupHorizontalMetrics({".notdef": (1100, 0)})
+        fb.setupHorizontalHeader()
+        fb.setupNameTable({"familyName": font_name, "styleName": "Regular"})
+        fb.setupOS2()
+        fb.setupPost()
+        fb.save(font_fn)
+        return emote_map(emotes)
+
+    def emotes(n):
+        ret = {}
+        for n in range(n):
+            fn = str(tmp_path / ("e%d.svg" % (n % 4,)))  # only 4 distinct
+            with open(fn, "w") as f:
+                f.write("emote %d" % (n % 4,))
+
+            ret["id%d" % (n,)] = {"id": "id%d" % (n,), "filename": fn}
+            ret["id%d" % (n,)].update({"shortcuts": [":e%d:" % (n,)], "fill": False})
+
+        return ret
+
+    cache = str(tmp_path / "fonts")
+    font_fn = str(tmp_path / "x.ttf")
+    sc, _ = get_font(emotes(6), font_fn, "font A", False, cache, gen)
+    assert len(gens) == 1 and gens[0][0] is None
+    assert len(set(gens[0][1].values())) == 4
+    assert sc[":e0:"] == sc[":e4:"] == chr(0xE001)
+
+    # exact hit; just copied and renamed
+    sc2, _ = get_font(emotes(6), font_fn, "font B", False, cache, gen)
+    assert len(gens) == 1 and sc2 == sc
+    assert TTFont(font_fn)["name"].getDebugName(1) == "font B"
+
+    # near match; starts from the first font
+    e = emotes(7)
+    e["id6"]["fill"] = True
+    get_font(e, font_fn, "font C", False, cache, gen)
+    assert len(gens) == 2 and gens[1][0].startswith(cache)
+    assert gens[1][1]["id6"] == 0xE005
+    assert all(gens[1][1][k] == v for k, v in gens[0][1].items())
+
+
+def test_subset(tmp_path):
+    from fontTools.fontBuilder import FontBuilder
+    from fontTools.ttLib import TTFont
+    from fontTools.pens.ttGlyphPen import TTGlyphPen
+    from .subset import subset_font
+
+    chars = "abc世界"
+    names = [".notdef"] + ["g%d" % (n,) for n in range(len(chars))]
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(names)
+    fb.setupCharacterMap({ord(c): g for c, g in zip(chars, names[1:])})
+    fb.setupGlyf({x: TTGlyphPen(None).glyph() for x in names})
+    fb.setupHorizontalMetrics({x: (500, 0) for x in names})
+    fb.setupHorizontalHeader()
+    fb.setupNameTable({"familyName": "Squished Noto", "styleName": "Regular"})
+    fb.setupOS2()
+    fb.setupPost()
+    src = str(tmp_path / "noto.ttf")
+    fb.save(src)
+
+    cache = str(tmp_path / "subsets")
+    dst = str(tmp_path / "x.cjk.otf")
+    for name in ["font A", "font B"]:
+        subset_font(src, "a世", dst, name, cache)
+        font = TTFont(dst)
+        cmap = font.getBestCmap()
+        assert ord("世") in cmap and ord("界") not in cmap
+        assert font["name"].getDebugName(1) == name
+        assert font["name"].getDebugName(6) == name.replace(" ", "") + "CJK"
+
+    # same chars, same subset
+    assert len(os.listdir(cache)) == 1
+
+
+def test_ffworker(tmp_path, monkeypatch):
+    from . import __main__ as sc, util
+
+    # stand-in for the fontforge module, good enough for gen_fonts
+    stub = """
+import os
+
+class G(object):
+    def importOutlines(self, fn):
+        print("fontforge says hi")  # should not break the protocol
+    def autoTrace(self):
+        pass
+
+class F(object):
+    def createChar(self, point):
+        return G()
+    def correctDirection(self):
+        pass
+    def generate(self, fn):
+        if self.familyname == "crash":
+            os._exit(1)
+        with open(fn, "w") as f:
+            f.write(str(os.getpid()))
+
+def font():
+    return F()
+"""
+    with open(str(tmp_path / "fontforge.py"), "w") as f:
+        f.write(stub)
+
+    monkeypatch.setattr(util, "HAVE_FONTFORGE", sys.executable)
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+    svg = str(tmp_path / "e.svg")
+    with open(svg, "w") as f:
+        f.write("<svg/>")
+
+    emotes = {"e": {"id": "e", "filename": svg, "shortcuts": [":e:"]}}
+    emotes["e"].update({"fill": False, "point": 0xE001})
+    font_fn = str(tmp_path / "x.ttf")
+
+    def pid(name):
+        ret = sc.generate_font(emotes, font_fn, name, False, None)
+        assert ret == [{":e:": chr(0xE001)}, []]
+        with open(font_fn) as f:
+            return f.read()
+
+    w = sc.FFWorker()
+    monkeypatch.setattr(sc, "ffworker", w)
+    try:
+        assert pid("a") == pid("b")  # same worker both times
+        p1 = pid("c")
+        with pytest.raises(Exception):
+            pid("crash")
+
+        assert pid("d") != p1  # and a new one after the crash
+
+        # concurrent callers (--batch building emotes) get their own replies
+        def one(n):
+            sc_ = ":e%d:" % (n,)
+            e = {"e": dict(emotes["e"], shortcuts=[sc_])}
+            fn = str(tmp_path / ("x%d.ttf" % (n,)))
+            for _ in range(5):
+                shortcuts, _ = sc.generate_font(e, fn, "t", False, None)
+                assert shortcuts == {sc_: chr(0xE001)}
+
+        with ThreadPoolExecutor(4) as ex:
+            list(ex.map(one, range(4)))
+    finally:
+        w.close()
+
+
+def test_batch_in_order():
+    from . import __main__ as sc
+
+    # groups of [n_msg, x] as they come back from the pool;
+    # falsy results are skipped but still count as done
+    groups = [[[3, "d"], [0, "a"]], [[2, None]], [[4, "e"], [1, "b"]]]
+    assert list(sc.in_order(iter(groups))) == [(0, "a"), (1, "b"), (3, "d"), (4, "e")]
+
+
+def test_batch(tmp_path):
+    from . import __main__ as sc
+    from .golden import synth_chat
+
+    # a broken file in the middle doesn't stop the rest
+    fns = []
+    chats = [["a", synth_chat(1, 100)], ["bad", "nope"], ["c", synth_chat(2, 100)]]
+    for name, chat in chats:
+        fns.append(str(tmp_path / (name + ".json")))
+        with open(fns[-1], "w", encoding="utf-8") as f:
+            json.dump(chat, f)
+
+    args = ["-m2", "--sz", "24", "--executor", "serial", "--batch"]
+    args += ["--fontdir", stand_in_noto(tmp_path)]
+    ar = sc.mk_argparser().parse_args(args + fns)
+    with pytest.raises(SystemExit) as ex:
+        sc.batch(ar, False)
+
+    assert ex.value.code == 1
+    outs = [x for x in os.listdir(str(tmp_path)) if x.endswith(".ass")]
+    assert sorted(outs) == ["a.ass", "c.ass"]
+
+
+def test_executors(monkeypatch):
+    from . import executor
+
+    class FakeCtx(object):
+        def __init__(self, ar, have_fugashi):
+            self.args = None
+
+    def fake_thr(ctx, a):
+        return [[n, [ctx.args, msg, id(ctx)]] for n, msg in a]
+
+    monkeypatch.setattr(executor, "Ctx", FakeCtx)
+    monkeypatch.setattr(executor, "gen_msg_thr", fake_thr)
+
+    groups = [[[n, n * 2]] for n in range(executor.SERIAL_MAX + 50)]
+    rets = {}
+    for kind in ["serial", "thread"]:
+        with executor.get_executor(kind, None, False, 3) as ex:
+            got = [x for rets in ex.measure("a1", groups) for x in rets]
+            assert ex.map(abs, [-1, 2, -3]) == [1, 2, 3]
+
+        rets[kind] = sorted([n, a, msg] for n, [a, msg, _] in got)
+        # one Ctx per thread, at most
+        ctxs = set(x[1][2] for x in got)
+        assert len(ctxs) <= (1 if kind == "serial" else 3)
+
+    assert rets["serial"] == rets["thread"]
+    assert rets["serial"] == [[n, "a1", n * 2] for n in range(len(groups))]
+
+
+def test_api(tmp_path):
+    import subprocess as sp
+    from .api import Converter, options
+    from .golden import synth_chat
+
+    with pytest.raises(TypeError):
+        options(nope=1)
+
+    with pytest.raises(ValueError):
+        Converter(options(emote_font=True))
+
+    # a normal chat, deletions and all; same as the cli
+    chat = synth_chat(3, 300)
+    assert any(x["action_type"] == "mark_chat_item_as_deleted" for x in chat)
+    fontdir = stand_in_noto(tmp_path)
+    with Converter(options(m=2, j=1, fontdir=fontdir)) as conv:
+        a = list(conv.convert(iter(chat)))
+        b = list(conv.convert(chat))
+
+    assert a == b
+    assert a[0] == "[Script Info]\n"
+    evs = [x for x in a if x.startswith("Dialogue: ")]
+    assert len(evs) > 250
+
+    fn = str(tmp_path / "a.json")
+    with open(fn, "w", encoding="utf-8") as f:
+        json.dump(chat, f)
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    cmd = [sys.executable, "-m", "softchat", "-m2", "-j1", "--fontdir", fontdir, fn]
+    sp.run(cmd, env=env, stdout=sp.DEVNULL, stderr=sp.DEVNULL, check=True)
+    with open(str(tmp_path / "a.ass"), "r", encoding="utf-8") as f:
+        assert [x for x in f if x.startswith("Dialogue: ")] == evs
+
+
+def test_importtime():
+    import subprocess as sp
+
+    # what `softchat --help` costs; the heavy stuff must wait until it's used
+    def imported(*args):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+        cmd = [sys.executable, "-X", "importtime"] + list(args)
+        err = sp.run(cmd, env=env, stdout=sp.DEVNULL, stderr=sp.PIPE).stderr
+        ret = {}
+        for ln in err.decode("utf-8").split("\n")[1:]:
+            if "|" in ln:
+                _, us, name = ln.split("|")
+                ret[name.strip()] = int(us)
+
+        return ret
+
+    base = imported("-c", "pass")
+    got = imported("-m", "softchat", "--help")
+    heavy = "PIL requests fontforge fontTools nototools fugashi pprint colorsys"
+    heavy += " email subprocess multiprocessing chat_downloader zstandard"
+    bad = [x for x in got if x not in base and x.split(".")[0] in heavy.split()]
+    assert not bad, f"imported at startup: {bad}"
+    assert "softchat.mproc" in got
+
+
+def test_cpu_mem_limits(tmp_path):
+    from .util import cpu_limit, mem_avail
+
+    n = cpu_limit(str(tmp_path))  # no cgroup files; affinity only
+    assert n >= 1
+
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    assert cpu_limit(str(tmp_path)) == min(n, 2)
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert cpu_limit(str(tmp_path)) == n
+
+    mi = tmp_path / "meminfo"
+    mi.write_text("MemTotal: 8000000 kB\nMemAvailable: 4000000 kB\n")
+    assert mem_avail(str(tmp_path), str(mi)) == 4000000 * 1024
+    (tmp_path / "memory.max").write_text("1073741824\n")
+    (tmp_path / "memory.current").write_text("536870912\n")
+    assert mem_avail(str(tmp_path), str(mi)) == 536870912
+    (tmp_path / "memory.stat").write_text("file 400000000\ninactive_file 268435456\n")
+    assert mem_avail(str(tmp_path), str(mi)) == 536870912 + 268435456
+    (tmp_path / "memory.max").write_text("max\n")
+    assert mem_avail(str(tmp_path), str(mi)) == 4000000 * 1024
+    assert mem_avail(str(tmp_path), str(tmp_path / "nope")) is None
+
+    # v1
+    (tmp_path / "memory.max").unlink()
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "memory.limit_in_bytes").write_text("1073741824\n")
+    (tmp_path / "memory" / "memory.usage_in_bytes").write_text("1000000000\n")
+    stat = "inactive_file 1\ntotal_inactive_file 500000000\n"
+    (tmp_path / "memory" / "memory.stat").write_text(stat)
+    assert mem_avail(str(tmp_path), str(mi)) == 1073741824 - 500000000
+
+
+def test_probe(tmp_path, monkeypatch):
+    import struct
+    from . import probe
+
+    def el(eid, body):
+        # ebml element with an 8-byte size
+        return eid + bytes([1]) + len(body).to_bytes(7, "big") + body
+
+    video = el(b"\xe0", el(b"\xb0", b"\x07\x80") + el(b"\xba", b"\x04\x38"))
+    tracks = el(b"\xae", el(b"\x83", b"\x02"))  # audio
+    tracks += el(b"\xae", el(b"\x83", b"\x01") + video)
+    info = el(b"\x2a\xd7\xb1", b"\x0f\x42\x40")  # 1ms per tick
+    info += el(b"\x44\x89", struct.pack(">d", 5e3))
+    seg = el(b"\x15\x49\xa9\x66", info) + el(b"\x16\x54\xae\x6b", tracks)
+    # unknown size, like a live recording
+    seg = b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff" + seg
+    mkv = el(b"\x1a\x45\xdf\xa3", b"") + seg + el(b"\x1f\x43\xb6\x75", b"x" * 99)
+
+    def box(kind, body):
+        return struct.pack(">I4s", len(body) + 8, kind) + body
+
+    def trak(hdlr, w, h, dur):
+        tkhd = box(b"tkhd", b"\0" * 76 + struct.pack(">II", w << 16, h << 16))
+        mdhd = box(b"mdhd", b"\1" + b"\0" * 19 + struct.pack(">IQ", 1000, dur))
+        return box(b"trak", tkhd + box(b"mdia", mdhd + box(b"hdlr", b"\0" * 8 + hdlr)))
+
+    mvhd = box(b"mvhd", b"\0" * 12 + struct.pack(">II", 90000, 90000 * 62))
+    traks = trak(b"soun", 0, 0, 62060) + trak(b"vide", 720, 1280, 62000)
+    moov = box(b"moov", mvhd + traks)
+    mp4 = box(b"ftyp", b"isom") + box(b"mdat", b"x" * 999) + moov
+
+    for ext, buf, want in [
+        ["webm", mkv, (5.0, (1920, 1080))],
+        ["mp4", mp4, (62.0, (720, 1280))],
+    ]:
+        fn = str(tmp_path / ("v." + ext))
+        with open(fn, "wb") as f:
+            f.write(buf)
+
+        assert get_media_info(fn) == want
+
+    # and the second time around it doesn't even look
+    monkeypatch.setattr(probe, "read_info", None)
+    assert get_media_info(fn) == want
+
+
+def test_golden(tmp_path):
+    from .golden import synth_chat, fingerprint
+
+    a = synth_chat(3, 300)
+    assert a == synth_chat(3, 300) and a != synth_chat(4, 300)
+    kinds = set(x["action_type"] for x in a)
+    assert kinds == set(["add_chat_item", "mark_chat_item_as_deleted"])
+    assert any("amount" in x for x in a) and any("emotes" in x for x in a)
+
+    # only the events count
+    ev = "Dialogue: 0,0:00:01.00,0:00:02.00,a,,0,0,0,,hello\n"
+    fns = []
+    for n, hdr in enumerate(["; cmd a\n", "; cmd b\nPlayResX: 1\n"]):
+        fn = tmp_path / f"{n}.ass"
+        fn.write_text("[Script Info]\n" + hdr + "[Events]\n" + ev)
+        fns.append(fingerprint(str(fn)))
+
+    assert fns[0] == fns[1] and fns[0].startswith("1:")
+    (tmp_path / "2.ass").write_text(ev.replace("hello", "hallo"))
+    assert fingerprint(str(tmp_path / "2.ass")) != fns[0]
+
+
+def test_trace(tmp_path):
+    from . import trace
+
+    fn = str(tmp_path / "t.json")
+    (tmp_path / "t.json.1.part").write_text("[]")  # from a crash
+    trace.start(fn)
+    try:
+        with trace.span("outer", n=1):
+            pt = trace.Phases("chunk", 2)
+            for _ in range(3):
+                pt.begin()
+                pt.mark("a")
+                pt.mark("b")
+                pt.end(5)
+
+        assert list(trace.waits(iter([1, 2]), "wait", min_us=0)) == [1, 2]
+
+        # a worker's events, saved when the pool closes
+        w = trace.Tracer(fn, "worker")
+        w.pid += 1
+        w.add("load args", "worker", trace.now(), 5)
+        w.save()
+    finally:
+        trace.finish()
+
+    assert trace.TRACE is None
+    assert os.listdir(str(tmp_path)) == ["t.json"]
+    with open(fn, "r", encoding="utf-8") as f:
+        evs = [x for x in json.load(f)["traceEvents"] if x["ph"] == "X"]
+
+    names = [x["name"] for x in evs]
+    assert names.count("chunk") == 2  # one full, and the rest at finish
+    assert names.count("wait") == 2 and "outer" in names and "load args" in names
+    chunk = [x for x in evs if x["name"] == "chunk"][0]
+    assert chunk["args"]["rounds"] == 2 and chunk["args"]["units"] == 10
+    a, b = [x for x in evs if x["name"] in ("a", "b")][:2]
+    assert a["ts"] == chunk["ts"] and b["ts"] == a["ts"] + a["dur"]
+
+
+def test_heatmap(tmp_path):
+    from .heatmap import density, windows, peaks, save_density, load_counts
+
+    def msg(t, kind="add_chat_item"):
+        return {"action_type": kind, "time_in_seconds": t}
+
+    ytdlp = {"actions": [{"addChatItemAction": {}}], "videoOffsetTimeMsec": "3500"}
+    items = [msg(0.5), msg(3.9), msg(-2), msg(5, "mark_chat_item_as_deleted")]
+    items += [{"replayChatItemAction": ytdlp}, msg(7)]
+    assert density(items) == [1, 0, 0, 2, 0, 0, 0, 1]
+
+    rng = random.Random(1)
+    counts = [rng.randrange(9) for _ in range(500)]
+    for w, win in zip([1, 7, 600], windows(counts, [1, 7, 600])):
+        assert win == [sum(counts[max(0, n - w + 1) : n + 1]) for n in range(500)]
+
+    rows = peaks([0, 1, 0, 0, 5, 0, 1], [1, 2], 3)
+    assert rows == [[0, [[1, 1], [1, 1]]], [3, [[5, 4], [5, 4]]], [6, [[1, 6], [1, 6]]]]
+
+    # the sidecar is used until the chat changes
+    fn = str(tmp_path / "a.json")
+    with open(fn, "w", encoding="utf-8") as f:
+        json.dump(items, f)
+
+    save_density(fn, [msg(1)])
+    assert load_counts(fn) == [0, 1]
+    with open(fn, "a", encoding="utf-8") as f:
+        f.write("\n")
+
+    assert load_counts(fn) == density(items)
+    assert os.path.exists(fn + ".softchat-density")
+
+
+if __name__ == "__main__":
+    # python3 -m softchat.the_test
+    bench()
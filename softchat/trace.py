@@ -0,0 +1,189 @@
+# --trace; where the time goes, in this process and every worker, as
+# chrome trace-event json (open it in ui.perfetto.dev or chrome://tracing)
+
+import os
+import json
+import glob
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from .util import info
+
+
+# the Tracer of this process, if --trace
+TRACE = None
+
+# native ids match what perfetto shows for other tools; 3.8+
+get_tid = getattr(threading, "get_native_id", threading.get_ident)
+
+
+def now():
+    # microseconds; perf_counter is system-wide so this lines up across workers
+    return perf_counter() * 1e6
+
+
+class Tracer(object):
+    """the events of one process; workers save theirs next to fn"""
+
+    def __init__(self, fn, pname):
+        self.fn = fn
+        self.pid = os.getpid()
+        self.evs = []
+        self.tids = set()
+        self.phases = []
+        self.meta("process_name", 0, f"{pname} {self.pid}")
+
+    def meta(self, k, tid, name):
+        ev = {"ph": "M", "name": k, "pid": self.pid, "tid": tid, "args": {"name": name}}
+        self.evs.append(ev)
+
+    def tid(self):
+        tid = get_tid()
+        if tid not in self.tids:
+            self.tids.add(tid)
+            self.meta("thread_name", tid, threading.current_thread().name)
+
+        return tid
+
+    def add(self, name, cat, ts, dur, args=None, tid=None):
+        ev = {"ph": "X", "name": name, "cat": cat, "ts": ts, "dur": dur}
+        ev.update(pid=self.pid, tid=tid or self.tid())
+        if args:
+            ev["args"] = args
+
+        self.evs.append(ev)
+
+    def save(self):
+        # worker exit; finish() in the main process picks it up
+        for x in self.phases:
+            x.flush()
+
+        with open(f"{self.fn}.{self.pid}.part", "w", encoding="utf-8") as f:
+            json.dump(self.evs, f)
+
+
+def start(fn):
+    global TRACE
+    for x in glob.glob(glob.escape(fn) + ".*.part"):
+        os.unlink(x)  # leftovers from a crash
+
+    TRACE = Tracer(fn, "softchat")
+
+
+def worker(fn):
+    """in a pool worker; saves the events when the pool is closed"""
+    global TRACE
+    from multiprocessing.util import Finalize
+
+    TRACE = Tracer(fn, "worker")
+    Finalize(TRACE, TRACE.save, exitpriority=10)
+
+
+def finish():
+    """writes the trace, with the workers' events merged in"""
+    global TRACE
+    tr, TRACE = TRACE, None
+    for x in tr.phases:
+        x.flush()
+
+    evs = tr.evs
+    for fn in sorted(glob.glob(glob.escape(tr.fn) + ".*.part")):
+        with open(fn, "r", encoding="utf-8") as f:
+            evs += json.load(f)
+
+        os.unlink(fn)
+
+    with open(tr.fn, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": evs, "displayTimeUnit": "ms"}, f)
+
+    info(f"wrote {len(evs)} trace events to {tr.fn}")
+
+
+@contextmanager
+def span(name, cat="main", **args):
+    """records how long the block took, if --trace"""
+    if not TRACE:
+        yield
+        return
+
+    t0 = now()
+    try:
+        yield
+    finally:
+        TRACE.add(name, cat, t0, now() - t0, args)
+
+
+def waits(it, name, cat="pool", min_us=500):
+    """yields from it, recording the waits for the next item if --trace"""
+    if not TRACE:
+        yield from it
+        return
+
+    it = iter(it)
+    while True:
+        t0 = now()
+        try:
+            x = next(it)
+        except StopIteration:
+            return
+
+        dur = now() - t0
+        if dur >= min_us:
+            TRACE.add(name, cat, t0, dur)
+
+        yield x
+
+
+class Phases(object):
+    """
+    where the time goes in a hot loop, without an event for each round;
+    mark(k) adds the time since begin() or the previous mark to k, and
+    every `every` rounds that becomes one span with the sums laid out
+    after each other underneath it. the rest of the span ("idle") is
+    the time between rounds, waiting for work or sending results back
+    """
+
+    def __init__(self, name, every=100):
+        self.name = name
+        self.every = every
+        self.tr = TRACE
+        self.tid = TRACE.tid()
+        self.sums = {}
+        self.n = self.units = 0
+        self.t0 = self.t = self.t1 = 0
+        TRACE.phases.append(self)
+
+    def begin(self):
+        self.t = now()
+        if not self.n:
+            self.t0 = self.t
+
+    def mark(self, k):
+        t = now()
+        self.sums[k] = self.sums.get(k, 0) + t - self.t
+        self.t = t
+
+    def end(self, units):
+        self.t1 = now()
+        self.n += 1
+        self.units += units
+        if self.n >= self.every:
+            self.flush()
+
+    def flush(self):
+        if not self.n:
+            return
+
+        t0 = self.t0
+        dur = self.t1 - t0
+        busy = sum(self.sums.values())
+        args = {"rounds": self.n, "units": self.units}
+        args.update({k + "_ms": round(v / 1000, 3) for k, v in self.sums.items()})
+        args["idle_ms"] = round((dur - busy) / 1000, 3)
+        self.tr.add(self.name, "measure", t0, dur, args, self.tid)
+        for k, v in self.sums.items():
+            self.tr.add(k, "measure", t0, v, None, self.tid)
+            t0 += v
+
+        self.sums = {}
+        self.n = self.units = 0
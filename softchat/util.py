@@ -2,9 +2,9 @@
 
 import os
 import sys
+import json
 import shlex
 import logging
-import subprocess as sp
 from datetime import datetime
 from contextlib import contextmanager
 
@@ -79,11 +79,25 @@ def find_fontforge():
     return None
 
 
-HAVE_FONTFORGE = True
-try:
-    import fontforge
-except:
-    HAVE_FONTFORGE = find_fontforge()
+# None until have_fontforge() has looked
+HAVE_FONTFORGE = None
+
+
+def have_fontforge():
+    """
+    True if fontforge can be imported here, or else the path to an
+    ffpython which can; only looks when emotes are actually wanted
+    """
+    global HAVE_FONTFORGE
+    if HAVE_FONTFORGE is None:
+        try:
+            import fontforge
+
+            HAVE_FONTFORGE = True
+        except:
+            HAVE_FONTFORGE = find_fontforge() or False
+
+    return HAVE_FONTFORGE
 
 
 def load_fugashi(write_cfg=False):
@@ -227,81 +241,126 @@ def tt(s):
     return "{:d}:{:02d}".format(m, s)
 
 
-def get_ff_info(fn):
-    # ffprobe -hide_banner -v error -select_streams v:0 -show_entries stream=duration -of default=noprint_wrappers=1:nokey=1 foo.mkv
-    #   webm: n/a
-    #   mkv: n/a
-    #   mp4: numSec
-    # ffprobe -hide_banner -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 foo.mkv
-    #   webm: numSec
-    #   mkv: numSec
-    #   mp4: numSec (0.06 sec larger)
-
-    # Try to grab the duration for the video stream, if available, otherwise fall back to format duration (webm)
-
-    if fn.lower().endswith("mkv"):
-        ret = sp.check_output(
-            [
-                "ffprobe",
-                "-hide_banner",
-                "-v",
-                "error",
-                "-select_streams",
-                "v:0",
-                "-show_entries",
-                "stream=width,height",
-                "-show_entries",
-                "stream=duration",
-                "-show_entries",
-                "format=duration",
-                "-of",
-                "default=noprint_wrappers=1:nokey=1",
-                fn,
-            ]
-        )
-        r = ret.decode("utf-8").strip().split("\n")
-        v_res = (int(r[0]), int(r[1]))
-
-        if len(r) == 4 and ":" in r[2]:
-            h, m, s = [float(x) for x in r[2].split(":")]
-            return 60 * (60 * h + m) + s, v_res
-        else:
-            return float(r[-1]), v_res
-    elif fn.lower().endswith("mp4"):
-        ret = sp.check_output(
-            [
-                "ffprobe",
-                "-hide_banner",
-                "-v",
-                "error",
-                "-select_streams",
-                "v:0",
-                "-show_entries",
-                "stream=width,height,duration",
-                "-of",
-                "default=noprint_wrappers=1:nokey=1",
-                fn,
-            ]
-        )
-        r = ret.decode("utf-8").strip().split("\n")
-        v_res = (int(r[0]), int(r[1]))
-        return float(r[2]), v_res
-    elif fn.lower().endswith("webm"):
-        ret = sp.check_output(
-            [
-                "ffprobe",
-                "-hide_banner",
-                "-v",
-                "error",
-                "-show_entries",
-                "format=width,height,duration",
-                "-of",
-                "default=noprint_wrappers=1:nokey=1",
-                fn,
-            ]
-        )
-        r = ret.decode("utf-8").strip().split("\n")
-        v_res = (int(r[0]), int(r[1]))
-        return float(r[2]), v_res
-    else:
-        raise Exception(f"Unknown video format {fn}")
+def unhms(s):
+    """seconds from [[h:]m:]s"""
+    ret = 0
+    for x in s.split(":"):
+        ret = ret * 60 + float(x)
+
+    return ret
+
+
+def sidecar_key(fn, ver):
+    st = os.stat(fn)
+    return [ver, st.st_size, st.st_mtime_ns]
+
+
+def sidecar_load(fn, suffix, ver):
+    """
+    what was cached in fn + suffix, or None if it's missing
+    or from another ver, or fn has changed since
+    """
+    try:
+        with open(fn + suffix, "r", encoding="utf-8") as f:
+            jd = json.load(f)
+
+        if jd["key"] == sidecar_key(fn, ver):
+            debug(f"using {fn}{suffix}")
+            return jd["v"]
+    except:
+        pass
+
+    return None
+
+
+def sidecar_save(fn, suffix, ver, v):
+    """caches v (json) next to fn; fine if it can't, like in a read-only dir"""
+    try:
+        jd = {"key": sidecar_key(fn, ver), "v": v}
+        with open(fn + suffix, "w", encoding="utf-8") as f:
+            json.dump(jd, f, separators=(",", ":"))
+    except Exception as ex:
+        debug(f"could not write {fn}{suffix}: {ex!r}")
+
+
+def read_num(fn):
+    """the first word of fn as an int; None if missing or not a number"""
+    try:
+        with open(fn, "r", encoding="utf-8") as f:
+            return int(f.read().split()[0])
+    except:
+        return None
+
+
+def read_stat(fn, key):
+    """the value of key in a memory.stat-like fn; 0 if not there"""
+    try:
+        with open(fn, "r", encoding="utf-8") as f:
+            for ln in f:
+                k, v = ln.split()[:2]
+                if k == key:
+                    return int(v)
+    except:
+        pass
+
+    return 0
+
+
+def cpu_limit(cg="/sys/fs/cgroup"):
+    """
+    how many cores this process can actually use; os.cpu_count is the
+    whole box, but taskset and container quotas can give us a lot less
+    """
+    try:
+        ret = len(os.sched_getaffinity(0))
+    except:
+        ret = os.cpu_count() or 1
+
+    # cgroup v2 says "max 100000" or "200000 100000"
+    try:
+        with open(os.path.join(cg, "cpu.max"), "r", encoding="utf-8") as f:
+            quota, period = f.read().split()[:2]
+
+        if quota != "max":
+            ret = min(ret, -(-int(quota) // int(period)))
+    except:
+        # v1; quota is -1 when unlimited
+        quota = read_num(os.path.join(cg, "cpu", "cpu.cfs_quota_us"))
+        period = read_num(os.path.join(cg, "cpu", "cpu.cfs_period_us"))
+        if quota and quota > 0 and period:
+            ret = min(ret, -(-quota // period))
+
+    return max(1, ret)
+
+
+def mem_avail(cg="/sys/fs/cgroup", meminfo="/proc/meminfo"):
+    """bytes of memory we can still use, or None if we can't tell"""
+    ret = []
+    try:
+        with open(meminfo, "r", encoding="utf-8") as f:
+            for ln in f:
+                if ln.startswith("MemAvailable:"):
+                    ret.append(int(ln.split()[1]) * 1024)
+    except:
+        pass
+
+    # cgroup v2, then v1 (which says 2**63-ish when unlimited);
+    # the usage includes page cache, so subtract the reclaimable
+    # part like kubelet and docker do
+    for lim, cur, stat, inactive in [
+        ["memory.max", "memory.current", "memory.stat", "inactive_file"],
+        [
+            "memory/memory.limit_in_bytes",
+            "memory/memory.usage_in_bytes",
+            "memory/memory.stat",
+            "total_inactive_file",
+        ],
+    ]:
+        lim = read_num(os.path.join(cg, lim))
+        cur = read_num(os.path.join(cg, cur))
+        if lim and lim < 1 << 60:
+            cur = max(0, (cur or 0) - read_stat(os.path.join(cg, stat), inactive))
+            ret.append(max(0, lim - cur))
+            break
+
+    return min(ret) if ret else None